@@ -0,0 +1,457 @@
+"""
+Бенчмарк отрисовки графиков фертильности
+
+Запуск: python chart_benchmark.py [all|analysis|render|soak] [--soak-renders N]
+
+analysis - анализ циклов и отрисовка маркеров; render - время, пик RSS и
+размер файла каждого графика для синтетических рядов разной длины;
+soak - многократная отрисовка под tracemalloc, завершается с кодом 1,
+если память растет или остаются незакрытые фигуры.
+"""
+
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Optional
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+from fertility_chart_generator import (
+    FertilityChartGenerator, FertilityAnalyzer, FertilityPhase, CycleSeries,
+    get_fertility_predictions, OVERLAY_ALIGNMENTS, CHART_DPI
+)
+from cohort_analyzer import CohortBatch, analyze_cohort, cohort_status_rows
+from light_chart_renderer import LightChartRenderer
+from render_pool import render_chart
+
+DAY_COUNTS = [30, 90, 365]
+LONG_SERIES_DAYS = [365, 3 * 365, 10 * 365]
+SERIES_DAYS = [90, 365, 1000]
+COHORT_USERS = 5000
+REPEATS = 3
+
+RENDER_DAYS = [30, 90, 365, 1000]
+# (график, профиль): профиль - разрешение из CHART_DPI; SVG - легкий рендерер
+RENDER_PROFILES = [
+    ("temperature", "preview"), ("temperature", "full"),
+    ("summary", "preview"), ("summary", "full"),
+    ("overlay", "preview"), ("overlay", "full"),
+    ("svg", "-"),
+]
+CONCURRENCY_LEVELS = [1, 2, 4]
+CONCURRENCY_RENDERS = 8
+
+SOAK_RENDERS = 2000
+SOAK_WARMUP = 50              # отрисовок до базового снимка (кэши шрифтов, текста)
+SOAK_GROWTH_LIMIT_KB = 1024   # допустимый прирост памяти Python за весь прогон
+SOAK_RSS_LIMIT_MB = 64        # допустимый прирост RSS (память вне tracemalloc: буферы Agg и т.п.)
+
+
+def generate_synthetic_records(days: int, seed: int = 42, gap_probability: float = 0.1) -> List[Dict]:
+    """Синтетические записи: 28-дневные циклы с подъемом температуры и пропусками"""
+    rng = random.Random(seed)
+    start = date(2024, 1, 1)
+    records = []
+
+    for i in range(days):
+        if rng.random() < gap_probability:
+            continue
+        cycle_day = i % 28
+        temperature = 36.3 + (0.4 if cycle_day > 14 else 0.0) + rng.uniform(-0.1, 0.1)
+        records.append({
+            'record_date': start + timedelta(days=i),
+            'temperature': round(temperature, 2) if rng.random() > gap_probability else None,
+            'menstruation_type': 'Средние' if cycle_day < 4 else None,
+        })
+
+    return records
+
+
+def _legacy_markers(ax, cycle_data: CycleSeries):
+    """Прежняя отрисовка маркеров: один scatter на каждый день"""
+    dates = cycle_data.dates.tolist()
+    for i, day_date in enumerate(dates):
+        temperature = cycle_data.temperatures[i]
+        if np.isnan(temperature):
+            continue
+        phase = cycle_data.phase_at(i)
+        if phase == FertilityPhase.OVULATION:
+            ax.scatter(day_date, temperature, s=100, c='red', marker='*', zorder=5)
+        if cycle_data.fertile[i] and phase != FertilityPhase.OVULATION:
+            ax.scatter(day_date, temperature, s=60, c='orange', marker='o', alpha=0.7, zorder=4)
+        if phase == FertilityPhase.MENSTRUAL:
+            ax.scatter(day_date, temperature, s=80, c='darkred', marker='s', zorder=4)
+
+
+def _legacy_bars(ax, cycle_data: CycleSeries, phase_colors: Dict[FertilityPhase, str]):
+    """Прежняя полоса фаз: один ax.bar на каждый день"""
+    dates = cycle_data.dates.tolist()
+    for i in np.flatnonzero(cycle_data.has_entry):
+        phase = cycle_data.phase_at(i)
+        height = 1.5 if cycle_data.fertile[i] else 1.0
+        if phase == FertilityPhase.MENSTRUAL:
+            height = 0.8
+        ax.bar(dates[i], height, color=phase_colors.get(phase, '#CCCCCC'), alpha=0.7, width=0.8)
+
+
+def _time_draw(draw) -> float:
+    """Среднее время построения и растеризации одной фигуры (мс)"""
+    total = 0.0
+    for _ in range(REPEATS):
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10))
+        started = time.perf_counter()
+        draw(ax1, ax2)
+        fig.canvas.draw()
+        total += time.perf_counter() - started
+        plt.close(fig)
+    return total / REPEATS * 1000
+
+
+def benchmark_markers_and_bars():
+    """Сравнение поштучной и коллекционной отрисовки маркеров и полосы фаз"""
+    generator = FertilityChartGenerator()
+    phase_colors = {
+        FertilityPhase.MENSTRUAL: '#FF6B6B',
+        FertilityPhase.FOLLICULAR: '#4ECDC4',
+        FertilityPhase.OVULATION: '#45B7D1',
+        FertilityPhase.LUTEAL: '#96CEB4',
+        FertilityPhase.UNKNOWN: '#CCCCCC'
+    }
+
+    print(f"{'дней':>6} {'поштучно, мс':>14} {'коллекции, мс':>14} {'ускорение':>10}")
+    for days in DAY_COUNTS:
+        cycle_data = generator.process_cycle_data(generate_synthetic_records(days))
+
+        def legacy(ax1, ax2):
+            _legacy_markers(ax1, cycle_data)
+            _legacy_bars(ax2, cycle_data, phase_colors)
+
+        def batched(ax1, ax2):
+            generator._add_special_markers(ax1, cycle_data)
+            generator._add_phase_bars(ax2, cycle_data, phase_colors)
+
+        legacy_ms = _time_draw(legacy)
+        batched_ms = _time_draw(batched)
+        print(f"{days:>6} {legacy_ms:>14.1f} {batched_ms:>14.1f} {legacy_ms / batched_ms:>9.1f}x")
+
+
+def _random_temperature_series(rng: random.Random, days: int) -> List:
+    """Случайный ряд температур с пропусками, ступеньками и повторами значений"""
+    base = rng.choice([36.0, 36.3, 36.55])
+    gap_probability = rng.choice([0.0, 0.2, 0.5])
+    series = []
+    for _ in range(days):
+        if rng.random() < gap_probability:
+            series.append(None)
+        else:
+            step = rng.choice([0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4])
+            series.append(round(base + step * rng.randint(0, 2), rng.choice([1, 2])))
+    return series
+
+
+def check_detect_ovulation_equivalence(trials: int = 20000, seed: int = 0) -> int:
+    """
+    Сравнение векторизованной detect_ovulation с исходной реализацией
+    на случайных рядах. Возвращает число проверенных рядов.
+    """
+    rng = random.Random(seed)
+    for _ in range(trials):
+        series = _random_temperature_series(rng, rng.randint(0, 60))
+        expected = FertilityAnalyzer._detect_ovulation_loop(series, [])
+        actual = FertilityAnalyzer.detect_ovulation(series, [])
+        if expected != actual:
+            raise AssertionError(f"Расхождение detect_ovulation на ряду {series}: {expected[0]} != {actual[0]}")
+    return trials
+
+
+def benchmark_detect_ovulation():
+    """Время detect_ovulation на многолетних рядах без подъема (полный просмотр)"""
+    rng = random.Random(1)
+    print(f"{'дней':>6} {'цикл Python, мс':>16} {'NumPy, мс':>10} {'ускорение':>10}")
+    for days in LONG_SERIES_DAYS:
+        series = [None if rng.random() < 0.1 else round(36.4 + rng.uniform(-0.05, 0.05), 2)
+                  for _ in range(days)]
+
+        def measure(func) -> float:
+            started = time.perf_counter()
+            for _ in range(REPEATS):
+                func(series, [])
+            return (time.perf_counter() - started) / REPEATS * 1000
+
+        loop_ms = measure(FertilityAnalyzer._detect_ovulation_loop)
+        numpy_ms = measure(FertilityAnalyzer.detect_ovulation)
+        print(f"{days:>6} {loop_ms:>16.2f} {numpy_ms:>10.2f} {loop_ms / numpy_ms:>9.1f}x")
+
+
+@dataclass
+class _LegacyCycleDay:
+    """Прежняя структура дня цикла (для сравнения с CycleSeries)"""
+    date: date
+    day_number: int
+    temperature: Optional[float] = None
+    mucus_type: Optional[str] = None
+    menstruation_type: Optional[str] = None
+    note: Optional[str] = None
+    phase: FertilityPhase = FertilityPhase.UNKNOWN
+    is_fertile: bool = False
+
+
+def _legacy_process_cycle_data(records: List[Dict]) -> List[_LegacyCycleDay]:
+    """Прежняя обработка: объект на каждую запись, номер дня по позиции в списке"""
+    sorted_records = sorted(records, key=lambda x: x['record_date'])
+    cycle_days = []
+    temperatures = []
+
+    for i, record in enumerate(sorted_records):
+        record_date = record['record_date']
+        if isinstance(record_date, str):
+            record_date = datetime.strptime(record_date, '%Y-%m-%d').date()
+        temp = float(record['temperature']) if record.get('temperature') else None
+        cycle_days.append(_LegacyCycleDay(
+            date=record_date,
+            day_number=i + 1,
+            temperature=temp,
+            mucus_type=record.get('mucus_type'),
+            menstruation_type=record.get('menstruation_type'),
+            note=record.get('note')
+        ))
+        temperatures.append(temp)
+
+    ovulation_day, phases = FertilityAnalyzer._detect_ovulation_loop(temperatures, [])
+    for i, day in enumerate(cycle_days):
+        day.phase = FertilityPhase.MENSTRUAL if day.menstruation_type else phases[i]
+        day.is_fertile = ovulation_day is not None and ovulation_day - 5 <= i <= ovulation_day + 1
+
+    return cycle_days
+
+
+def _measure_build(build, records: List[Dict]):
+    """Время построения (мс) и память, удерживаемая результатом (КБ)"""
+    started = time.perf_counter()
+    for _ in range(REPEATS):
+        build(records)
+    elapsed_ms = (time.perf_counter() - started) / REPEATS * 1000
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(records)
+    retained_kb = (tracemalloc.get_traced_memory()[0] - before) / 1024
+    tracemalloc.stop()
+    del result
+
+    return elapsed_ms, retained_kb
+
+
+def benchmark_cycle_series():
+    """Сравнение списка CycleDay и календарного CycleSeries по времени и памяти"""
+    generator = FertilityChartGenerator()
+    print(f"{'дней':>6} {'CycleDay, мс':>13} {'CycleSeries, мс':>16} {'CycleDay, КБ':>13} {'CycleSeries, КБ':>16}")
+    for days in SERIES_DAYS:
+        records = generate_synthetic_records(days)
+        legacy_ms, legacy_kb = _measure_build(_legacy_process_cycle_data, records)
+        series_ms, series_kb = _measure_build(generator.process_cycle_data, records)
+        print(f"{days:>6} {legacy_ms:>13.2f} {series_ms:>16.2f} {legacy_kb:>13.1f} {series_kb:>16.1f}")
+
+
+def _synthetic_cohort(users: int, records_per_user: int = 40) -> List[Dict]:
+    """Строки всех пользователей в порядке (user_id, дата), как из db.iter_recent_records"""
+    rows = []
+    for user_id in range(1, users + 1):
+        for record in generate_synthetic_records(records_per_user, seed=user_id, gap_probability=0.2):
+            rows.append({'user_id': user_id, **record})
+    return rows
+
+
+def benchmark_cohort_analysis():
+    """Пакетный анализ фаз против поштучного анализа пользователей (пользователей/с)"""
+    rows = _synthetic_cohort(COHORT_USERS)
+    per_user: Dict[int, List[Dict]] = {}
+    for row in rows:
+        per_user.setdefault(row['user_id'], []).append(row)
+
+    started = time.perf_counter()
+    expected = {user_id: get_fertility_predictions(records) for user_id, records in per_user.items()}
+    single_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    statuses = cohort_status_rows(analyze_cohort(CohortBatch.from_rows(rows)))
+    batch_seconds = time.perf_counter() - started
+
+    for user_id, phase, ovulation_day, cycle_length, fertile_days, _ in statuses:
+        prediction = expected[user_id]
+        if (phase, ovulation_day, cycle_length, fertile_days) != (
+                prediction['current_phase'], prediction['ovulation_day'],
+                prediction['cycle_length'], prediction['fertile_days_count']):
+            raise AssertionError(f"Расхождение пакетного анализа для пользователя {user_id}")
+
+    print(f"{COHORT_USERS} пользователей: поштучно {COHORT_USERS / single_seconds:.0f} польз./с, "
+          f"пакетно {COHORT_USERS / batch_seconds:.0f} польз./с (результаты совпадают)")
+
+
+def _rss_mb() -> float:
+    """Текущий RSS процесса (МБ)"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _render_once(generator: FertilityChartGenerator, cycle_data: CycleSeries,
+                 chart_type: str, quality: str) -> bytes:
+    """Одна отрисовка тем же путем, что и в боте (render_chart выполняется в процессе пула)"""
+    if chart_type == "svg":
+        return LightChartRenderer().svg_chart(cycle_data)
+    if chart_type in OVERLAY_ALIGNMENTS:
+        cycle_data = generator.build_cycle_overlay(cycle_data, OVERLAY_ALIGNMENTS[chart_type])
+    return render_chart(cycle_data, chart_type, CHART_DPI[quality])
+
+
+def _measure_render(chart_type: str, quality: str, days: int) -> Dict:
+    """
+    Замер в отдельном процессе: пик RSS процесса монотонен, поэтому
+    каждый график и длина ряда измеряются в новом процессе после прогрева.
+    """
+    generator = FertilityChartGenerator()
+    _render_once(generator, generator.process_cycle_data(generate_synthetic_records(30)), chart_type, quality)
+
+    cycle_data = generator.process_cycle_data(generate_synthetic_records(days))
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        image = _render_once(generator, cycle_data, chart_type, quality)
+        timings.append(time.perf_counter() - started)
+
+    return {
+        "ms": sorted(timings)[len(timings) // 2] * 1000,
+        "peak_mb": _peak_rss_mb(),
+        "kb": len(image) / 1024,
+    }
+
+
+def benchmark_rendering():
+    """Время, пик RSS и размер файла каждого графика и профиля для рядов 30-1000 дней"""
+    context = multiprocessing.get_context("spawn")
+    print(f"{'график':>12} {'профиль':>8} {'дней':>6} {'мс':>9} {'пик RSS, МБ':>12} {'размер, КБ':>11}")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as executor:
+        for chart_type, quality in RENDER_PROFILES:
+            for days in RENDER_DAYS:
+                result = executor.submit(_measure_render, chart_type, quality, days).result()
+                print(f"{chart_type:>12} {quality:>8} {days:>6} {result['ms']:>9.1f} {result['peak_mb']:>12.1f} "
+                      f"{result['kb']:>11.1f}")
+
+
+def benchmark_render_concurrency(days: int = 90):
+    """Пропускная способность пула отрисовки при разном числе одновременных запросов"""
+    import render_pool
+
+    cycle_data = FertilityChartGenerator().process_cycle_data(generate_synthetic_records(days))
+
+    async def run(concurrency: int) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await render_pool.render_in_pool(cycle_data, "temperature", CHART_DPI["preview"])
+
+        await render_pool.start_render_pool()
+        started = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(CONCURRENCY_RENDERS)])
+        return CONCURRENCY_RENDERS / (time.perf_counter() - started)
+
+    print(f"Пул отрисовки: {render_pool.RENDER_WORKERS} процессов, превью {days} дней")
+    for concurrency in CONCURRENCY_LEVELS:
+        print(f"  одновременно {concurrency}: {asyncio.run(run(concurrency)):.2f} графиков/с")
+    render_pool.shutdown_render_pool()
+
+
+def soak_test(renders: int = SOAK_RENDERS) -> bool:
+    """
+    Многократная отрисовка всех типов графиков (превью) под tracemalloc.
+    Базовый снимок памяти берется после первых 10% отрисовок (кэши шрифтов
+    и текста уже заполнены), дальше память не должна расти. Возвращает False,
+    если память Python или RSS выросли сверх порогов либо остались
+    незакрытые фигуры matplotlib. Под tracemalloc отрисовка в несколько раз
+    медленнее: 2000 графиков - десятки минут.
+    """
+    generator = FertilityChartGenerator()
+    cycle_data = generator.process_cycle_data(generate_synthetic_records(90))
+    chart_types = [chart_type for chart_type, _ in RENDER_PROFILES if chart_type != "svg"][::2] + ["svg"]
+    checkpoint = max(renders // 10, 1)
+
+    for i in range(SOAK_WARMUP):
+        _render_once(generator, cycle_data, chart_types[i % len(chart_types)], "preview")
+
+    tracemalloc.start()
+    baseline = None
+    started = time.perf_counter()
+    for i in range(renders):
+        _render_once(generator, cycle_data, chart_types[i % len(chart_types)], "preview")
+        if (i + 1) % checkpoint == 0:
+            gc.collect()
+            if baseline is None:
+                baseline = tracemalloc.take_snapshot()
+                baseline_traced = tracemalloc.get_traced_memory()[0]
+                baseline_rss = _rss_mb()
+            print(f"  {i + 1:>6} отрисовок: Python {(tracemalloc.get_traced_memory()[0] - baseline_traced) / 1024:+.1f} КБ, "
+                  f"RSS {_rss_mb() - baseline_rss:+.1f} МБ")
+
+    gc.collect()
+    growth_kb = (tracemalloc.get_traced_memory()[0] - baseline_traced) / 1024
+    rss_growth_mb = _rss_mb() - baseline_rss
+    open_figures = len(plt.get_fignums())
+    final = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    passed = growth_kb <= SOAK_GROWTH_LIMIT_KB and rss_growth_mb <= SOAK_RSS_LIMIT_MB and not open_figures
+    print(f"Прогон: {renders} отрисовок за {time.perf_counter() - started:.0f} с, "
+          f"Python {growth_kb:+.1f} КБ (порог {SOAK_GROWTH_LIMIT_KB}), "
+          f"RSS {rss_growth_mb:+.1f} МБ (порог {SOAK_RSS_LIMIT_MB}), незакрытых фигур: {open_figures}")
+    if not passed:
+        print("Наибольший прирост памяти:")
+        for stat in final.compare_to(baseline, "lineno")[:10]:
+            print(f"  {stat}")
+    return passed
+
+
+def benchmark_analysis():
+    benchmark_markers_and_bars()
+    print(f"\ndetect_ovulation: эквивалентность на {check_detect_ovulation_equivalence()} случайных рядах")
+    benchmark_detect_ovulation()
+    print()
+    benchmark_cycle_series()
+    print()
+    benchmark_cohort_analysis()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк графиков фертильности")
+    parser.add_argument("suite", nargs="?", default="all", choices=["all", "analysis", "render", "soak"])
+    parser.add_argument("--soak-renders", type=int, default=SOAK_RENDERS,
+                        help=f"отрисовок в проверке утечек (по умолчанию {SOAK_RENDERS})")
+    args = parser.parse_args()
+
+    if args.suite in ("all", "analysis"):
+        benchmark_analysis()
+    if args.suite in ("all", "render"):
+        print()
+        benchmark_rendering()
+        print()
+        benchmark_render_concurrency()
+    if args.suite in ("all", "soak"):
+        print()
+        if not soak_test(args.soak_renders):
+            sys.exit(1)
@@ -0,0 +1,155 @@
+"""
+Кэш отрисованных графиков и упреждающая отрисовка
+
+Графики кэшируются по отпечатку данных, из которых они строятся (даты,
+температуры, менструация), поэтому запись новых данных автоматически
+делает старый график неактуальным без явной инвалидации.
+
+После записи температуры превью графика отрисовывается заранее с
+низким приоритетом: большинство пользователей открывают график сразу
+после утреннего измерения, и тогда он отдается из кэша. Упреждающая
+отрисовка ограничена глобальным лимитом одновременных задач и
+отбрасывается, если пул отрисовки занят запросами пользователей.
+
+Сами отрисовки проходят через render_scheduler: он объединяет одинаковые
+задачи и отвечает RenderBusyError при перегрузке.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple
+
+from db_handler import db
+from lazy_modules import load_module
+from render_scheduler import render_scheduler, RenderBusyError, INTERACTIVE, SPECULATIVE
+
+CACHE_MAX_ENTRIES = int(os.getenv("CHART_CACHE_SIZE", "500"))
+SPECULATIVE_LIMIT = int(os.getenv("SPECULATIVE_RENDERS", "1"))  # одновременных упреждающих отрисовок
+MIN_TEMPERATURE_RECORDS = 3  # меньше - обработчик графика не рисует
+
+# (user_id, chart_type, quality) -> (отпечаток данных, PNG)
+_charts: "OrderedDict[Tuple[int, str, str], Tuple[str, bytes]]" = OrderedDict()
+_speculative_running = 0
+_speculative_users = set()
+_speculative_tasks = set()  # ссылки на задачи, чтобы их не собрал сборщик мусора
+
+# Статистика для журнала
+stats = {"hits": 0, "misses": 0, "speculative": 0, "dropped": 0}
+
+
+def records_fingerprint(records: List[Dict[str, Any]]) -> str:
+    """Отпечаток полей записей, от которых зависит график"""
+    digest = hashlib.blake2b(digest_size=16)
+    for record in sorted(records, key=lambda r: str(r['record_date'])):
+        digest.update(repr((
+            str(record['record_date']),
+            float(record['temperature']) if record.get('temperature') else None,
+            record.get('menstruation_type'),
+        )).encode())
+    return digest.hexdigest()
+
+
+def get_cached_chart(user_id: int, chart_type: str, fingerprint: str,
+                     quality: str = "preview") -> Optional[bytes]:
+    """График из кэша, если он построен по тем же данным"""
+    key = (user_id, chart_type, quality)
+    entry = _charts.get(key)
+    if entry is None or entry[0] != fingerprint:
+        return None
+    _charts.move_to_end(key)
+    return entry[1]
+
+
+def store_chart(user_id: int, chart_type: str, fingerprint: str, image: bytes,
+                quality: str = "preview"):
+    key = (user_id, chart_type, quality)
+    _charts[key] = (fingerprint, image)
+    _charts.move_to_end(key)
+    while len(_charts) > CACHE_MAX_ENTRIES:
+        _charts.popitem(last=False)
+
+
+def render_queue_busy() -> bool:
+    """Есть ли очередь на отрисовку или заняты все процессы"""
+    return render_scheduler.busy()
+
+
+async def get_or_render_chart(user_id: int, records: List[Dict[str, Any]],
+                              chart_type: str = "temperature",
+                              priority: int = INTERACTIVE,
+                              quality: str = "preview") -> Optional[bytes]:
+    """
+    График из кэша или новая отрисовка с сохранением в кэш.
+    quality: "preview" - для сообщения, "full" - 300 dpi для отправки файлом.
+    RenderBusyError, если очередь отрисовки переполнена.
+    """
+    fingerprint = records_fingerprint(records)
+    image = get_cached_chart(user_id, chart_type, fingerprint, quality)
+    if image is not None:
+        stats["hits"] += 1
+        return image
+
+    stats["misses"] += 1
+
+    async def render() -> Optional[bytes]:
+        chart_generator = await load_module("fertility_chart_generator")
+        chart_buffer = await chart_generator.generate_fertility_chart(records, chart_type, quality=quality)
+        if chart_buffer is None:
+            return None
+        rendered = chart_buffer.getvalue()
+        store_chart(user_id, chart_type, fingerprint, rendered, quality)
+        return rendered
+
+    # Тот же график, который уже ждет в очереди или рисуется (например,
+    # упреждающе), не рисуется повторно: планировщик вернет его результат
+    return await render_scheduler.submit((user_id, chart_type, quality, fingerprint), render, priority)
+
+
+async def _speculative_render(user_id: int):
+    """Упреждающая отрисовка графика температуры и обновление прогноза"""
+    global _speculative_running
+    # Столько же записей, сколько читает обработчик графика, иначе отпечаток не совпадет
+    from fertility_chart_bot_integration import CHART_RECORDS_LIMITS
+
+    try:
+        records = await db.get_user_records(user_id, limit=CHART_RECORDS_LIMITS["temperature"])
+        temp_records = [r for r in records if r.get('temperature')]
+        if len(temp_records) >= MIN_TEMPERATURE_RECORDS:
+            try:
+                await get_or_render_chart(user_id, records, "temperature", priority=SPECULATIVE)
+                stats["speculative"] += 1
+            except RenderBusyError:
+                stats["dropped"] += 1
+
+        # Модель прогноза пересчитывается здесь, если цикл закрылся,
+        # а не при открытии прогноза пользователем
+        predictor = await load_module("cycle_predictor")
+        await predictor.cycle_predictor.predict(user_id, records)
+    except Exception as e:
+        logging.error(f"Ошибка упреждающей отрисовки для пользователя {user_id}: {e}")
+    finally:
+        _speculative_running -= 1
+        _speculative_users.discard(user_id)
+
+
+def schedule_speculative_render(user_id: int) -> bool:
+    """
+    Планирование упреждающей отрисовки после записи температуры.
+    Задача отбрасывается, если достигнут лимит, пул занят или
+    для пользователя уже есть задача. Возвращает True, если задача запущена.
+    """
+    global _speculative_running
+    if (_speculative_running >= SPECULATIVE_LIMIT or user_id in _speculative_users
+            or render_queue_busy()):
+        stats["dropped"] += 1
+        return False
+
+    _speculative_running += 1
+    _speculative_users.add(user_id)
+    task = asyncio.get_running_loop().create_task(_speculative_render(user_id))
+    _speculative_tasks.add(task)
+    task.add_done_callback(_speculative_tasks.discard)
+    return True
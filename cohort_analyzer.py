@@ -0,0 +1,173 @@
+"""
+Пакетный анализ фаз цикла для всех активных пользователей
+
+Записи всех пользователей читаются одним запросом (курсором, в порядке user_id),
+упаковываются в «рваные» массивы NumPy (плоские значения + смещения пользователей)
+и анализируются матрицей сразу для тысяч пользователей за один векторизованный
+проход. Результаты записываются в таблицу phase_status одним запросом на пачку.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Optional, List, Dict, Any, Sequence
+
+import numpy as np
+
+from db_handler import db
+from fertility_chart_generator import FertilityAnalyzer, FertilityPhase, PHASES, PHASE_CODES
+
+RECORDS_PER_USER = 40    # как у get_user_records(limit=40) в обработчиках графиков
+USERS_PER_PASS = 2000    # пользователей в одном векторизованном проходе
+FETCH_BATCH_SIZE = 5000  # строк, получаемых из курсора за раз
+
+
+@dataclass
+class CohortBatch:
+    """
+    Записи пачки пользователей в виде рваных массивов: строки отсортированы
+    по (user_id, дата), записи пользователя i лежат в [offsets[i], offsets[i + 1])
+    """
+    user_ids: np.ndarray      # int64, по одному на пользователя
+    offsets: np.ndarray       # int64, len = пользователей + 1
+    day_ordinals: np.ndarray  # int64, date.toordinal() каждой записи
+    temperatures: np.ndarray  # float, NaN - нет измерения
+    menstrual: np.ndarray     # bool
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence) -> "CohortBatch":
+        """Упаковка строк (user_id, record_date, temperature, menstruation_type), отсортированных по user_id и дате"""
+        count = len(rows)
+        row_users = np.fromiter((r['user_id'] for r in rows), dtype=np.int64, count=count)
+        day_ordinals = np.fromiter((r['record_date'].toordinal() for r in rows), dtype=np.int64, count=count)
+        temperatures = np.fromiter(
+            (float(r['temperature']) if r['temperature'] else np.nan for r in rows), dtype=float, count=count)
+        menstrual = np.fromiter((bool(r['menstruation_type']) for r in rows), dtype=bool, count=count)
+
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(row_users)) + 1]).astype(np.int64)
+        return cls(
+            user_ids=row_users[starts],
+            offsets=np.append(starts, count),
+            day_ordinals=day_ordinals,
+            temperatures=temperatures,
+            menstrual=menstrual
+        )
+
+
+def analyze_cohort(batch: CohortBatch) -> Dict[str, np.ndarray]:
+    """
+    Анализ фаз для всех пользователей пачки за один проход. Ряды выравниваются
+    по календарю от первой записи пользователя (как CycleSeries) и дополняются NaN.
+    Возвращает массивы результатов по пользователям.
+    """
+    users = len(batch)
+    counts = np.diff(batch.offsets)
+    row_user = np.repeat(np.arange(users), counts)
+
+    first_ordinals = batch.day_ordinals[batch.offsets[:-1]]
+    columns = batch.day_ordinals - first_ordinals[row_user]
+    lengths = columns[batch.offsets[1:] - 1] + 1
+    width = int(lengths.max())
+
+    temperatures = np.full((users, width), np.nan)
+    temperatures[row_user, columns] = batch.temperatures
+    menstrual = np.zeros((users, width), dtype=bool)
+    menstrual[row_user, columns] = batch.menstrual
+
+    ovulation_days = FertilityAnalyzer.find_ovulation_days(temperatures)
+    codes = FertilityAnalyzer.phase_code_matrix(ovulation_days, lengths, width)
+    codes[menstrual] = PHASE_CODES[FertilityPhase.MENSTRUAL]
+    fertile = FertilityAnalyzer.fertile_window_matrix(ovulation_days, lengths, width)
+
+    # Текущая фаза: последний день с температурой или менструацией, иначе последний день ряда
+    with_data = ~np.isnan(temperatures) | menstrual
+    has_data = with_data.any(axis=1)
+    last_with_data = width - 1 - np.argmax(with_data[:, ::-1], axis=1)
+    current_day = np.where(has_data, last_with_data, lengths - 1)
+    current_codes = codes[np.arange(users), current_day]
+
+    # День цикла с фазой «Овуляция» (как в get_fertility_predictions)
+    ovulation_index = np.clip(ovulation_days + 1, 0, width - 1)
+    has_ovulation = (ovulation_days >= 0) & (codes[np.arange(users), ovulation_index] == PHASE_CODES[FertilityPhase.OVULATION])
+
+    return {
+        "user_ids": batch.user_ids,
+        "current_phase_codes": current_codes,
+        "ovulation_day": np.where(has_ovulation, ovulation_index + 1, -1),
+        "cycle_length": lengths,
+        "fertile_days": fertile.sum(axis=1),
+        "next_ovulation_ordinal": first_ordinals + lengths - 1 + 14,  # Примерная оценка
+    }
+
+
+def cohort_status_rows(results: Dict[str, np.ndarray]) -> List[tuple]:
+    """Преобразование результатов в строки для db.save_phase_statuses"""
+    return [
+        (
+            int(user_id),
+            PHASES[code].value,
+            int(ovulation_day) if ovulation_day >= 0 else None,
+            int(cycle_length),
+            int(fertile_days),
+            date.fromordinal(int(next_ovulation))
+        )
+        for user_id, code, ovulation_day, cycle_length, fertile_days, next_ovulation in zip(
+            results["user_ids"], results["current_phase_codes"], results["ovulation_day"],
+            results["cycle_length"], results["fertile_days"], results["next_ovulation_ordinal"]
+        )
+    ]
+
+
+async def refresh_cohort_status(records_per_user: int = RECORDS_PER_USER,
+                                active_since: Optional[date] = None,
+                                users_per_pass: int = USERS_PER_PASS) -> Dict[str, Any]:
+    """
+    Пересчет фаз всех пользователей (или только активных с active_since)
+    потоком из одного запроса. Возвращает статистику с пропускной способностью.
+    """
+    started = time.perf_counter()
+    processed_users = 0
+    pending: List = []
+
+    async def flush(rows: List) -> int:
+        if not rows:
+            return 0
+        batch = CohortBatch.from_rows(rows)
+        await db.save_phase_statuses(cohort_status_rows(analyze_cohort(batch)))
+        return len(batch)
+
+    try:
+        pending_users = 0
+        async for chunk in db.iter_recent_records(records_per_user, active_since, FETCH_BATCH_SIZE):
+            for row in chunk:
+                # Пачка режется только на границе пользователя
+                if pending and row['user_id'] != pending[-1]['user_id']:
+                    pending_users += 1
+                    if pending_users >= users_per_pass:
+                        processed_users += await flush(pending)
+                        pending, pending_users = [], 0
+                pending.append(row)
+
+        processed_users += await flush(pending)
+    except Exception as e:
+        logging.error(f"Ошибка пакетного анализа фаз: {e}")
+
+    elapsed = time.perf_counter() - started
+    users_per_second = processed_users / elapsed if elapsed > 0 else 0.0
+    logging.info(f"Пакетный анализ фаз: {processed_users} пользователей за {elapsed:.2f} с "
+                 f"({users_per_second:.0f} пользователей/с)")
+
+    return {
+        "users": processed_users,
+        "seconds": elapsed,
+        "users_per_second": users_per_second,
+    }
+
+
+def default_active_since(days: int = 3) -> date:
+    """Дата, с которой пользователь считается активным"""
+    return date.today() - timedelta(days=days)
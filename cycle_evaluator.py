@@ -0,0 +1,321 @@
+"""
+Инкрементальная оценка цикла по правилам симптотермального метода (Sensiplan)
+
+Каждое дневное наблюдение (температура, слизь, менструация, нарушения)
+обновляет состояние цикла за O(1): покровную линию, статус температурного
+сдвига («3 над 6») и счетчик дней после пика слизи. Состояние хранится в БД,
+поэтому текущая фаза и статус фертильного окна получаются поиском, а не
+пересчетом всей истории.
+"""
+
+import json
+import logging
+from copy import deepcopy
+from dataclasses import dataclass, field, asdict
+from datetime import date, datetime
+from typing import Optional, List, Dict, Any, Union
+
+from db_handler import db
+from fertility_phases import FertilityPhase
+
+LOW_TEMPERATURES = 6       # «6» в правиле «3 над 6»
+HIGHER_TEMPERATURES = 3    # «3» в правиле «3 над 6»
+SHIFT_DELTA = 0.2          # третье высокое значение выше покровной линии минимум на 0.2 °C
+PEAK_CLOSE_DAYS = 3        # окно закрывается вечером 3-го дня после пика слизи
+INFERTILE_START_DAYS = 5   # первые 5 дней цикла считаются нефертильными
+NEW_CYCLE_MIN_DAYS = 10    # раньше этого дня менструация без сдвига не начинает новый цикл
+REBUILD_RECORDS_LIMIT = 90  # сколько последних записей переигрывать при восстановлении
+
+# Качество слизи: чем выше, тем фертильнее
+MUCUS_RANKS = {
+    "Сухо": 1,
+    "Влажно": 2,
+    "Мокро": 3,
+}
+
+
+@dataclass
+class SensiplanState:
+    """Состояние текущего цикла (даты хранятся в формате YYYY-MM-DD)"""
+    cycle_start: Optional[str] = None
+    last_date: Optional[str] = None
+    last_menstruation: bool = False
+    low_temperatures: List[float] = field(default_factory=list)     # до 6 последних низких значений
+    higher_temperatures: List[float] = field(default_factory=list)  # текущая серия выше покровной линии
+    cover_line: Optional[float] = None
+    shift_start: Optional[str] = None  # первый день серии высоких значений
+    shift_confirmed: bool = False
+    shift_date: Optional[str] = None
+    best_mucus: int = 0
+    peak_date: Optional[str] = None
+    peak_confirmed: bool = False
+    fertile_started: bool = False
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SensiplanState":
+        known = {key: value for key, value in data.items() if key in cls.__dataclass_fields__}
+        return cls(**known)
+
+
+def _to_date(value: Union[str, date, None]) -> Optional[date]:
+    if value is None or isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _parse_disruptions(disruptions) -> List[str]:
+    if not disruptions:
+        return []
+    if isinstance(disruptions, str):
+        try:
+            return json.loads(disruptions) or []
+        except json.JSONDecodeError:
+            return []
+    return list(disruptions)
+
+
+class SensiplanEvaluator:
+    """Правила Sensiplan, применяемые к одному наблюдению за раз"""
+
+    @staticmethod
+    def observe(state: SensiplanState, record_date: Union[str, date],
+                temperature: Optional[float] = None, mucus_type: Optional[str] = None,
+                menstruation_type: Optional[str] = None, disruptions=None) -> SensiplanState:
+        """Возвращает новое состояние после наблюдения за день record_date"""
+        day = _to_date(record_date)
+        state = deepcopy(state)
+
+        # Начало нового цикла: первый день менструации после сдвига
+        # или после достаточно длинного цикла
+        if menstruation_type and not state.last_menstruation:
+            cycle_start = _to_date(state.cycle_start)
+            if (cycle_start is None or state.shift_confirmed
+                    or (day - cycle_start).days + 1 >= NEW_CYCLE_MIN_DAYS):
+                state = SensiplanState(cycle_start=day.isoformat())
+
+        if state.cycle_start is None:
+            state.cycle_start = day.isoformat()
+
+        state.last_date = day.isoformat()
+        state.last_menstruation = bool(menstruation_type)
+
+        # Температура с нарушениями измерения не учитывается
+        if temperature is not None and not _parse_disruptions(disruptions):
+            SensiplanEvaluator._observe_temperature(state, float(temperature), day)
+
+        rank = MUCUS_RANKS.get(mucus_type, 0)
+        if rank:
+            SensiplanEvaluator._observe_mucus(state, rank, day)
+
+        return state
+
+    @staticmethod
+    def _observe_temperature(state: SensiplanState, temperature: float, day: date):
+        """Обновление покровной линии и серии высоких значений («3 над 6»)"""
+        if state.shift_confirmed:
+            return
+
+        if state.higher_temperatures:
+            if temperature > state.cover_line:
+                state.higher_temperatures.append(temperature)
+                count = len(state.higher_temperatures)
+                # Основное правило: 3-е значение минимум на 0.2 °C выше покровной линии;
+                # исключение: если нет, достаточно 4-го значения выше покровной линии
+                if ((count == HIGHER_TEMPERATURES
+                        and round(temperature - state.cover_line, 2) >= SHIFT_DELTA)
+                        or count > HIGHER_TEMPERATURES):
+                    state.shift_confirmed = True
+                    state.shift_date = day.isoformat()
+                return
+
+            # Серия прервана: ее значения становятся обычными низкими
+            state.low_temperatures.extend(state.higher_temperatures)
+            state.higher_temperatures = []
+            state.cover_line = None
+            state.shift_start = None
+
+        elif len(state.low_temperatures) == LOW_TEMPERATURES and temperature > max(state.low_temperatures):
+            state.cover_line = max(state.low_temperatures)
+            state.higher_temperatures = [temperature]
+            state.shift_start = day.isoformat()
+            return
+
+        state.low_temperatures.append(temperature)
+        del state.low_temperatures[:-LOW_TEMPERATURES]
+
+    @staticmethod
+    def _observe_mucus(state: SensiplanState, rank: int, day: date):
+        """Обновление пика слизи: последний день самого фертильного качества"""
+        if rank >= MUCUS_RANKS["Влажно"]:
+            state.fertile_started = True
+            if rank >= state.best_mucus:
+                state.best_mucus = rank
+                state.peak_date = day.isoformat()
+                state.peak_confirmed = False
+                return
+
+        if state.peak_date and rank < state.best_mucus:
+            state.peak_confirmed = True
+
+    @staticmethod
+    def status(state: Optional[SensiplanState]) -> Dict[str, Any]:
+        """Текущая фаза и статус фертильного окна из сохраненного состояния"""
+        if state is None or state.last_date is None:
+            return {
+                "phase": FertilityPhase.UNKNOWN.value,
+                "fertile_window_open": None,
+                "cycle_day": None,
+            }
+
+        last_date = _to_date(state.last_date)
+        cycle_day = (last_date - _to_date(state.cycle_start)).days + 1
+
+        days_after_peak = None
+        if state.peak_date:
+            days_after_peak = (last_date - _to_date(state.peak_date)).days
+
+        if state.best_mucus == 0:
+            # Слизь не отмечалась: оценка только по температуре
+            mucus_closed = True
+        else:
+            mucus_closed = state.peak_confirmed and days_after_peak >= PEAK_CLOSE_DAYS
+
+        infertile = state.shift_confirmed and mucus_closed
+        fertile_window_open = not infertile and (state.fertile_started or cycle_day > INFERTILE_START_DAYS)
+
+        if state.last_menstruation:
+            phase = FertilityPhase.MENSTRUAL
+        elif infertile:
+            phase = FertilityPhase.LUTEAL
+        elif state.shift_confirmed or state.higher_temperatures or state.peak_confirmed:
+            phase = FertilityPhase.OVULATION
+        else:
+            phase = FertilityPhase.FOLLICULAR
+
+        if state.shift_confirmed:
+            shift_status = "подтвержден"
+        elif state.higher_temperatures:
+            shift_status = f"{len(state.higher_temperatures)}/{HIGHER_TEMPERATURES} высоких"
+        else:
+            shift_status = "нет"
+
+        return {
+            "phase": phase.value,
+            "fertile_window_open": fertile_window_open,
+            "cycle_day": cycle_day,
+            "cycle_start": state.cycle_start,
+            "cover_line": state.cover_line,
+            "shift_status": shift_status,
+            "shift_start": state.shift_start,
+            "shift_date": state.shift_date,
+            "peak_date": state.peak_date,
+            "days_after_peak": days_after_peak,
+        }
+
+
+class CycleTracker:
+    """Хранилище состояний циклов пользователей (кэш в памяти + таблица cycle_states)"""
+
+    def __init__(self):
+        # user_id -> {"day_start": состояние до текущего дня, "state": текущее состояние}
+        self._cache: Dict[int, Dict[str, SensiplanState]] = {}
+
+    async def _load(self, user_id: int) -> Optional[Dict[str, SensiplanState]]:
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            return entry
+
+        data = await db.get_cycle_state(user_id)
+        if not data:
+            return None
+
+        entry = {
+            "day_start": SensiplanState.from_dict(data.get("day_start", {})),
+            "state": SensiplanState.from_dict(data.get("state", {})),
+        }
+        self._cache[user_id] = entry
+        return entry
+
+    async def _save(self, user_id: int, entry: Dict[str, SensiplanState]):
+        self._cache[user_id] = entry
+        await db.save_cycle_state(user_id, {
+            "day_start": asdict(entry["day_start"]),
+            "state": asdict(entry["state"]),
+        })
+
+    async def observe(self, user_id: int, record_date: Union[str, date], record: Dict[str, Any]):
+        """
+        Учет дневной записи пользователя. Повторные изменения того же дня
+        переприменяются к состоянию на начало дня; правка прошедших дней
+        приводит к восстановлению состояния из записей.
+        """
+        try:
+            day = _to_date(record_date)
+            entry = await self._load(user_id)
+
+            if entry is not None and entry["state"].last_date:
+                last_date = _to_date(entry["state"].last_date)
+                if day < last_date:
+                    await self.rebuild(user_id)
+                    return
+                day_start = entry["day_start"] if day == last_date else entry["state"]
+            else:
+                day_start = SensiplanState()
+
+            state = SensiplanEvaluator.observe(
+                day_start, day,
+                temperature=record.get('temperature'),
+                mucus_type=record.get('mucus_type'),
+                menstruation_type=record.get('menstruation_type'),
+                disruptions=record.get('disruptions')
+            )
+            await self._save(user_id, {"day_start": day_start, "state": state})
+        except Exception as e:
+            logging.error(f"Не удалось обновить состояние цикла пользователя {user_id}: {e}")
+
+    async def observe_record(self, user_id: int, record_date: Union[str, date]):
+        """Учет сохраненной записи за день (после db.create_record)"""
+        record = await db.get_record_by_date(user_id, record_date)
+        if record:
+            await self.observe(user_id, record_date, record)
+
+    async def rebuild(self, user_id: int, records: Optional[List[Dict[str, Any]]] = None) -> Optional[SensiplanState]:
+        """Восстановление состояния переигрыванием последних записей"""
+        try:
+            if records is None:
+                records = await db.get_user_records(user_id, limit=REBUILD_RECORDS_LIMIT)
+            if not records:
+                return None
+
+            day_start = state = SensiplanState()
+            for record in sorted(records, key=lambda r: _to_date(r['record_date'])):
+                day_start = state
+                state = SensiplanEvaluator.observe(
+                    state, record['record_date'],
+                    temperature=record.get('temperature'),
+                    mucus_type=record.get('mucus_type'),
+                    menstruation_type=record.get('menstruation_type'),
+                    disruptions=record.get('disruptions')
+                )
+
+            await self._save(user_id, {"day_start": day_start, "state": state})
+            return state
+        except Exception as e:
+            logging.error(f"Не удалось восстановить состояние цикла пользователя {user_id}: {e}")
+            return None
+
+    async def invalidate(self, user_id: int):
+        """Сброс состояния (например, после импорта задним числом)"""
+        self._cache.pop(user_id, None)
+        await db.delete_cycle_state(user_id)
+
+    async def get_status(self, user_id: int, records: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Текущая фаза и фертильное окно; при отсутствии состояния оно восстанавливается"""
+        entry = await self._load(user_id)
+        if entry is not None:
+            return SensiplanEvaluator.status(entry["state"])
+        return SensiplanEvaluator.status(await self.rebuild(user_id, records))
+
+
+# Глобальный экземпляр
+cycle_tracker = CycleTracker()
@@ -0,0 +1,247 @@
+"""
+Прогноз следующей овуляции и менструации по истории циклов пользователя
+
+Из прошлых закрытых циклов оцениваются распределения длины цикла,
+длины лютеиновой фазы и дня температурного сдвига. Оценки сжимаются
+к популяционным значениям (нормальная модель с априорным «весом» в
+PRIOR_CYCLES циклов), поэтому при короткой истории прогноз близок к
+средним значениям, а с ростом истории становится индивидуальным.
+
+Параметры модели кэшируются (в памяти и в таблице cycle_models) и
+пересчитываются только после закрытия цикла, поэтому сам прогноз -
+это поиск в кэше и несколько сложений дат.
+"""
+
+import logging
+import math
+from dataclasses import dataclass, asdict
+from datetime import date, timedelta
+from typing import Optional, List, Dict, Any
+
+import numpy as np
+
+from db_handler import db
+from fertility_chart_generator import FertilityAnalyzer, FertilityChartGenerator
+from cycle_evaluator import cycle_tracker, NEW_CYCLE_MIN_DAYS, _to_date
+
+HISTORY_RECORDS_LIMIT = 400  # около года истории для оценки параметров
+PRIOR_CYCLES = 3.0           # вес популяционного априорного распределения (в циклах)
+
+# Популяционные значения: (среднее, стандартное отклонение) в днях
+POPULATION_CYCLE_LENGTH = (28.0, 3.5)
+POPULATION_LUTEAL_LENGTH = (13.0, 2.0)
+POPULATION_SHIFT_DAY = (16.0, 3.0)  # день цикла первого высокого значения
+
+# Границы правдоподобных значений: циклы с пропусками в записях
+# или без найденного сдвига не искажают оценки
+CYCLE_LENGTH_RANGE = (18, 60)
+LUTEAL_LENGTH_RANGE = (7, 20)
+
+
+@dataclass
+class CycleModel:
+    """Параметры модели циклов пользователя (средние и стандартные отклонения в днях)"""
+    cycle_length_mean: float = POPULATION_CYCLE_LENGTH[0]
+    cycle_length_sd: float = POPULATION_CYCLE_LENGTH[1]
+    luteal_length_mean: float = POPULATION_LUTEAL_LENGTH[0]
+    luteal_length_sd: float = POPULATION_LUTEAL_LENGTH[1]
+    shift_day_mean: float = POPULATION_SHIFT_DAY[0]
+    shift_day_sd: float = POPULATION_SHIFT_DAY[1]
+    cycles_observed: int = 0
+    last_cycle_start: Optional[str] = None  # начало текущего (незакрытого) цикла
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CycleModel":
+        known = {key: value for key, value in data.items() if key in cls.__dataclass_fields__}
+        return cls(**known)
+
+
+def shrink_to_prior(values: np.ndarray, prior_mean: float, prior_sd: float,
+                    prior_weight: float = PRIOR_CYCLES) -> tuple:
+    """
+    Апостериорные среднее и стандартное отклонение: выборочные оценки,
+    сжатые к априорным с весом prior_weight наблюдений
+    """
+    n = len(values)
+    if n == 0:
+        return prior_mean, prior_sd
+
+    mean = float(values.mean())
+    total = prior_weight + n
+    posterior_mean = (prior_weight * prior_mean + n * mean) / total
+    posterior_var = (
+        prior_weight * prior_sd ** 2
+        + n * float(values.var())
+        + prior_weight * n / total * (mean - prior_mean) ** 2
+    ) / total
+    return posterior_mean, math.sqrt(posterior_var)
+
+
+def extract_closed_cycles(records: List[Dict]) -> Dict[str, Any]:
+    """
+    Разбиение истории на циклы. Возвращает длины закрытых циклов, длины
+    лютеиновой фазы и дни сдвига (для циклов с найденным сдвигом)
+    и дату начала текущего цикла.
+    """
+    series = FertilityChartGenerator().process_cycle_data(records)
+    empty = np.array([], dtype=np.int64)
+    if series is None:
+        return {"lengths": empty, "luteal_lengths": empty, "shift_days": empty, "current_start": None}
+
+    # Граница цикла - как в cycle_evaluator
+    starts = FertilityAnalyzer.find_cycle_starts(series.menstrual, NEW_CYCLE_MIN_DAYS)
+    lengths = np.diff(starts)
+
+    luteal_lengths = []
+    shift_days = []
+    for start, length in zip(starts[:-1], lengths):
+        ovulation = FertilityAnalyzer.find_ovulation_day(series.temperatures[start:start + length])
+        if ovulation is not None:
+            # Индекс овуляции - день перед первым высоким значением
+            shift_days.append(ovulation + 2)
+            luteal_lengths.append(length - (ovulation + 1))
+
+    current_start = series.start + timedelta(days=int(starts[-1])) if len(starts) else series.start
+    return {
+        "lengths": lengths,
+        "luteal_lengths": np.array(luteal_lengths, dtype=np.int64),
+        "shift_days": np.array(shift_days, dtype=np.int64),
+        "current_start": current_start,
+    }
+
+
+def _in_range(values: np.ndarray, bounds: tuple) -> np.ndarray:
+    return values[(values >= bounds[0]) & (values <= bounds[1])].astype(float)
+
+
+def fit_cycle_model(records: List[Dict]) -> CycleModel:
+    """Оценка параметров модели по истории записей пользователя"""
+    cycles = extract_closed_cycles(records)
+
+    lengths = _in_range(cycles["lengths"], CYCLE_LENGTH_RANGE)
+    plausible = ((cycles["luteal_lengths"] >= LUTEAL_LENGTH_RANGE[0])
+                 & (cycles["luteal_lengths"] <= LUTEAL_LENGTH_RANGE[1]))
+    luteal_lengths = cycles["luteal_lengths"][plausible].astype(float)
+    shift_days = cycles["shift_days"][plausible].astype(float)
+
+    cycle_mean, cycle_sd = shrink_to_prior(lengths, *POPULATION_CYCLE_LENGTH)
+    luteal_mean, luteal_sd = shrink_to_prior(luteal_lengths, *POPULATION_LUTEAL_LENGTH)
+    shift_mean, shift_sd = shrink_to_prior(shift_days, *POPULATION_SHIFT_DAY)
+
+    current_start = cycles["current_start"]
+    return CycleModel(
+        cycle_length_mean=cycle_mean,
+        cycle_length_sd=cycle_sd,
+        luteal_length_mean=luteal_mean,
+        luteal_length_sd=luteal_sd,
+        shift_day_mean=shift_mean,
+        shift_day_sd=shift_sd,
+        cycles_observed=len(lengths),
+        last_cycle_start=current_start.isoformat() if current_start else None
+    )
+
+
+def predict_dates(model: CycleModel, cycle_start: date, shift_start: Optional[date] = None,
+                  today: Optional[date] = None) -> Dict[str, Any]:
+    """
+    Прогноз дат по модели и текущему циклу. Если сдвиг температуры в текущем
+    цикле подтвержден, менструация отсчитывается от овуляции по длине
+    лютеиновой фазы, иначе - от начала цикла по средней длине цикла.
+    """
+    today = today or date.today()
+    ovulation_offset = round(model.shift_day_mean) - 2  # дней от начала цикла до овуляции
+
+    if shift_start is not None:
+        ovulation = shift_start - timedelta(days=1)
+        next_period = ovulation + timedelta(days=round(model.luteal_length_mean))
+        period_sd = model.luteal_length_sd
+    else:
+        next_period = cycle_start + timedelta(days=round(model.cycle_length_mean))
+        period_sd = model.cycle_length_sd
+    # Задержка: менструация ожидается не раньше завтрашнего дня
+    next_period = max(next_period, today + timedelta(days=1))
+
+    current_ovulation = cycle_start + timedelta(days=ovulation_offset)
+    if shift_start is None and current_ovulation >= today:
+        next_ovulation = current_ovulation
+    else:
+        next_ovulation = next_period + timedelta(days=ovulation_offset)
+
+    return {
+        "next_period": next_period,
+        "next_period_sd": period_sd,
+        "next_ovulation": next_ovulation,
+        "next_ovulation_sd": model.shift_day_sd,
+        "cycles_observed": model.cycles_observed,
+    }
+
+
+class CyclePredictor:
+    """Кэш моделей циклов пользователей (в памяти + таблица cycle_models)"""
+
+    def __init__(self):
+        self._cache: Dict[int, CycleModel] = {}
+
+    async def _load(self, user_id: int) -> Optional[CycleModel]:
+        model = self._cache.get(user_id)
+        if model is not None:
+            return model
+
+        data = await db.get_cycle_model(user_id)
+        if not data:
+            return None
+
+        model = CycleModel.from_dict(data)
+        self._cache[user_id] = model
+        return model
+
+    async def refit(self, user_id: int) -> CycleModel:
+        """Пересчет модели по истории пользователя"""
+        records = await db.get_user_records(user_id, limit=HISTORY_RECORDS_LIMIT)
+        model = fit_cycle_model(records)
+        self._cache[user_id] = model
+        await db.save_cycle_model(user_id, asdict(model))
+        logging.info(f"Модель циклов пользователя {user_id} обновлена: "
+                     f"{model.cycles_observed} циклов, длина {model.cycle_length_mean:.1f} дн.")
+        return model
+
+    async def get_model(self, user_id: int, cycle_start: Optional[str] = None) -> CycleModel:
+        """
+        Модель пользователя из кэша. Пересчитывается, только если ее еще нет
+        или текущий цикл начался позже последнего учтенного (цикл закрылся).
+        """
+        model = await self._load(user_id)
+        if model is None or (cycle_start and model.last_cycle_start
+                             and _to_date(cycle_start) > _to_date(model.last_cycle_start)):
+            model = await self.refit(user_id)
+            if cycle_start and (not model.last_cycle_start
+                                or _to_date(cycle_start) > _to_date(model.last_cycle_start)):
+                # Начало цикла по состоянию Sensiplan считается учтенным,
+                # чтобы расхождение границ не вызывало пересчет на каждый запрос
+                model.last_cycle_start = cycle_start
+                await db.save_cycle_model(user_id, asdict(model))
+        return model
+
+    async def invalidate(self, user_id: int):
+        """Сброс модели (например, после импорта истории)"""
+        self._cache.pop(user_id, None)
+        await db.delete_cycle_model(user_id)
+
+    async def predict(self, user_id: int, records: Optional[List[Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
+        """Прогноз следующей менструации и овуляции для пользователя"""
+        try:
+            status = await cycle_tracker.get_status(user_id, records)
+            cycle_start = status.get("cycle_start")
+            if not cycle_start:
+                return None
+
+            model = await self.get_model(user_id, cycle_start)
+            shift_start = status.get("shift_start") if status.get("shift_date") else None
+            return predict_dates(model, _to_date(cycle_start), _to_date(shift_start))
+        except Exception as e:
+            logging.error(f"Не удалось построить прогноз для пользователя {user_id}: {e}")
+            return None
+
+
+# Глобальный экземпляр
+cycle_predictor = CyclePredictor()
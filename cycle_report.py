@@ -0,0 +1,318 @@
+"""
+PDF-отчет по нескольким циклам для врача
+
+Первая страница - сводка циклов, далее по странице на цикл: график
+температуры и таблица дней. Страницы растрируются и пишутся по одной в
+буфер в памяти (StreamingPdfPages), фигура каждой страницы закрывается
+сразу после записи, поэтому память не растет с числом циклов. График
+цикла рисуется при сборке его страницы (в разрешении страницы). Графики
+закрытых циклов (они больше не меняются) кэшируются по отпечатку записей
+цикла: повторный отчет передает их в сборку готовым PNG и не рисует
+заново, а новые графики закрытых циклов сборка возвращает для кэша.
+"""
+
+import gc
+import io
+import logging
+from datetime import date, timedelta
+from typing import Optional, List, Dict, Any, Tuple
+
+import numpy as np
+
+from fertility_chart_generator import FertilityChartGenerator, FertilityAnalyzer, load_pyplot
+
+REPORT_RECORDS_LIMIT = 400   # как у истории прогноза: около 13 циклов
+REPORT_MAX_CYCLES = 12       # последних циклов в отчете (включая текущий)
+REPORT_PAGE_SIZE = (8.27, 11.69)  # A4, дюймы
+REPORT_DPI = 200             # разрешение растра страницы
+REPORT_JPEG_QUALITY = 90
+CHART_BOX_TOP = 0.95         # график цикла: верхний край и высота (доли страницы)
+CHART_BOX_HEIGHT = 0.39
+ROWS_PER_TABLE = 35          # дней в колонке таблицы; на странице две колонки
+TABLE_COLUMNS = ["День", "Дата", "t, °C", "Менструация", "Выделения", "Фаза"]
+TABLE_COLUMN_WIDTHS = [0.08, 0.18, 0.11, 0.21, 0.21, 0.21]
+CELL_TEXT_LIMIT = 13
+MIN_CHART_TEMPERATURES = 3   # меньше - страница цикла без графика
+REPORT_CHART_QUALITY = "report"  # графики циклов отчета в кэше графиков (разрешение страницы)
+
+
+def split_cycles(records: List[Dict]) -> List[List[Dict]]:
+    """Разбиение записей на циклы (от старых к новым) по тем же границам, что и в cycle_evaluator"""
+    from cycle_evaluator import NEW_CYCLE_MIN_DAYS, _to_date
+
+    series = FertilityChartGenerator().process_cycle_data(records)
+    if series is None:
+        return []
+
+    starts = FertilityAnalyzer.find_cycle_starts(series.menstrual, NEW_CYCLE_MIN_DAYS)
+    if not len(starts) or starts[0] != 0:
+        # Записи до первой отмеченной менструации - неполный цикл
+        starts = np.concatenate([[0], starts])
+    bounds = [series.start + timedelta(days=int(start)) for start in starts] + [date.max]
+
+    ordered = sorted(records, key=lambda r: _to_date(r['record_date']))
+    cycles: List[List[Dict]] = [[] for _ in starts]
+    cycle = 0
+    for record in ordered:
+        day = _to_date(record['record_date'])
+        while day >= bounds[cycle + 1]:
+            cycle += 1
+        cycles[cycle].append(record)
+    return [cycle_records for cycle_records in cycles if cycle_records]
+
+
+def _cell(value: Any) -> str:
+    if value is None or value == "":
+        return ""
+    text = str(value)
+    return text if len(text) <= CELL_TEXT_LIMIT else text[:CELL_TEXT_LIMIT - 1] + "…"
+
+
+def _day_rows(cycle_records: List[Dict]) -> Tuple[List[List[str]], Dict[str, Any]]:
+    """Строки таблицы дней цикла (все календарные дни, включая пропуски) и сводка цикла"""
+    from cycle_evaluator import _to_date
+
+    series = FertilityChartGenerator().process_cycle_data(cycle_records)
+    by_day = {(_to_date(r['record_date']) - series.start).days: r for r in cycle_records}
+
+    rows = []
+    for day in range(len(series)):
+        record = by_day.get(day, {})
+        temperature = series.temperatures[day]
+        rows.append([
+            str(day + 1),
+            (series.start + timedelta(days=day)).strftime("%d.%m.%Y"),
+            "" if np.isnan(temperature) else f"{temperature:.2f}",
+            _cell(record.get('menstruation_type')),
+            _cell(record.get('mucus_type')),
+            _cell(series.phase_at(day).value) if record else "",
+        ])
+
+    summary = {
+        "start": series.start,
+        "length": len(series),
+        "shift_day": series.ovulation_day + 2 if series.ovulation_day is not None else None,
+        "measurements": int(series.has_temperature.sum()),
+    }
+    return rows, summary
+
+
+class StreamingPdfPages:
+    """
+    Многостраничный PDF в поток, в духе PdfPages: каждая страница (растр,
+    JPEG) записывается сразу при добавлении, в памяти остаются только
+    смещения объектов. PdfPages из matplotlib не подходит: встроенные
+    изображения он держит в памяти до закрытия файла.
+    """
+
+    def __init__(self, stream: io.BytesIO, page_size: Tuple[float, float] = REPORT_PAGE_SIZE,
+                 title: str = "Отчет по циклам"):
+        self.stream = stream
+        self.page_size = page_size
+        self.title = title
+        self._offsets: Dict[int, int] = {}
+        self._page_ids: List[int] = []
+        self._next_id = 4  # 1 - каталог, 2 - список страниц, 3 - сведения о документе
+        stream.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def _reserve_id(self) -> int:
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id: int, body: bytes, data: Optional[bytes] = None):
+        self._offsets[obj_id] = self.stream.tell()
+        self.stream.write(f"{obj_id} 0 obj\n".encode() + body)
+        if data is not None:
+            self.stream.write(b"\nstream\n" + data + b"\nendstream")
+        self.stream.write(b"\nendobj\n")
+
+    def add_page(self, image):
+        """Страница из изображения PIL, растянутого на весь лист"""
+        jpeg = io.BytesIO()
+        image.convert("RGB").save(jpeg, "JPEG", quality=REPORT_JPEG_QUALITY)
+        jpeg = jpeg.getvalue()
+        width, height = (round(size * 72, 2) for size in self.page_size)
+        content = f"q {width} 0 0 {height} 0 0 cm /Page Do Q".encode()
+
+        image_id, content_id, page_id = self._reserve_id(), self._reserve_id(), self._reserve_id()
+        self._write_object(image_id, (
+            f"<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} "
+            f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>"
+        ).encode(), jpeg)
+        self._write_object(content_id, f"<< /Length {len(content)} >>".encode(), content)
+        self._write_object(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+            f"/Resources << /XObject << /Page {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode())
+        self._page_ids.append(page_id)
+
+    def close(self):
+        """Список страниц, каталог и таблица ссылок"""
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>".encode())
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        title = self.title.encode("utf-16-be").hex().upper()
+        self._write_object(3, f"<< /Title <FEFF{title}> /Producer (Fertility Tracker Bot) >>".encode())
+
+        xref_offset = self.stream.tell()
+        self.stream.write(f"xref\n0 {self._next_id}\n0000000000 65535 f \n".encode())
+        for obj_id in range(1, self._next_id):
+            self.stream.write(f"{self._offsets[obj_id]:010d} 00000 n \n".encode())
+        self.stream.write(f"trailer\n<< /Size {self._next_id} /Root 1 0 R /Info 3 0 R >>\n"
+                          f"startxref\n{xref_offset}\n%%EOF\n".encode())
+
+
+def _add_table(fig, rect: List[float], rows: List[List[str]]):
+    ax = fig.add_axes(rect)
+    ax.axis('off')
+    table = ax.table(cellText=rows, colLabels=TABLE_COLUMNS, colWidths=TABLE_COLUMN_WIDTHS,
+                     loc='upper center', cellLoc='center')
+    table.auto_set_font_size(False)
+    table.set_fontsize(6)
+    table.scale(1, 0.9)
+
+
+def _add_day_tables(fig, rows: List[List[str]], top: float):
+    """Две колонки таблицы дней от top до низа страницы"""
+    for column, chunk_start in enumerate(range(0, min(len(rows), 2 * ROWS_PER_TABLE), ROWS_PER_TABLE)):
+        _add_table(fig, [0.03 + column * 0.485, 0.03, 0.455, top - 0.03],
+                   rows[chunk_start:chunk_start + ROWS_PER_TABLE])
+
+
+def _cycle_chart(cycle_records: List[Dict]) -> Optional[bytes]:
+    """PNG графика температуры цикла для его страницы или None, если измерений мало"""
+    if sum(1 for r in cycle_records if r.get('temperature')) < MIN_CHART_TEMPERATURES:
+        return None
+    generator = FertilityChartGenerator()
+    return generator.create_temperature_chart(generator.process_cycle_data(cycle_records), dpi=REPORT_DPI).getvalue()
+
+
+def _page_image(fig, chart_png: Optional[bytes] = None):
+    """Растр страницы (Agg, REPORT_DPI); график цикла вставляется из готового PNG без перерисовки"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from PIL import Image
+
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    page = Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba()).convert("RGB")
+    if chart_png:
+        left, top, width, height = (round(value) for value in (
+            0.03 * page.width, (1 - CHART_BOX_TOP) * page.height, 0.94 * page.width, CHART_BOX_HEIGHT * page.height))
+        with Image.open(io.BytesIO(chart_png)) as chart:
+            chart = chart.convert("RGB")
+            chart.thumbnail((width, height), Image.LANCZOS)
+            page.paste(chart, (left + (width - chart.width) // 2, top))
+    return page
+
+
+def render_report_pdf(cycles: List[Tuple[List[Dict], Optional[bytes]]]) -> Tuple[bytes, Dict[int, bytes]]:
+    """
+    Сборка PDF (выполняется в процессе пула отрисовки).
+    cycles - от старых к новым: (записи цикла, PNG графика из кэша или None).
+    Возвращает PDF и заново нарисованные графики закрытых циклов (номер
+    цикла в cycles -> PNG) для кэша.
+    """
+    plt = load_pyplot()
+
+    pages = []
+    for cycle_records, cached_chart in cycles:
+        rows, summary = _day_rows(cycle_records)
+        pages.append((rows, summary, cycle_records, cached_chart))
+    new_charts: Dict[int, bytes] = {}
+
+    buffer = io.BytesIO()
+    with StreamingPdfPages(buffer) as pdf:
+        # Сводка циклов
+        fig = plt.figure(figsize=REPORT_PAGE_SIZE, dpi=REPORT_DPI)
+        fig.text(0.5, 0.95, "Отчет по циклам", ha='center', fontsize=16, fontweight='bold')
+        fig.text(0.5, 0.92, f"Сформирован {date.today().strftime('%d.%m.%Y')}", ha='center', fontsize=9)
+        ax = fig.add_axes([0.1, 0.1, 0.8, 0.78])
+        ax.axis('off')
+        summary_rows = [
+            [str(number), summary["start"].strftime("%d.%m.%Y"),
+             str(summary["length"]) + (" (текущий)" if number == len(pages) else ""),
+             str(summary["shift_day"]) if summary["shift_day"] else "—", str(summary["measurements"])]
+            for number, (_, summary, _, _) in enumerate(pages, 1)
+        ]
+        table = ax.table(cellText=summary_rows, loc='upper center', cellLoc='center',
+                         colLabels=["№", "Начало", "Дней", "День сдвига", "Измерений"])
+        table.auto_set_font_size(False)
+        table.set_fontsize(9)
+        pdf.add_page(_page_image(fig))
+        plt.close(fig)
+
+        # По странице на цикл: в памяти только текущая страница и ее график
+        for number, (rows, summary, cycle_records, chart_png) in enumerate(pages, 1):
+            if chart_png is None:
+                chart_png = _cycle_chart(cycle_records)
+                if chart_png is not None and number < len(pages):
+                    new_charts[number - 1] = chart_png
+            fig = plt.figure(figsize=REPORT_PAGE_SIZE, dpi=REPORT_DPI)
+            fig.text(0.5, 0.965, f"Цикл {number}: с {summary['start'].strftime('%d.%m.%Y')}, "
+                                 f"{summary['length']} дн.", ha='center', fontsize=12, fontweight='bold')
+            _add_day_tables(fig, rows, CHART_BOX_TOP - CHART_BOX_HEIGHT - 0.01 if chart_png else 0.94)
+            pdf.add_page(_page_image(fig, chart_png))
+            plt.close(fig)
+            chart_png = None
+            # Фигуры matplotlib связаны циклическими ссылками: без сборки мусора
+            # память страниц освобождается пачками, и пик растет с числом циклов
+            gc.collect()
+
+            # Продолжение таблицы для длинных циклов
+            for continuation in range(2 * ROWS_PER_TABLE, len(rows), 2 * ROWS_PER_TABLE):
+                fig = plt.figure(figsize=REPORT_PAGE_SIZE, dpi=REPORT_DPI)
+                fig.text(0.5, 0.965, f"Цикл {number} (продолжение)", ha='center', fontsize=12)
+                _add_day_tables(fig, rows[continuation:], 0.94)
+                pdf.add_page(_page_image(fig))
+                plt.close(fig)
+                gc.collect()
+
+    return buffer.getvalue(), new_charts
+
+
+async def build_cycle_report(user_id: int) -> Optional[bytes]:
+    """
+    PDF-отчет по последним циклам пользователя или None, если записей нет.
+    RenderBusyError, если очередь отрисовки переполнена.
+    """
+    from db_handler import db
+    from chart_cache import get_cached_chart, records_fingerprint, store_chart
+    from render_scheduler import render_scheduler, RenderBusyError, INTERACTIVE
+    from render_pool import run_in_pool
+
+    records = await db.get_user_records(user_id, limit=REPORT_RECORDS_LIMIT)
+    cycles = split_cycles(records)[-REPORT_MAX_CYCLES:]
+    if not cycles:
+        return None
+
+    # Графики закрытых циклов - из кэша по отпечатку записей цикла (текущий цикл меняется каждый день)
+    slots = [f"report_cycle:{min(str(r['record_date']) for r in cycle_records)}" for cycle_records in cycles]
+    fingerprints = [records_fingerprint(cycle_records) for cycle_records in cycles]
+    report_cycles = [
+        (cycle_records, get_cached_chart(user_id, slot, fingerprint, REPORT_CHART_QUALITY)
+         if number < len(cycles) - 1 else None)
+        for number, (cycle_records, slot, fingerprint) in enumerate(zip(cycles, slots, fingerprints))
+    ]
+
+    # Отчет запрошен пользователем: приоритет как у графика по кнопке, чтобы его
+    # не вытесняли упреждающие отрисовки
+    async def render() -> bytes:
+        report, new_charts = await run_in_pool(render_report_pdf, report_cycles)
+        for number, chart_png in new_charts.items():
+            store_chart(user_id, slots[number], fingerprints[number], chart_png, REPORT_CHART_QUALITY)
+        return report
+
+    try:
+        return await render_scheduler.submit(("report", user_id, records_fingerprint(records)), render, INTERACTIVE)
+    except RenderBusyError:
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка создания PDF-отчета для пользователя {user_id}: {e}")
+        return None
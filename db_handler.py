@@ -86,6 +86,53 @@ class DatabaseHandler:
                 CREATE INDEX IF NOT EXISTS idx_records_date ON records (record_date)
             ''')
             
+            # Создание таблицы cycle_states (инкрементальное состояние цикла)
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS cycle_states (
+                    user_id BIGINT PRIMARY KEY,
+                    state JSONB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES tg_users (user_id) ON DELETE CASCADE
+                )
+            ''')
+            
+            # Создание таблицы cycle_models (параметры модели циклов для прогноза)
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS cycle_models (
+                    user_id BIGINT PRIMARY KEY,
+                    model JSONB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES tg_users (user_id) ON DELETE CASCADE
+                )
+            ''')
+            
+            # Создание таблицы phase_status (результаты пакетного анализа фаз)
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS phase_status (
+                    user_id BIGINT PRIMARY KEY,
+                    current_phase VARCHAR(50),
+                    ovulation_day INTEGER,
+                    cycle_length INTEGER,
+                    fertile_days INTEGER,
+                    next_ovulation DATE,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES tg_users (user_id) ON DELETE CASCADE
+                )
+            ''')
+            
+            # Создание таблицы import_fingerprints (итоги импорта файлов по отпечатку содержимого)
+            await connection.execute('''
+                CREATE TABLE IF NOT EXISTS import_fingerprints (
+                    user_id BIGINT NOT NULL,
+                    fingerprint VARCHAR(64) NOT NULL,
+                    records_state VARCHAR(64) NOT NULL,
+                    result JSONB NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, fingerprint),
+                    FOREIGN KEY (user_id) REFERENCES tg_users (user_id) ON DELETE CASCADE
+                )
+            ''')
+            
             logging.info("Таблицы базы данных успешно созданы/проверены")
     
     async def create_user(self, user_id: int, username: Optional[str] = None, 
@@ -242,6 +289,315 @@ class DatabaseHandler:
             logging.error(f"Не удалось удалить запись для пользователя {user_id} на {record_date}: {e}")
             return False
     
+    async def get_cycle_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получение сохраненного состояния цикла пользователя"""
+        try:
+            async with self.pool.acquire() as connection:
+                row = await connection.fetchrow('''
+                    SELECT state FROM cycle_states WHERE user_id = $1
+                ''', user_id)
+                if not row:
+                    return None
+                import json
+                state = row['state']
+                return json.loads(state) if isinstance(state, str) else state
+        except Exception as e:
+            logging.error(f"Не удалось получить состояние цикла для пользователя {user_id}: {e}")
+            return None
+    
+    async def save_cycle_state(self, user_id: int, state: Dict[str, Any]) -> bool:
+        """Сохранение состояния цикла пользователя"""
+        try:
+            async with self.pool.acquire() as connection:
+                import json
+                await connection.execute('''
+                    INSERT INTO cycle_states (user_id, state)
+                    VALUES ($1, $2)
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET
+                        state = EXCLUDED.state,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', user_id, json.dumps(state))
+                return True
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояние цикла для пользователя {user_id}: {e}")
+            return False
+    
+    async def delete_cycle_state(self, user_id: int) -> bool:
+        """Удаление состояния цикла пользователя"""
+        try:
+            async with self.pool.acquire() as connection:
+                await connection.execute('''
+                    DELETE FROM cycle_states WHERE user_id = $1
+                ''', user_id)
+                return True
+        except Exception as e:
+            logging.error(f"Не удалось удалить состояние цикла для пользователя {user_id}: {e}")
+            return False
+    
+    async def get_cycle_model(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получение сохраненной модели циклов пользователя"""
+        try:
+            async with self.pool.acquire() as connection:
+                row = await connection.fetchrow('''
+                    SELECT model FROM cycle_models WHERE user_id = $1
+                ''', user_id)
+                if not row:
+                    return None
+                import json
+                model = row['model']
+                return json.loads(model) if isinstance(model, str) else model
+        except Exception as e:
+            logging.error(f"Не удалось получить модель циклов для пользователя {user_id}: {e}")
+            return None
+    
+    async def save_cycle_model(self, user_id: int, model: Dict[str, Any]) -> bool:
+        """Сохранение модели циклов пользователя"""
+        try:
+            async with self.pool.acquire() as connection:
+                import json
+                await connection.execute('''
+                    INSERT INTO cycle_models (user_id, model)
+                    VALUES ($1, $2)
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET
+                        model = EXCLUDED.model,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', user_id, json.dumps(model))
+                return True
+        except Exception as e:
+            logging.error(f"Не удалось сохранить модель циклов для пользователя {user_id}: {e}")
+            return False
+    
+    async def delete_cycle_model(self, user_id: int) -> bool:
+        """Удаление модели циклов пользователя"""
+        try:
+            async with self.pool.acquire() as connection:
+                await connection.execute('''
+                    DELETE FROM cycle_models WHERE user_id = $1
+                ''', user_id)
+                return True
+        except Exception as e:
+            logging.error(f"Не удалось удалить модель циклов для пользователя {user_id}: {e}")
+            return False
+    
+    async def iter_recent_records(self, records_per_user: int, active_since: Optional[date] = None,
+                                  batch_size: int = 5000):
+        """
+        Потоковое чтение последних записей всех пользователей одним запросом
+        (по records_per_user на пользователя), в порядке user_id и даты.
+        Отдает строки пачками по batch_size.
+        """
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                cursor = connection.cursor('''
+                    SELECT user_id, record_date, temperature, menstruation_type
+                    FROM (
+                        SELECT user_id, record_date, temperature, menstruation_type,
+                               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY record_date DESC) AS rn
+                        FROM records
+                        WHERE $2::date IS NULL OR user_id IN (
+                            SELECT DISTINCT user_id FROM records WHERE record_date >= $2::date
+                        )
+                    ) recent
+                    WHERE rn <= $1
+                    ORDER BY user_id, record_date
+                ''', records_per_user, active_since, prefetch=batch_size)
+                
+                batch = []
+                async for row in cursor:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+    
+    async def iter_user_records(self, user_id: int, batch_size: int = 1000):
+        """
+        Потоковое чтение всей истории записей пользователя (от старых к новым)
+        через курсор. Отдает пачки строк по batch_size.
+        """
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                cursor = connection.cursor('''
+                    SELECT record_date, temperature, mucus_type, menstruation_type,
+                           cervical_position, note, abdominal_pain, breast_tenderness,
+                           intercourse, disruptions, created_at, updated_at
+                    FROM records
+                    WHERE user_id = $1
+                    ORDER BY record_date
+                ''', user_id, prefetch=batch_size)
+
+                batch = []
+                async for row in cursor:
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+    async def save_phase_statuses(self, rows: List[tuple]) -> bool:
+        """
+        Массовое сохранение результатов анализа фаз одним запросом.
+        rows: (user_id, current_phase, ovulation_day, cycle_length, fertile_days, next_ovulation)
+        """
+        if not rows:
+            return True
+        try:
+            columns = list(zip(*rows))
+            async with self.pool.acquire() as connection:
+                await connection.execute('''
+                    INSERT INTO phase_status (
+                        user_id, current_phase, ovulation_day, cycle_length, fertile_days, next_ovulation
+                    )
+                    SELECT * FROM unnest($1::bigint[], $2::varchar[], $3::int[], $4::int[], $5::int[], $6::date[])
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET
+                        current_phase = EXCLUDED.current_phase,
+                        ovulation_day = EXCLUDED.ovulation_day,
+                        cycle_length = EXCLUDED.cycle_length,
+                        fertile_days = EXCLUDED.fertile_days,
+                        next_ovulation = EXCLUDED.next_ovulation,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', *[list(column) for column in columns])
+                return True
+        except Exception as e:
+            logging.error(f"Не удалось сохранить результаты анализа фаз ({len(rows)} пользователей): {e}")
+            return False
+    
+    async def bulk_upsert_records(self, user_id: int, rows: List[tuple],
+                                  outcomes: Optional[Dict[Any, str]] = None) -> Optional[Dict[str, int]]:
+        """
+        Массовое создание или обновление записей пользователя одним запросом
+        (импорт). rows: (record_date, temperature, note). Новые дни создаются
+        так же, как в create_record без остальных аргументов; у существующих
+        обновляется температура (пустое значение из импорта не стирает
+        сохраненную), а заметка из импорта только заполняет пустую - заметка,
+        уже сохраненная или исправленная в боте, не перезаписывается.
+        Остальные поля записи не трогаются.
+
+        Итоги считаются по дням: "inserted", "updated", "unchanged" - дни,
+        сверенные с базой; "skipped" - повторные строки за день, уже учтенный
+        в этом импорте (в той же пачке или, если передан outcomes, в прежних):
+        они записываются (побеждает последняя), но отдельным днем не
+        считаются. outcomes - итог каждой даты импорта, общий для всех его
+        пачек, пополняется; день, учтенный без изменений и измененный
+        повторной строкой, переходит в "updated".
+        Возвращает приращения {"inserted", "updated", "unchanged", "skipped"}
+        или None при ошибке.
+        """
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+        if not rows:
+            return counts
+        outcomes = {} if outcomes is None else outcomes
+        try:
+            # Одна дата дважды в одном INSERT ... ON CONFLICT недопустима: побеждает последняя строка,
+            # как при последовательных вызовах create_record
+            unique_rows = list({row[0]: row for row in rows}.values())
+            counts["skipped"] = len(rows) - len(unique_rows)
+            record_dates, temperatures, notes = (list(column) for column in zip(*unique_rows))
+            async with self.pool.acquire() as connection:
+                # Строки без изменений отсекает WHERE и не возвращает RETURNING;
+                # xmax = 0 только у вставленных строк
+                written = await connection.fetch('''
+                    INSERT INTO records (
+                        user_id, record_date, temperature, mucus_type,
+                        menstruation_type, cervical_position, note,
+                        abdominal_pain, breast_tenderness, intercourse, disruptions
+                    )
+                    SELECT $1, record_date, temperature, NULL, NULL, NULL, note, NULL, NULL, NULL, '[]'::jsonb
+                    FROM unnest($2::date[], $3::numeric[], $4::text[]) AS imported(record_date, temperature, note)
+                    ON CONFLICT (user_id, record_date)
+                    DO UPDATE SET
+                        temperature = COALESCE(EXCLUDED.temperature, records.temperature),
+                        note = COALESCE(records.note, EXCLUDED.note),
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE (records.temperature, records.note) IS DISTINCT FROM
+                          (COALESCE(EXCLUDED.temperature, records.temperature), COALESCE(records.note, EXCLUDED.note))
+                    RETURNING record_date, (xmax = 0) AS inserted
+                ''', user_id, record_dates, temperatures, notes)
+            changed = {row['record_date']: "inserted" if row['inserted'] else "updated" for row in written}
+            for record_date in record_dates:
+                outcome = changed.get(record_date, "unchanged")
+                previous = outcomes.get(record_date)
+                if previous is None:
+                    outcomes[record_date] = outcome
+                    counts[outcome] += 1
+                    continue
+                counts["skipped"] += 1
+                if previous == "unchanged" and outcome != "unchanged":
+                    outcomes[record_date] = "updated"
+                    counts["unchanged"] -= 1
+                    counts["updated"] += 1
+            return counts
+        except Exception as e:
+            logging.error(f"Не удалось сохранить записи импорта для пользователя {user_id} ({len(rows)} строк): {e}")
+            return None
+
+    async def get_records_state(self, user_id: int) -> Optional[str]:
+        """
+        Версия записей пользователя (число записей и время последнего
+        изменения): меняется при любом создании, изменении или удалении
+        """
+        try:
+            async with self.pool.acquire() as connection:
+                row = await connection.fetchrow(
+                    'SELECT COUNT(*) AS count, MAX(updated_at) AS updated_at FROM records WHERE user_id = $1',
+                    user_id
+                )
+                return f"{row['count']}:{row['updated_at'].isoformat() if row['updated_at'] else ''}"
+        except Exception as e:
+            logging.error(f"Не удалось получить версию записей пользователя {user_id}: {e}")
+            return None
+
+    async def get_import_fingerprint(self, user_id: int, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Сохраненный итог импорта файла с этим отпечатком: {"records_state", "result"}"""
+        try:
+            async with self.pool.acquire() as connection:
+                row = await connection.fetchrow(
+                    'SELECT records_state, result FROM import_fingerprints WHERE user_id = $1 AND fingerprint = $2',
+                    user_id, fingerprint
+                )
+                if row is None:
+                    return None
+                import json
+                result = row['result']
+                return {"records_state": row['records_state'],
+                        "result": json.loads(result) if isinstance(result, str) else result}
+        except Exception as e:
+            logging.error(f"Не удалось получить отпечаток импорта пользователя {user_id}: {e}")
+            return None
+
+    async def save_import_fingerprint(self, user_id: int, fingerprint: str, records_state: str,
+                                      result: Dict[str, Any], keep: int = 20) -> bool:
+        """Сохранение итога импорта файла; у пользователя хранятся последние keep отпечатков"""
+        try:
+            import json
+            async with self.pool.acquire() as connection:
+                async with connection.transaction():
+                    await connection.execute('''
+                        INSERT INTO import_fingerprints (user_id, fingerprint, records_state, result)
+                        VALUES ($1, $2, $3, $4)
+                        ON CONFLICT (user_id, fingerprint)
+                        DO UPDATE SET
+                            records_state = EXCLUDED.records_state,
+                            result = EXCLUDED.result,
+                            created_at = CURRENT_TIMESTAMP
+                    ''', user_id, fingerprint, records_state, json.dumps(result, default=str))
+                    await connection.execute('''
+                        DELETE FROM import_fingerprints
+                        WHERE user_id = $1 AND fingerprint NOT IN (
+                            SELECT fingerprint FROM import_fingerprints
+                            WHERE user_id = $1 ORDER BY created_at DESC LIMIT $2
+                        )
+                    ''', user_id, keep)
+                return True
+        except Exception as e:
+            logging.error(f"Не удалось сохранить отпечаток импорта пользователя {user_id}: {e}")
+            return False
+
     async def close(self):
         """Закрытие пула подключений к базе данных"""
         if self.pool:
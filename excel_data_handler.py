@@ -1,11 +1,76 @@
 import pandas as pd
+import numpy as np
 import asyncio
 import logging
-from datetime import datetime, date
-from typing import Optional, List, Dict, Any, Union
+import io
+import re
+from datetime import datetime, date, timedelta
+from typing import Optional, List, Dict, Any, Union, Iterable, Iterator, BinaryIO
 from db_handler import db
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields, replace
+from operator import itemgetter
+
+# Сколько записей импорта отправляется в базу одним запросом
+IMPORT_CHUNK_SIZE = 500
+# В скольких первых строках листа ищется строка заголовков
+HEADER_SEARCH_ROWS = 50
+# Длина превью импорта в символах
+PREVIEW_LENGTH = 500
+# Значения ошибок формул Excel (#REF!, #N/A, ...) считаются пустыми ячейками, как в pandas
+EXCEL_ERROR_VALUES = frozenset(('#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A'))
+# В скольких первых строках листа ищутся месяц и год карты («Месяц:», «Год: ... Дата: ...»)
+CONTEXT_SEARCH_ROWS = 100
+# Полные даты текстом в колонке «Дата»
+ISO_DATE_PATTERN = r'\d{4}-\d{1,2}-\d{1,2}'
+DOTTED_DATE_PATTERN = r'\d{1,2}\.\d{1,2}\.\d{4}$'
+# Начала названий месяцев в поле «Месяц:»
+MONTH_PREFIXES = (
+    ('янв', 1), ('фев', 2), ('мар', 3), ('апр', 4), ('май', 5), ('мая', 5),
+    ('июн', 6), ('июл', 7), ('авг', 8), ('сен', 9), ('окт', 10), ('ноя', 11), ('дек', 12),
+)
+# Шаблон для заполнения: колонки (заголовок, ширина), число дней, диапазон температур, месяцы
+TEMPLATE_COLUMNS = (
+    ('День цикла', 11), ('Дата', 8), ('БТТ', 8), ('Нарушения', 14), ('Примечание', 30),
+    ('Новый термометр', 17), ('НТ', 6), ('температура.1', 14), ('Время', 9),
+    ('позже/раньше', 14), ('плодный период', 16),
+)
+TEMPLATE_DAYS = 40
+TEMPLATE_TEMPERATURE_RANGE = (35.0, 40.0)
+TEMPLATE_MONTHS = ('январь', 'февраль', 'март', 'апрель', 'май', 'июнь',
+                   'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь')
+_template_bytes: Optional[bytes] = None
+# Итоги записи импорта в базу (db.bulk_upsert_records): дни, сверенные с базой, и повторы дат
+WRITE_COUNTS = ('inserted', 'updated', 'unchanged')
+SKIPPED_COUNT = 'skipped'
+# Колонки листа -> поля FertilityRecord
+SOURCE_COLUMNS = {
+    'День цикла': 'cycle_day',
+    'Дата': 'date',
+    'БТТ': 'temperature',
+    'температура.1': 'temperature_alt',
+    'Нарушения': 'disruptions',
+    'Примечание': 'note',
+    'Новый термометр': 'new_thermometer',
+    'НТ': 'disruption_code',
+    'Время': 'measurement_time',
+    'позже/раньше': 'timing_note',
+    'плодный период': 'fertile_period',
+}
+# Заметка в том виде, как она хранится в базе (колонка экспорта истории): при импорте
+# записывается как есть, без сборки из частей, чтобы экспорт импортировался обратно без изменений
+STORED_NOTE_COLUMN = 'Заметка'
+IMPORT_COLUMNS = tuple(SOURCE_COLUMNS) + (STORED_NOTE_COLUMN,)
+# Части заметки для базы данных в порядке следования: (поле, подпись)
+NOTE_LABELS = (
+    ('note', 'Примечание'),
+    ('new_thermometer', 'Термометр'),
+    ('disruption_code', 'Код'),
+    ('measurement_time', 'Время'),
+    ('timing_note', 'Время заметка'),
+    ('fertile_period', 'Плодный период'),
+    ('cycle_day', 'День цикла'),
+)
 
 @dataclass
 class FertilityRecord:
@@ -22,19 +87,390 @@ class FertilityRecord:
     timing_note: Optional[str] = None  # позже/раньше
     fertile_period: Optional[str] = None  # плодный период
 
+    def combined_note(self) -> Optional[str]:
+        """Заметка для базы данных, собранная из полей таблицы"""
+        note_parts = [f"{label}: {getattr(self, name)}" for name, label in NOTE_LABELS if getattr(self, name)]
+        return "; ".join(note_parts) if note_parts else None
+
+def export_header(user_id: int) -> str:
+    """Заголовок текстового экспорта для Telegram"""
+    return f"📊 Экспорт данных фертильности (пользователь {user_id})\n\n"
+
+def format_record_for_bot(record: FertilityRecord) -> str:
+    """Блок текстового экспорта для одной записи"""
+    result = ""
+    if record.date:
+        result += f"📅 {record.date.strftime('%d.%m.%y')}\n"
+    
+    if record.temperature:
+        result += f"🌡 БТТ: {record.temperature}°C\n"
+    elif record.temperature_alt:
+        result += f"🌡 Температура: {record.temperature_alt}°C\n"
+    
+    if record.disruptions:
+        result += f"⚠️ Нарушения: {record.disruptions}\n"
+    
+    if record.measurement_time:
+        result += f"⏰ Время: {record.measurement_time}\n"
+    
+    if record.note or record.new_thermometer:
+        note = record.note or record.new_thermometer
+        result += f"📝 Заметка: {note}\n"
+    
+    return result + "\n"
+
+RECORD_FIELDS = [record_field.name for record_field in fields(FertilityRecord)]
+
+def _month_in_text(text: Any) -> Optional[int]:
+    """Номер месяца по первому слову-названию месяца в тексте"""
+    if not isinstance(text, str):
+        return None
+    for word in re.findall(r'[а-яё]+', text.lower()):
+        for prefix, month in MONTH_PREFIXES:
+            if word.startswith(prefix):
+                return month
+    return None
+
+@dataclass
+class SheetDates:
+    """
+    Восстановление дат карты: в колонке «Дата» записан номер дня месяца,
+    месяц и год начала карты берутся из полей листа. Номер дня меньше
+    предыдущего означает переход на следующий месяц; состояние перехода
+    переносится между пачками строк одного листа.
+    """
+    year: Optional[int] = None
+    month: Optional[int] = None
+    first_day: Optional[int] = None  # первый номер дня в колонке «Дата» (для сверки с «Дата: дд.мм»)
+    wraps: int = 0
+    last_day: Optional[float] = None
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]) -> 'SheetDates':
+        """Месяц и год из первых строк листа («Месяц: январь», «Год: 2024  Дата: 26.01»)"""
+        dates = cls()
+        label_month = explicit = None
+        day_column = None
+        for row in rows:
+            for index, value in enumerate(row):
+                if not isinstance(value, str):
+                    continue
+                text = value.strip()
+                if day_column is None and text == 'Дата' and 'БТТ' in row:
+                    day_column = index
+                elif text.startswith('Месяц'):
+                    label_month = _month_in_text(text[len('Месяц'):])
+                    if index + 1 < len(row):
+                        dates.month = _month_in_text(row[index + 1])
+                elif text.startswith('Год'):
+                    year = re.search(r'Год:?\s*(\d{4})', text)
+                    if year:
+                        dates.year = int(year.group(1))
+                    elif index + 1 < len(row) and isinstance(row[index + 1], (int, float)) and 1900 < row[index + 1] < 2200:
+                        dates.year = int(row[index + 1])
+                    day_month = re.search(r'Дата:?\s*(\d{1,2})\.(\d{1,2})', text)
+                    if day_month:
+                        explicit = (int(day_month.group(1)), int(day_month.group(2)))
+            if day_column is not None and dates.first_day is None and row is not None and len(row) > day_column:
+                day = row[day_column]
+                if isinstance(day, (int, float)) and not isinstance(day, bool) and day > 0:
+                    dates.first_day = int(day)
+
+        # «Дата: дд.мм» надежнее всего, если совпадает с первым днем карты; затем значение
+        # рядом с «Месяц:», затем месяц в самой подписи
+        if explicit and explicit[0] == dates.first_day and 1 <= explicit[1] <= 12:
+            dates.month = explicit[1]
+        elif dates.month is None:
+            dates.month = label_month or (explicit[1] if explicit and 1 <= explicit[1] <= 12 else None)
+        return dates
+
+    def follow(self, previous: Optional['SheetDates']):
+        """Год карты без года - по предыдущей карте (карты идут подряд), иначе не позже текущего месяца"""
+        if self.year is not None or self.month is None:
+            return
+        if previous is not None and previous.year is not None and previous.month is not None:
+            self.year = previous.year + (1 if self.month < previous.month else 0)
+        else:
+            today = date.today()
+            self.year = today.year if self.month <= today.month else today.year - 1
+
+    def anchor_to_today(self, total_wraps: int):
+        """Карта без месяца: считаем, что она заканчивается в текущем месяце"""
+        today = date.today()
+        self.year, month = divmod(today.year * 12 + today.month - 1 - total_wraps, 12)
+        self.month = month + 1
+
+    @staticmethod
+    def count_wraps(days: Iterable[Any]) -> int:
+        """Число переходов через конец месяца в последовательности номеров дней"""
+        wraps = 0
+        previous = None
+        for day in days:
+            if isinstance(day, (int, float)) and not isinstance(day, bool) and day == day:
+                if previous is not None and day < previous:
+                    wraps += 1
+                previous = day
+        return wraps
+
+    def resolve(self, values: pd.Series) -> pd.Series:
+        """Даты для пачки значений колонки «Дата» (даты Excel берутся как есть)"""
+        if self.year is None or self.month is None:
+            today = date.today()
+            self.year, self.month = self.year or today.year, self.month or today.month
+
+        is_date = values.map(lambda value: isinstance(value, (datetime, date)))
+        result = pd.Series(None, index=values.index, dtype=object)
+        if is_date.any():
+            result[is_date] = values[is_date].map(lambda value: value.date() if isinstance(value, datetime) else value)
+
+        # Полные даты текстом (CSV, выгрузки других приложений): ГГГГ-ММ-ДД или ДД.ММ.ГГГГ
+        is_text = values.map(lambda value: isinstance(value, str))
+        if is_text.any():
+            text = values[is_text].astype(object).str.strip()
+            iso, dotted = text.str.match(ISO_DATE_PATTERN), text.str.match(DOTTED_DATE_PATTERN)
+            parsed = pd.concat([
+                pd.to_datetime(text[iso], format='ISO8601', errors='coerce'),
+                pd.to_datetime(text[dotted], format='%d.%m.%Y', errors='coerce'),
+            ]).dropna()
+            if not parsed.empty:
+                result[parsed.index] = parsed.dt.date
+                is_date = is_date | values.index.isin(parsed.index)
+
+        day = np.trunc(_to_number(values.where(~is_date), 'Дата')).dropna()
+        if day.empty:
+            return result
+        previous = day.shift(1)
+        previous.iloc[0] = self.last_day if self.last_day is not None else np.nan
+        wraps = (day < previous).cumsum() + self.wraps
+        self.wraps, self.last_day = int(wraps.iloc[-1]), float(day.iloc[-1])
+
+        months = self.year * 12 + self.month - 1 + wraps
+        dates = pd.to_datetime(pd.DataFrame({'year': months // 12, 'month': months % 12 + 1, 'day': day}),
+                               errors='coerce')
+        invalid = dates.isna()
+        if invalid.any():
+            logging.warning(f"Не удалось обработать даты ({int(invalid.sum())}): {values[day.index[invalid]].iloc[0]}")
+        result[day.index] = dates.dt.date.where(dates.notna())
+        return result
+
+def _to_number(values: pd.Series, name: str) -> pd.Series:
+    """Числа из колонки; нечисловые значения становятся NaN с одним предупреждением на пачку"""
+    numbers = pd.to_numeric(values, errors='coerce').astype(float)
+    invalid = values.notna() & numbers.isna()
+    if invalid.any():
+        logging.warning(f"Не удалось обработать значения '{name}' ({int(invalid.sum())}): {values[invalid].iloc[0]}")
+    return numbers
+
+def _to_text(values: pd.Series) -> pd.Series:
+    """Текст из колонки; пустые ячейки и пустые строки становятся NaN"""
+    text = values.astype(str)
+    return text.where(values.notna() & (text != ''))
+
+def records_frame(raw: pd.DataFrame, dates: Optional[SheetDates] = None) -> pd.DataFrame:
+    """
+    Векторное извлечение записей из таблицы с заголовками листа Excel:
+    колонки с именами полей FertilityRecord, только строки с температурой.
+    Типы приводятся по колонкам целиком, без обхода строк. dates - месяц и
+    год карты (для следующих пачек того же листа передается тот же объект).
+    """
+    raw = raw[[name for name in IMPORT_COLUMNS if name in raw.columns]]
+    raw = raw.where(~raw.isin(EXCEL_ERROR_VALUES))
+
+    def column(name: str) -> pd.Series:
+        return raw[name] if name in raw.columns else pd.Series(np.nan, index=raw.index, dtype=object)
+
+    temperature = _to_number(column('БТТ'), 'БТТ')
+    temperature_alt = _to_number(column('температура.1'), 'температура.1')
+    has_temperature = temperature.notna() | temperature_alt.notna()
+    # Переходы через конец месяца считаются по всем строкам, включая дни без температуры
+    record_dates = (dates or SheetDates()).resolve(column('Дата'))[has_temperature]
+    raw = raw[has_temperature]
+
+    frame = pd.DataFrame(index=raw.index, columns=RECORD_FIELDS, dtype=object)
+    frame['temperature'] = temperature[has_temperature]
+    frame['temperature_alt'] = temperature_alt[has_temperature]
+    frame['cycle_day'] = np.trunc(_to_number(column('День цикла'), 'День цикла')).astype('Int64')
+
+    frame['date'] = record_dates
+
+    for name, record_field in SOURCE_COLUMNS.items():
+        if record_field in ('cycle_day', 'date', 'temperature', 'temperature_alt'):
+            continue
+        frame[record_field] = _to_text(column(name))
+    if STORED_NOTE_COLUMN in raw.columns:
+        frame['stored_note'] = _to_text(raw[STORED_NOTE_COLUMN])
+        frame['note'] = frame['note'].fillna(frame['stored_note'])
+    return frame
+
+def effective_temperature(frame: pd.DataFrame) -> pd.Series:
+    """Температура для базы: БТТ, а если ее нет - альтернативная"""
+    return frame['temperature'].where(frame['temperature'].fillna(0) != 0, frame['temperature_alt'])
+
+def combined_notes(frame: pd.DataFrame) -> pd.Series:
+    """Заметки для базы данных по всем строкам сразу, как FertilityRecord.combined_note"""
+    notes = pd.Series(np.nan, index=frame.index, dtype=object)
+    for name, label in NOTE_LABELS:
+        values = frame[name]
+        if name == 'cycle_day':
+            values = values.where(values != 0)
+        part = (label + ": " + values.astype(str)).astype(object).where(values.notna())
+        notes = (notes + "; " + part).fillna(notes).fillna(part)
+    return notes
+
+def frame_db_rows(frame: pd.DataFrame) -> List[tuple]:
+    """
+    Граница с базой данных: только здесь пачка превращается в строки
+    (record_date, temperature, note) для db.bulk_upsert_records
+    """
+    dated = frame[frame['date'].notna()]
+    temperatures = effective_temperature(dated).astype(object)
+    notes = (dated['stored_note'] if 'stored_note' in dated.columns else combined_notes(dated)).astype(object)
+    return list(zip(
+        dated['date'],
+        temperatures.where(temperatures.notna(), None),
+        notes.where(notes.notna(), None),
+    ))
+
+def iter_frame_records(frame: pd.DataFrame) -> Iterator[FertilityRecord]:
+    """Записи FertilityRecord из пачки по одной (для превью и прежнего API)"""
+    for row in frame[RECORD_FIELDS].itertuples(index=False, name=None):
+        values = {name: (None if pd.isna(value) else value) for name, value in zip(RECORD_FIELDS, row)}
+        if values['cycle_day'] is not None:
+            values['cycle_day'] = int(values['cycle_day'])
+        yield FertilityRecord(**values)
+
+@dataclass
+class ImportSummary:
+    """
+    Статистика и превью импорта, накапливаемые за один проход по листу:
+    пачки записей проходят через observe() по пути в базу и больше не
+    перечитываются; статистика считается по колонкам пачки. Итоги листов,
+    разобранных по отдельности, объединяются через merge().
+    """
+    user_id: int
+    total_records: int = 0
+    dated_records: int = 0
+    temperature_records: int = 0
+    records_with_disruptions: int = 0
+    records_with_notes: int = 0
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    temperature_min: Optional[float] = None
+    temperature_max: Optional[float] = None
+    temperature_sum: float = 0.0
+    temperature_count: int = 0
+    preview_parts: List[str] = field(default_factory=list)
+    preview_length: int = 0
+
+    def add(self, frame: pd.DataFrame):
+        """Учет пачки записей (результат records_frame) в статистике и превью"""
+        if frame.empty:
+            return
+        self.total_records += len(frame)
+        temperatures = effective_temperature(frame)
+        temperatures = temperatures[temperatures.notna() & (temperatures != 0)]
+        if len(temperatures):
+            self.temperature_records += len(temperatures)
+            self.temperature_count += len(temperatures)
+            self.temperature_sum += float(temperatures.sum())
+            low, high = float(temperatures.min()), float(temperatures.max())
+            self.temperature_min = low if self.temperature_min is None else min(self.temperature_min, low)
+            self.temperature_max = high if self.temperature_max is None else max(self.temperature_max, high)
+        self.records_with_disruptions += int(frame['disruptions'].notna().sum())
+        self.records_with_notes += int(frame['note'].notna().sum())
+        dates = frame['date'].dropna()
+        self.dated_records += len(dates)
+        if len(dates):
+            low, high = dates.min(), dates.max()
+            self.start_date = low if self.start_date is None else min(self.start_date, low)
+            self.end_date = high if self.end_date is None else max(self.end_date, high)
+
+        # Превью обрезается до PREVIEW_LENGTH, поэтому записи форматируются, только пока оно не заполнено
+        for record in iter_frame_records(frame):
+            if self.preview_length > PREVIEW_LENGTH:
+                break
+            if not self.preview_parts:
+                self.preview_parts.append(export_header(self.user_id))
+                self.preview_length += len(self.preview_parts[0])
+            block = format_record_for_bot(record)
+            self.preview_parts.append(block)
+            self.preview_length += len(block)
+
+    def observe(self, frames: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Пропускает пачки дальше, попутно учитывая каждую"""
+        for frame in frames:
+            self.add(frame)
+            yield frame
+
+    def merge(self, other: 'ImportSummary'):
+        """Добавление итогов другого листа (превью дополняется его записями без заголовка)"""
+        self.total_records += other.total_records
+        self.dated_records += other.dated_records
+        self.temperature_records += other.temperature_records
+        self.records_with_disruptions += other.records_with_disruptions
+        self.records_with_notes += other.records_with_notes
+        self.temperature_sum += other.temperature_sum
+        self.temperature_count += other.temperature_count
+        for name, pick in (('start_date', min), ('end_date', max), ('temperature_min', min), ('temperature_max', max)):
+            values = [value for value in (getattr(self, name), getattr(other, name)) if value is not None]
+            setattr(self, name, pick(values) if values else None)
+
+        for block in other.preview_parts[1:]:
+            if self.preview_length > PREVIEW_LENGTH:
+                break
+            if not self.preview_parts:
+                self.preview_parts.append(export_header(self.user_id))
+                self.preview_length += len(self.preview_parts[0])
+            self.preview_parts.append(block)
+            self.preview_length += len(block)
+
+    def statistics(self) -> Dict[str, Any]:
+        """Статистика в формате ExcelDataHandler.get_statistics"""
+        temperature_stats = {}
+        if self.temperature_count:
+            temperature_stats = {
+                "min": self.temperature_min,
+                "max": self.temperature_max,
+                "avg": self.temperature_sum / self.temperature_count,
+                "count": self.temperature_count
+            }
+        return {
+            "total_records": self.total_records,
+            "temperature_records": self.temperature_records,
+            "records_with_disruptions": self.records_with_disruptions,
+            "records_with_notes": self.records_with_notes,
+            "date_range": {"start": self.start_date, "end": self.end_date},
+            "temperature_stats": temperature_stats
+        }
+
+    def preview(self) -> str:
+        """Начало текстового экспорта, как export_to_bot_format с обрезкой"""
+        if not self.preview_parts:
+            return "Нет данных для экспорта"
+        text = "".join(self.preview_parts)
+        return text[:PREVIEW_LENGTH] + "..." if len(text) > PREVIEW_LENGTH else text
+
 class ExcelDataHandler:
     """Класс для обработки данных из Excel таблиц фертильности"""
     
-    def __init__(self, excel_file_path: str):
+    def __init__(self, excel_file_path: Union[str, BinaryIO]):
+        # Путь к файлу или открытый файловый объект (загрузка из Telegram в памяти)
         self.excel_file_path = excel_file_path
+        self.source_name = excel_file_path if isinstance(excel_file_path, str) else "загруженный файл"
         self.data = None
+    
+    def _source(self) -> Union[str, BinaryIO]:
+        """Источник для чтения; файловый объект перематывается в начало перед каждым проходом"""
+        if not isinstance(self.excel_file_path, str):
+            self.excel_file_path.seek(0)
+        return self.excel_file_path
         
     def load_excel_data(self) -> bool:
         """Загрузка данных из Excel файла"""
         try:
             # Читаем первый лист (Карта 1)
-            self.data = pd.read_excel(self.excel_file_path, sheet_name=0)
-            logging.info(f"Успешно загружен Excel файл: {self.excel_file_path}")
+            self.data = pd.read_excel(self._source(), sheet_name=0)
+            logging.info(f"Успешно загружен Excel файл: {self.source_name}")
             logging.info(f"Размер данных: {self.data.shape}")
             return True
         except Exception as e:
@@ -47,65 +483,14 @@ class ExcelDataHandler:
             logging.error("Данные не загружены. Сначала вызовите load_excel_data()")
             return []
         
-        records = []
-        
         try:
-            # Находим строки с данными о температуре
-            temp_mask = self.data['БТТ'].notna() | self.data['температура.1'].notna()
-            fertility_data = self.data[temp_mask].copy()
-            
-            for _, row in fertility_data.iterrows():
-                record = FertilityRecord()
-                
-                # Основные поля
-                if pd.notna(row.get('День цикла')):
-                    record.cycle_day = int(row['День цикла'])
-                
-                # Обработка даты
-                if pd.notna(row.get('Дата')):
-                    # Предполагаем, что дата может быть числом дня месяца
-                    try:
-                        day = int(row['Дата'])
-                        # Создаем дату для текущего года и месяца (можно адаптировать)
-                        current_year = datetime.now().year
-                        current_month = datetime.now().month
-                        record.date = date(current_year, current_month, day)
-                    except (ValueError, TypeError):
-                        logging.warning(f"Не удалось обработать дату: {row.get('Дата')}")
-                
-                # Температура
-                if pd.notna(row.get('БТТ')):
-                    record.temperature = float(row['БТТ'])
-                
-                if pd.notna(row.get('температура.1')):
-                    record.temperature_alt = float(row['температура.1'])
-                
-                # Нарушения и коды
-                if pd.notna(row.get('Нарушения')):
-                    record.disruptions = str(row['Нарушения'])
-                
-                if pd.notna(row.get('НТ')):
-                    record.disruption_code = str(row['НТ'])
-                
-                # Примечания и заметки
-                if pd.notna(row.get('Примечание')):
-                    record.note = str(row['Примечание'])
-                
-                if pd.notna(row.get('Новый термометр')):
-                    record.new_thermometer = str(row['Новый термометр'])
-                
-                # Время измерения
-                if pd.notna(row.get('Время')):
-                    record.measurement_time = str(row['Время'])
-                
-                if pd.notna(row.get('позже/раньше')):
-                    record.timing_note = str(row['позже/раньше'])
-                
-                if pd.notna(row.get('плодный период')):
-                    record.fertile_period = str(row['плодный период'])
-                
-                records.append(record)
-                
+            # Месяц и год карты - из первых строк листа (первая строка - заголовки)
+            header = tuple(str(name) for name in self.data.columns)
+            dates = SheetDates.from_rows([header] + list(self.data.head(CONTEXT_SEARCH_ROWS).itertuples(index=False, name=None)))
+            dates.follow(None)
+            if dates.month is None and 'Дата' in self.data.columns:
+                dates.anchor_to_today(SheetDates.count_wraps(self.data['Дата']))
+            records = list(iter_frame_records(records_frame(self.data, dates)))
             logging.info(f"Извлечено {len(records)} записей о фертильности")
             return records
             
@@ -113,6 +498,131 @@ class ExcelDataHandler:
             logging.error(f"Ошибка извлечения данных: {e}")
             return []
     
+    def _sheet_dates(self, worksheet, previous: Optional[SheetDates] = None) -> SheetDates:
+        """Месяц и год карты на листе; год без подписи - по предыдущей карте"""
+        dates = SheetDates.from_rows(worksheet.iter_rows(max_row=CONTEXT_SEARCH_ROWS, values_only=True))
+        dates.follow(previous)
+        if dates.month is None:
+            # Месяца на листе нет: отдельный проход по колонке «Дата», чтобы карта заканчивалась в текущем
+            # месяце (если в ней номера дней, а не полные даты)
+            rows = worksheet.iter_rows(values_only=True)
+            columns = self._find_header(rows) or {}
+            day_column = columns.get('Дата')
+            days = [row[day_column] for row in rows if day_column is not None and len(row) > day_column
+                    and isinstance(row[day_column], (int, float)) and not isinstance(row[day_column], bool)]
+            if days:
+                dates.anchor_to_today(SheetDates.count_wraps(days))
+                logging.warning(f"На листе '{worksheet.title}' ({self.source_name}) не указан месяц карты, "
+                                f"даты отсчитаны от текущего месяца")
+        return dates
+
+    def discover_card_sheets(self) -> List[tuple]:
+        """
+        Листы-карты книги (со строкой заголовков, где есть «БТТ») с месяцем
+        и годом начала каждой карты: [(название листа, SheetDates)]
+        """
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(self._source(), read_only=True, data_only=True)
+        try:
+            sheets = []
+            previous = None
+            for worksheet in workbook.worksheets:
+                if self._find_header(worksheet.iter_rows(values_only=True)) is None:
+                    continue
+                dates = self._sheet_dates(worksheet, previous)
+                sheets.append((worksheet.title, dates))
+                previous = dates
+            logging.info(f"Найдено листов-карт: {len(sheets)} ({self.source_name})")
+            return sheets
+        finally:
+            workbook.close()
+
+    def iter_record_frames(self, chunk_size: int = IMPORT_CHUNK_SIZE, sheet_name: Optional[str] = None,
+                           dates: Optional[SheetDates] = None) -> Iterator[pd.DataFrame]:
+        """
+        Потоковое извлечение записей о фертильности с листа (по умолчанию
+        первого) пачками. Лист читается openpyxl в режиме read-only построчно:
+        строка заголовков находится один раз, из каждой строки берутся только
+        нужные колонки, и каждые chunk_size строк преобразуются в записи
+        векторно (records_frame), поэтому память не зависит от размера листа.
+        dates - месяц и год карты (из discover_card_sheets); без них
+        определяются по самому листу.
+        """
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(self._source(), read_only=True, data_only=True)
+        try:
+            worksheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+            dates = replace(dates) if dates is not None else self._sheet_dates(worksheet)
+            rows = worksheet.iter_rows(values_only=True)
+            columns = self._find_header(rows)
+            if columns is None:
+                logging.error(f"На листе '{worksheet.title}' не найдена строка заголовков с колонкой 'БТТ': {self.source_name}")
+                return
+
+            names = [name for name in IMPORT_COLUMNS if name in columns]
+            indexes = [columns[name] for name in names]
+            width = max(indexes) + 1
+            pick = itemgetter(*indexes) if len(indexes) > 1 else (lambda row: (row[indexes[0]],))
+
+            count = 0
+            chunk = []
+            for row in rows:
+                if len(row) < width:
+                    row = row + (None,) * (width - len(row))
+                chunk.append(pick(row))
+                if len(chunk) >= chunk_size:
+                    frame = records_frame(pd.DataFrame(chunk, columns=names, dtype=object), dates)
+                    chunk = []
+                    if not frame.empty:
+                        count += len(frame)
+                        yield frame
+            if chunk:
+                frame = records_frame(pd.DataFrame(chunk, columns=names, dtype=object), dates)
+                if not frame.empty:
+                    count += len(frame)
+                    yield frame
+            logging.info(f"Извлечено {count} записей о фертильности с листа '{worksheet.title}'")
+        finally:
+            workbook.close()
+
+    def iter_workbook_frames(self, chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """Пачки записей со всех листов-карт книги по очереди"""
+        for sheet_name, dates in self.discover_card_sheets():
+            yield from self.iter_record_frames(chunk_size, sheet_name, dates)
+
+    def iter_fertility_records(self) -> Iterator[FertilityRecord]:
+        """Потоковое извлечение записей по одной поверх iter_record_frames"""
+        for frame in self.iter_record_frames():
+            yield from iter_frame_records(frame)
+
+    @staticmethod
+    def _find_header(rows: Iterator[tuple]) -> Optional[Dict[str, int]]:
+        """
+        Поиск строки заголовков среди первых HEADER_SEARCH_ROWS строк.
+        Повторяющиеся названия получают суффиксы .1, .2 ... как в pandas
+        (вторая колонка «температура» -> «температура.1»).
+        """
+        for _, row in zip(range(HEADER_SEARCH_ROWS), rows):
+            names = [value.strip() if isinstance(value, str) else value for value in row]
+            if 'БТТ' not in names:
+                continue
+
+            columns = {}
+            seen = {}
+            for index, name in enumerate(names):
+                if not isinstance(name, str) or not name:
+                    continue
+                if name in seen:
+                    seen[name] += 1
+                    name = f"{name}.{seen[name]}"
+                else:
+                    seen[name] = 0
+                columns.setdefault(name, index)
+            return columns
+        return None
+
     async def save_to_database(self, user_id: int, records: List[FertilityRecord]) -> bool:
         """Сохранение записей в базу данных"""
         try:
@@ -122,24 +632,7 @@ class ExcelDataHandler:
                 # Подготовка данных для сохранения
                 temperature = record.temperature or record.temperature_alt
                 
-                # Создание заметки из различных полей
-                note_parts = []
-                if record.note:
-                    note_parts.append(f"Примечание: {record.note}")
-                if record.new_thermometer:
-                    note_parts.append(f"Термометр: {record.new_thermometer}")
-                if record.disruption_code:
-                    note_parts.append(f"Код: {record.disruption_code}")
-                if record.measurement_time:
-                    note_parts.append(f"Время: {record.measurement_time}")
-                if record.timing_note:
-                    note_parts.append(f"Время заметка: {record.timing_note}")
-                if record.fertile_period:
-                    note_parts.append(f"Плодный период: {record.fertile_period}")
-                if record.cycle_day:
-                    note_parts.append(f"День цикла: {record.cycle_day}")
-                
-                combined_note = "; ".join(note_parts) if note_parts else None
+                combined_note = record.combined_note()
                 
                 # Сохранение в базу данных
                 if record.date:
@@ -167,134 +660,338 @@ class ExcelDataHandler:
             logging.error(f"Ошибка сохранения в базу данных: {e}")
             return False
     
+    async def save_records_bulk(self, user_id: int, records: Iterable[FertilityRecord],
+                                chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+        """
+        Сохранение записей пачками по chunk_size через db.bulk_upsert_records.
+        records читается лениво, в памяти держится только текущая пачка.
+        Возвращает число сохраненных дней (повторы дат не учитываются).
+        """
+        saved = 0
+        chunk = []
+        outcomes: Dict[Any, str] = {}
+        for record in records:
+            if not record.date:
+                continue
+            chunk.append((record.date, record.temperature or record.temperature_alt, record.combined_note()))
+            if len(chunk) >= chunk_size:
+                counts = await db.bulk_upsert_records(user_id, chunk, outcomes) or {}
+                saved += sum(counts.get(key, 0) for key in WRITE_COUNTS)
+                chunk = []
+        if chunk:
+            counts = await db.bulk_upsert_records(user_id, chunk, outcomes) or {}
+            saved += sum(counts.get(key, 0) for key in WRITE_COUNTS)
+
+        logging.info(f"Сохранено {saved} записей импорта для пользователя {user_id}")
+        return saved
+
+    async def save_frames_bulk(self, user_id: int, frames: Iterable[pd.DataFrame]) -> Dict[str, int]:
+        """
+        Сохранение пачек записей (результат records_frame) через
+        db.bulk_upsert_records, по одному запросу на пачку.
+        Возвращает {"inserted", "updated", "unchanged", "skipped"} по всем
+        пачкам: каждый день учитывается один раз, повторы даты (в том числе на
+        следующих листах) - в "skipped" (пачки, которые не удалось записать,
+        не учитываются).
+        """
+        totals = dict.fromkeys(WRITE_COUNTS + (SKIPPED_COUNT,), 0)
+        outcomes: Dict[Any, str] = {}
+        for frame in frames:
+            counts = await db.bulk_upsert_records(user_id, frame_db_rows(frame), outcomes)
+            for key in totals:
+                totals[key] += counts[key] if counts else 0
+
+        logging.info(f"Импорт для пользователя {user_id}: новых записей {totals['inserted']}, "
+                     f"измененных {totals['updated']}, без изменений {totals['unchanged']}, "
+                     f"повторов дат {totals[SKIPPED_COUNT]}")
+        return totals
+
     def get_statistics(self) -> Dict[str, Any]:
         """Получение статистики по данным"""
-        if self.data is None:
-            return {}
-        
-        records = self.extract_fertility_records()
-        
-        stats = {
-            "total_records": len(records),
-            "temperature_records": len([r for r in records if r.temperature or r.temperature_alt]),
-            "records_with_disruptions": len([r for r in records if r.disruptions]),
-            "records_with_notes": len([r for r in records if r.note]),
-            "date_range": {
-                "start": min([r.date for r in records if r.date], default=None),
-                "end": max([r.date for r in records if r.date], default=None)
-            },
-            "temperature_stats": self._get_temperature_stats(records)
-        }
-        
-        return stats
-    
-    def _get_temperature_stats(self, records: List[FertilityRecord]) -> Dict[str, float]:
-        """Вычисление статистики по температуре"""
-        temperatures = []
-        
-        for record in records:
-            if record.temperature:
-                temperatures.append(record.temperature)
-            elif record.temperature_alt:
-                temperatures.append(record.temperature_alt)
-        
-        if not temperatures:
-            return {}
-        
-        return {
-            "min": min(temperatures),
-            "max": max(temperatures),
-            "avg": sum(temperatures) / len(temperatures),
-            "count": len(temperatures)
-        }
+        summary = ImportSummary(user_id=0)
+        for frame in self.iter_record_frames():
+            summary.add(frame)
+        return summary.statistics()
     
     def export_to_bot_format(self, user_id: int) -> str:
         """Экспорт данных в формат, подходящий для Telegram бота"""
-        records = self.extract_fertility_records()
-        
+        records = list(self.iter_fertility_records())
         if not records:
             return "Нет данных для экспорта"
-        
-        result = f"📊 Экспорт данных фертильности (пользователь {user_id})\n\n"
-        
-        for record in records:
-            if record.date:
-                result += f"📅 {record.date.strftime('%d.%m.%y')}\n"
-            
-            if record.temperature:
-                result += f"🌡 БТТ: {record.temperature}°C\n"
-            elif record.temperature_alt:
-                result += f"🌡 Температура: {record.temperature_alt}°C\n"
-            
-            if record.disruptions:
-                result += f"⚠️ Нарушения: {record.disruptions}\n"
-            
-            if record.measurement_time:
-                result += f"⏰ Время: {record.measurement_time}\n"
-            
-            if record.note or record.new_thermometer:
-                note = record.note or record.new_thermometer
-                result += f"📝 Заметка: {note}\n"
-            
-            result += "\n"
-        
-        return result
+        return export_header(user_id) + "".join(format_record_for_bot(record) for record in records)
+
+# Колонки листа цикла при экспорте истории: (заголовок, ширина)
+HISTORY_COLUMNS = (
+    ('Дата', 12), ('День цикла', 11), ('БТТ', 8), ('Слизь', 16), ('Менструация', 13),
+    ('Шейка матки', 16), ('Боль внизу живота', 12), ('Чувствительность груди', 14),
+    ('Половой акт', 11), ('Нарушения', 18), ('Заметка', 40), ('Создано', 19), ('Обновлено', 19),
+)
+SUMMARY_COLUMNS = (
+    ('Цикл', 8), ('Начало', 12), ('Конец', 12), ('Длина, дней', 12), ('Записей', 10),
+    ('С температурой', 14), ('Мин. БТТ', 10), ('Макс. БТТ', 10), ('Средняя БТТ', 12),
+    ('Дней менструации', 14), ('Половых актов', 13), ('С нарушениями', 13),
+)
+
+@dataclass
+class CycleTotals:
+    """Итоги цикла для сводного листа экспорта"""
+    number: int
+    start: date
+    end: date
+    next_start: Optional[date] = None
+    records: int = 0
+    temperature_count: int = 0
+    temperature_sum: float = 0.0
+    temperature_min: Optional[float] = None
+    temperature_max: Optional[float] = None
+    menstruation_days: int = 0
+    intercourse_days: int = 0
+    disrupted_days: int = 0
+
+    def row(self) -> list:
+        length = ((self.next_start or self.end + timedelta(days=1)) - self.start).days
+        average = round(self.temperature_sum / self.temperature_count, 2) if self.temperature_count else None
+        return [self.number, self.start, self.end, length, self.records, self.temperature_count,
+                self.temperature_min, self.temperature_max, average,
+                self.menstruation_days, self.intercourse_days, self.disrupted_days]
+
+class HistoryRows:
+    """
+    Строки экспорта всей истории пользователя (колонки HISTORY_COLUMNS) с
+    разбиением на циклы. Записи должны поступать по возрастанию даты; циклы
+    разбиваются по тем же границам, что и в cycle_evaluator (начало
+    менструации не ближе NEW_CYCLE_MIN_DAYS дней к предыдущему началу).
+    В памяти держатся только итоги циклов; начало цикла сообщается
+    _start_cycle, чтобы запись могла разложить строки по циклам.
+    """
+
+    def __init__(self):
+        from cycle_evaluator import NEW_CYCLE_MIN_DAYS
+
+        self.min_cycle_days = NEW_CYCLE_MIN_DAYS
+        self.cycles: List[CycleTotals] = []
+        self.rows = 0
+        self.last_onset: Optional[date] = None
+        self.previous_date: Optional[date] = None
+        self.previous_menstrual = False
+
+    def _start_cycle(self, day: date):
+        if self.cycles:
+            self.cycles[-1].next_start = day
+        self.cycles.append(CycleTotals(number=len(self.cycles) + 1, start=day, end=day))
+
+    def row(self, record: Dict[str, Any]) -> list:
+        """Строка истории для записи (из db.iter_user_records)"""
+        from cycle_evaluator import _parse_disruptions
+
+        day = record['record_date']
+        menstrual = bool(record['menstruation_type'])
+        onset = menstrual and not (self.previous_menstrual and self.previous_date == day - timedelta(days=1))
+        if not self.cycles or (onset and (self.last_onset is None
+                                          or (day - self.last_onset).days + 1 >= self.min_cycle_days)):
+            self._start_cycle(day)
+            if onset:
+                self.last_onset = day
+        self.previous_date, self.previous_menstrual = day, menstrual
+
+        cycle = self.cycles[-1]
+        temperature = float(record['temperature']) if record['temperature'] is not None else None
+        disruptions = _parse_disruptions(record['disruptions'])
+        cycle.end = day
+        cycle.records += 1
+        if temperature is not None:
+            cycle.temperature_count += 1
+            cycle.temperature_sum += temperature
+            cycle.temperature_min = temperature if cycle.temperature_min is None else min(cycle.temperature_min, temperature)
+            cycle.temperature_max = temperature if cycle.temperature_max is None else max(cycle.temperature_max, temperature)
+        cycle.menstruation_days += menstrual
+        cycle.intercourse_days += bool(record['intercourse'])
+        cycle.disrupted_days += bool(disruptions)
+        self.rows += 1
+
+        def flag(value):
+            return None if value is None else ("Да" if value else "Нет")
+
+        def timestamp(value):
+            # openpyxl не записывает даты с часовым поясом
+            return value.replace(tzinfo=None) if value is not None else None
+
+        return [
+            day, (day - cycle.start).days + 1, temperature, record['mucus_type'], record['menstruation_type'],
+            record['cervical_position'], flag(record['abdominal_pain']), flag(record['breast_tenderness']),
+            flag(record['intercourse']), ", ".join(disruptions) or None, record['note'],
+            timestamp(record['created_at']), timestamp(record['updated_at']),
+        ]
+
+class HistoryWorkbookWriter(HistoryRows):
+    """
+    Запись всей истории пользователя в xlsx по одной строке: лист на каждый
+    цикл и сводный лист. Книга создается в режиме write-only (строки сразу
+    уходят во временные файлы openpyxl), в памяти держатся только итоги циклов.
+    """
+
+    def __init__(self):
+        from openpyxl import Workbook
+
+        super().__init__()
+        self.workbook = Workbook(write_only=True)
+        self.summary_sheet = self._create_sheet("Сводка", SUMMARY_COLUMNS)
+        self.sheet = None
+
+    def _create_sheet(self, title: str, columns):
+        from openpyxl.utils import get_column_letter
+
+        sheet = self.workbook.create_sheet(title)
+        for index, (_, width) in enumerate(columns, start=1):
+            sheet.column_dimensions[get_column_letter(index)].width = width
+        sheet.freeze_panes = "A2"
+        sheet.append([name for name, _ in columns])
+        return sheet
+
+    def _start_cycle(self, day: date):
+        if self.sheet is not None:
+            # Лист закончившегося цикла дописан: закрываем его writer, чтобы не копить открытые листы
+            self.sheet.close()
+        super()._start_cycle(day)
+        cycle = self.cycles[-1]
+        self.sheet = self._create_sheet(f"Цикл {cycle.number} {day:%d.%m.%Y}", HISTORY_COLUMNS)
+
+    def add(self, record: Dict[str, Any]):
+        """Запись строки истории (из db.iter_user_records)"""
+        row = self.row(record)  # при начале нового цикла создает его лист
+        self.sheet.append(row)
+
+    def save(self, output: Union[str, BinaryIO]):
+        """Сводный лист и сохранение книги (в файл или в буфер)"""
+        for cycle in self.cycles:
+            self.summary_sheet.append(cycle.row())
+        self.workbook.save(output)
+
+async def export_history_to_excel(user_id: int, output: Union[str, BinaryIO]) -> int:
+    """
+    Экспорт всей истории пользователя в Excel: строки читаются курсором
+    пачками и сразу пишутся в книгу. Возвращает число выгруженных записей
+    (0 - записей нет, файл не создается).
+    """
+    writer = HistoryWorkbookWriter()
+    async for batch in db.iter_user_records(user_id):
+        for record in batch:
+            writer.add(record)
+    if writer.rows:
+        await asyncio.to_thread(writer.save, output)
+    logging.info(f"Экспорт истории пользователя {user_id}: {writer.rows} записей, {len(writer.cycles)} циклов")
+    return writer.rows
 
 # Функции для интеграции с ботом
-async def import_excel_to_bot(excel_file_path: str, user_id: int) -> Dict[str, Any]:
-    """Импорт данных из Excel в бот"""
+async def import_excel_to_bot(excel_file_path: Union[str, BinaryIO], user_id: int) -> Dict[str, Any]:
+    """Импорт данных из Excel (путь или файловый объект) в бот"""
     try:
         # Инициализируем обработчик Excel
         excel_handler = ExcelDataHandler(excel_file_path)
         
-        # Загружаем данные
-        if not excel_handler.load_excel_data():
+        # Один проход по всем листам-картам: разбор строк, статистика, превью и запись в базу пачками
+        summary = ImportSummary(user_id=user_id)
+        try:
+            counts = await excel_handler.save_frames_bulk(user_id, summary.observe(excel_handler.iter_workbook_frames()))
+        except Exception as e:
+            logging.error(f"Ошибка загрузки Excel файла: {e}")
             return {"success": False, "error": "Не удалось загрузить Excel файл"}
         
-        # Извлекаем записи
-        records = excel_handler.extract_fertility_records()
-        if not records:
+        if not summary.total_records:
             return {"success": False, "error": "Не найдено записей для импорта"}
         
-        # Сохраняем в базу данных
-        success = await excel_handler.save_to_database(user_id, records)
-        
-        # Получаем статистику
-        stats = excel_handler.get_statistics()
-        
+        # Записи без даты (пустая колонка «Дата») в базу не попадают, повторы даты считаются одним днем
+        saved = sum(counts[key] for key in WRITE_COUNTS)
         return {
-            "success": success,
-            "records_imported": len(records),
-            "statistics": stats,
-            "preview": excel_handler.export_to_bot_format(user_id)[:500] + "..." if len(excel_handler.export_to_bot_format(user_id)) > 500 else excel_handler.export_to_bot_format(user_id)
+            "success": saved == summary.dated_records - counts[SKIPPED_COUNT],
+            "records_imported": summary.total_records,
+            "records_saved": saved,
+            **counts,
+            "statistics": summary.statistics(),
+            "preview": summary.preview()
         }
         
     except Exception as e:
         logging.error(f"Ошибка импорта Excel: {e}")
         return {"success": False, "error": str(e)}
 
-def create_excel_template(output_path: str) -> bool:
-    """Создание шаблона Excel для заполнения"""
+def build_excel_template() -> bytes:
+    """
+    Шаблон Excel для заполнения: лист-карта с заголовками как в исходной
+    таблице, ширинами колонок, проверкой температур и полями месяца и года
+    карты (по ним при импорте восстанавливаются даты)
+    """
+    import openpyxl
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.datavalidation import DataValidation
+
+    workbook = openpyxl.Workbook()
+    worksheet = workbook.active
+    worksheet.title = "Карта 1"
+    worksheet.append([name for name, _ in TEMPLATE_COLUMNS])
+    for day in range(1, TEMPLATE_DAYS + 1):
+        worksheet.append([day])
+
+    last_row = TEMPLATE_DAYS + 1
+    for index, (name, width) in enumerate(TEMPLATE_COLUMNS, start=1):
+        worksheet.column_dimensions[get_column_letter(index)].width = width
+        worksheet.cell(row=1, column=index).font = Font(bold=True)
+    worksheet.freeze_panes = "A2"
+
+    def column_range(name: str) -> str:
+        letter = get_column_letter([column for column, _ in TEMPLATE_COLUMNS].index(name) + 1)
+        return f"{letter}2:{letter}{last_row}"
+
+    low, high = TEMPLATE_TEMPERATURE_RANGE
+    temperature = DataValidation(type="decimal", operator="between", formula1=str(low), formula2=str(high),
+                                 allow_blank=True, showErrorMessage=True, errorTitle="Температура",
+                                 error=f"Введите температуру от {low} до {high} °C, например 36.6")
+    temperature.add(column_range('БТТ'))
+    temperature.add(column_range('температура.1'))
+    day = DataValidation(type="whole", operator="between", formula1="1", formula2="31",
+                         allow_blank=True, showErrorMessage=True, errorTitle="Дата",
+                         error="Введите число месяца от 1 до 31")
+    day.add(column_range('Дата'))
+    worksheet.add_data_validation(temperature)
+    worksheet.add_data_validation(day)
+
+    # Месяц и год первого дня карты - справа от таблицы, в формате исходных карт
+    context_column = len(TEMPLATE_COLUMNS) + 2
+    worksheet.cell(row=2, column=context_column, value="Месяц:").font = Font(bold=True)
+    worksheet.cell(row=3, column=context_column, value="Год:").font = Font(bold=True)
+    worksheet.column_dimensions[get_column_letter(context_column + 1)].width = 12
+    month_cell = worksheet.cell(row=2, column=context_column + 1).coordinate
+    year_cell = worksheet.cell(row=3, column=context_column + 1).coordinate
+    months = DataValidation(type="list", formula1='"' + ",".join(TEMPLATE_MONTHS) + '"', allow_blank=True)
+    months.add(month_cell)
+    year = DataValidation(type="whole", operator="between", formula1="2000", formula2="2100", allow_blank=True,
+                          showErrorMessage=True, errorTitle="Год", error="Введите год, например 2025")
+    year.add(year_cell)
+    worksheet.add_data_validation(months)
+    worksheet.add_data_validation(year)
+
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+def excel_template_bytes() -> bytes:
+    """Шаблон Excel: строится один раз за процесс, дальше отдаются те же байты"""
+    global _template_bytes
+    if _template_bytes is None:
+        _template_bytes = build_excel_template()
+        logging.info(f"Создан шаблон Excel ({len(_template_bytes)} байт)")
+    return _template_bytes
+
+def create_excel_template(output_path: Union[str, BinaryIO]) -> bool:
+    """Создание шаблона Excel для заполнения (в файл или в буфер)"""
     try:
-        # Создаем структуру данных как в исходной таблице
-        template_data = {
-            'День цикла': list(range(1, 41)),  # Дни цикла 1-40
-            'Дата': [''] * 40,  # Пустые даты для заполнения
-            'БТТ': [''] * 40,  # Базальная температура тела
-            'Нарушения': [''] * 40,  # Нарушения измерения
-            'Примечание': [''] * 40,  # Примечания
-            'Новый термометр': [''] * 40,  # Заметки о термометре
-            'НТ': [''] * 40,  # Коды нарушений
-            'температура.1': [''] * 40,  # Альтернативная температура
-            'Время': [''] * 40,  # Время измерения
-            'позже/раньше': [''] * 40,  # Заметки о времени
-            'плодный период': [''] * 40,  # Отметки плодного периода
-        }
-        
-        df = pd.DataFrame(template_data)
-        df.to_excel(output_path, index=False)
-        
-        logging.info(f"Создан шаблон Excel: {output_path}")
+        template = excel_template_bytes()
+        if isinstance(output_path, str):
+            with open(output_path, 'wb') as output:
+                output.write(template)
+        else:
+            output_path.write(template)
         return True
         
     except Exception as e:
@@ -8,11 +8,42 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 import logging
 from datetime import datetime, timedelta
 from db_handler import db
-from fertility_chart_generator import (
-    generate_fertility_chart, 
-    get_current_fertility_phase,
-    get_fertility_predictions
-)
+from cycle_evaluator import cycle_tracker
+from chart_cache import get_or_render_chart
+from render_scheduler import RenderBusyError
+# Генератор графиков, прогноз и пакетный анализ (numpy/matplotlib)
+# загружаются при первом запросе через load_module
+from lazy_modules import load_module
+
+OVERLAY_RECORDS_LIMIT = 220  # около 7 циклов: текущий и до 6 прошлых
+RENDER_BUSY_TEXT = "⏳ Сейчас создается много графиков. Попробуйте через минуту."
+# Сколько записей берется для графика каждого типа (превью и полное разрешение должны совпадать)
+CHART_RECORDS_LIMITS = {
+    "temperature": 40,
+    "summary": 40,
+    "overlay": OVERLAY_RECORDS_LIMIT,
+    "overlay_shift": OVERLAY_RECORDS_LIMIT,
+}
+
+def full_resolution_keyboard(chart_type: str) -> InlineKeyboardBuilder:
+    """Кнопка получения графика в полном разрешении (под превью)"""
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🔍 Полное разрешение", callback_data=f"chart_full:{chart_type}")
+    return builder
+
+async def get_predictions_with_forecast(user_id: int, records) -> dict:
+    """Анализ записей с прогнозом дат по модели циклов пользователя"""
+    chart_generator = await load_module("fertility_chart_generator")
+    predictor = await load_module("cycle_predictor")
+    
+    predictions = chart_generator.get_fertility_predictions(records)
+    forecast = await predictor.cycle_predictor.predict(user_id, records)
+    if forecast and not predictions.get('error'):
+        predictions['next_ovulation_estimate'] = forecast['next_ovulation'].strftime('%d.%m.%Y')
+        predictions['next_period_estimate'] = forecast['next_period'].strftime('%d.%m.%Y')
+        predictions['next_period_sd'] = forecast['next_period_sd']
+        predictions['cycles_observed'] = forecast['cycles_observed']
+    return predictions
 
 async def handle_chart_request_button(message: Message):
     """Обработчик кнопки запроса графиков"""
@@ -22,6 +53,9 @@ async def handle_chart_request_button(message: Message):
         builder.button(text="📊 Сводный график", callback_data="chart_summary")
         builder.button(text="🔮 Прогноз фертильности", callback_data="chart_prediction")
         builder.button(text="📅 Текущая фаза", callback_data="chart_current_phase")
+        builder.button(text="⚡ Быстрый график", callback_data="chart_quick")
+        builder.button(text="🔁 Сравнение циклов", callback_data="chart_overlay")
+        builder.button(text="📄 PDF-отчет для врача", callback_data="chart_pdf_report")
         builder.adjust(2)
         
         help_text = (
@@ -31,6 +65,9 @@ async def handle_chart_request_button(message: Message):
             "📊 <b>Сводный график</b> - комплексный анализ с температурой, фазами и фертильными днями\n\n"
             "🔮 <b>Прогноз фертильности</b> - анализ текущего состояния и прогноз следующей овуляции\n\n"
             "📅 <b>Текущая фаза</b> - определение текущей фазы менструального цикла\n\n"
+            "⚡ <b>Быстрый график</b> - упрощенный график температуры за доли секунды\n\n"
+            "🔁 <b>Сравнение циклов</b> - текущий цикл на фоне прошлых (по дню цикла или по сдвигу)\n\n"
+            "📄 <b>PDF-отчет для врача</b> - последние циклы в одном документе: график температуры и таблица дней\n\n"
             "<i>Для создания точного графика необходимо минимум 5-7 записей температуры</i>"
         )
         
@@ -49,7 +86,7 @@ async def handle_temperature_chart(callback_query: CallbackQuery):
         await callback_query.message.edit_text("⏳ Создаю график температуры...")
         
         # Получаем данные пользователя за последний цикл (до 40 дней)
-        records = await db.get_user_records(user_id, limit=40)
+        records = await db.get_user_records(user_id, limit=CHART_RECORDS_LIMITS["temperature"])
         
         if not records:
             await callback_query.message.edit_text(
@@ -69,14 +106,16 @@ async def handle_temperature_chart(callback_query: CallbackQuery):
             )
             return
         
-        # Создаем график
-        chart_buffer = await generate_fertility_chart(records, "temperature")
+        # Создаем график (или берем заранее отрисованный после записи температуры)
+        chart_image = await get_or_render_chart(user_id, records, "temperature")
         
-        if chart_buffer:
-            # Отправляем график
-            photo = BufferedInputFile(chart_buffer.getvalue(), filename="temperature_chart.png")
+        if chart_image:
+            # Отправляем превью; 300 dpi - по кнопке, файлом
+            photo = BufferedInputFile(chart_image, filename="temperature_chart.png")
             
-            current_phase = get_current_fertility_phase(records)
+            # Фаза из инкрементального состояния цикла, как в «Текущей фазе»
+            cycle_status = await cycle_tracker.get_status(user_id, records)
+            current_phase = cycle_status['phase']
             
             caption = (
                 f"📈 <b>График базальной температуры</b>\n\n"
@@ -94,13 +133,16 @@ async def handle_temperature_chart(callback_query: CallbackQuery):
             await callback_query.message.answer_photo(
                 photo=photo,
                 caption=caption,
-                parse_mode="HTML"
+                parse_mode="HTML",
+                reply_markup=full_resolution_keyboard("temperature").as_markup()
             )
             
             await callback_query.message.delete()
         else:
             await callback_query.message.edit_text("❌ Не удалось создать график. Попробуйте позже.")
             
+    except RenderBusyError:
+        await callback_query.message.edit_text(RENDER_BUSY_TEXT)
     except Exception as e:
         logging.error(f"Ошибка в handle_temperature_chart: {e}")
         await callback_query.message.edit_text("❌ Произошла ошибка при создании графика.")
@@ -112,7 +154,7 @@ async def handle_summary_chart(callback_query: CallbackQuery):
         
         await callback_query.message.edit_text("⏳ Создаю сводный график...")
         
-        records = await db.get_user_records(user_id, limit=40)
+        records = await db.get_user_records(user_id, limit=CHART_RECORDS_LIMITS["summary"])
         
         if not records:
             await callback_query.message.edit_text(
@@ -121,13 +163,13 @@ async def handle_summary_chart(callback_query: CallbackQuery):
             return
         
         # Создаем сводный график
-        chart_buffer = await generate_fertility_chart(records, "summary")
+        chart_image = await get_or_render_chart(user_id, records, "summary")
         
-        if chart_buffer:
-            photo = BufferedInputFile(chart_buffer.getvalue(), filename="summary_chart.png")
+        if chart_image:
+            photo = BufferedInputFile(chart_image, filename="summary_chart.png")
             
             # Получаем детальную информацию
-            predictions = get_fertility_predictions(records)
+            predictions = await get_predictions_with_forecast(user_id, records)
             
             caption = (
                 f"📊 <b>Сводный график цикла</b>\n\n"
@@ -142,6 +184,9 @@ async def handle_summary_chart(callback_query: CallbackQuery):
             if predictions.get('next_ovulation_estimate'):
                 caption += f"🔮 Следующая овуляция (примерно): <b>{predictions['next_ovulation_estimate']}</b>\n"
             
+            if predictions.get('next_period_estimate'):
+                caption += f"🩸 Следующая менструация (примерно): <b>{predictions['next_period_estimate']}</b>\n"
+            
             caption += (
                 f"\n<i>Верхний график - температура с фазами\n"
                 f"Нижний график - календарь фертильности</i>"
@@ -150,13 +195,16 @@ async def handle_summary_chart(callback_query: CallbackQuery):
             await callback_query.message.answer_photo(
                 photo=photo,
                 caption=caption,
-                parse_mode="HTML"
+                parse_mode="HTML",
+                reply_markup=full_resolution_keyboard("summary").as_markup()
             )
             
             await callback_query.message.delete()
         else:
             await callback_query.message.edit_text("❌ Не удалось создать график.")
             
+    except RenderBusyError:
+        await callback_query.message.edit_text(RENDER_BUSY_TEXT)
     except Exception as e:
         logging.error(f"Ошибка в handle_summary_chart: {e}")
         await callback_query.message.edit_text("❌ Произошла ошибка при создании графика.")
@@ -178,7 +226,7 @@ async def handle_fertility_prediction(callback_query: CallbackQuery):
             return
         
         # Получаем прогноз
-        predictions = get_fertility_predictions(records)
+        predictions = await get_predictions_with_forecast(user_id, records)
         
         if predictions.get('error'):
             await callback_query.message.edit_text(f"❌ Ошибка анализа: {predictions['error']}")
@@ -213,7 +261,18 @@ async def handle_fertility_prediction(callback_query: CallbackQuery):
         # Прогноз следующей овуляции
         if predictions.get('next_ovulation_estimate'):
             prediction_text += f"\n🔮 <b>Прогноз следующей овуляции:</b>\n{predictions['next_ovulation_estimate']}\n"
-            prediction_text += f"<i>(примерная дата, основана на средней длине цикла)</i>\n"
+            cycles_observed = predictions.get('cycles_observed', 0)
+            if cycles_observed:
+                prediction_text += f"<i>(примерная дата по вашим прошлым циклам: {cycles_observed})</i>\n"
+            else:
+                prediction_text += f"<i>(примерная дата, основана на средней длине цикла)</i>\n"
+        
+        # Прогноз следующей менструации
+        if predictions.get('next_period_estimate'):
+            prediction_text += (
+                f"\n🩸 <b>Прогноз следующей менструации:</b>\n{predictions['next_period_estimate']}"
+                f" (± {predictions['next_period_sd']:.0f} дн.)\n"
+            )
         
         # Рекомендации
         prediction_text += f"\n💡 <b>Рекомендации:</b>\n"
@@ -244,6 +303,156 @@ async def handle_fertility_prediction(callback_query: CallbackQuery):
         logging.error(f"Ошибка в handle_fertility_prediction: {e}")
         await callback_query.message.edit_text("❌ Произошла ошибка при анализе данных.")
 
+async def handle_overlay_chart(callback_query: CallbackQuery):
+    """Обработчик графика сравнения циклов (выравнивание по дню цикла или по сдвигу)"""
+    try:
+        user_id = callback_query.from_user.id
+        chart_type = callback_query.data.replace("chart_", "", 1)  # overlay или overlay_shift
+        
+        # Кнопка переключения стоит под фото, поэтому прогресс - отдельным сообщением
+        progress_message = await callback_query.message.answer("⏳ Сравниваю циклы...")
+        await callback_query.answer()
+        
+        records = await db.get_user_records(user_id, limit=CHART_RECORDS_LIMITS[chart_type])
+        if not records:
+            await progress_message.edit_text("📊 У вас пока нет записей для сравнения циклов.")
+            return
+        
+        # Повторный запрос без новых записей отдается из кэша графиков
+        chart_image = await get_or_render_chart(user_id, records, chart_type)
+        if not chart_image:
+            await progress_message.edit_text(
+                "🔁 Для сравнения нужны отмеченные дни менструации хотя бы в одном цикле\n"
+                "(а для выравнивания по сдвигу - цикл с найденным подъемом температуры)."
+            )
+            return
+        
+        if chart_type == "overlay_shift":
+            caption = "🔁 <b>Сравнение циклов по дню сдвига</b>\n0 - первый высокий день"
+            builder_text, builder_data = "📅 Выровнять по дню цикла", "chart_overlay"
+        else:
+            caption = "🔁 <b>Сравнение циклов по дню цикла</b>"
+            builder_text, builder_data = "📈 Выровнять по сдвигу", "chart_overlay_shift"
+        caption += "\n<i>Серая полоса - среднее ± σ прошлых циклов</i>"
+        
+        builder = full_resolution_keyboard(chart_type)
+        builder.button(text=builder_text, callback_data=builder_data)
+        builder.adjust(1)
+        
+        await callback_query.message.answer_photo(
+            photo=BufferedInputFile(chart_image, filename=f"{chart_type}_chart.png"),
+            caption=caption,
+            parse_mode="HTML",
+            reply_markup=builder.as_markup()
+        )
+        await progress_message.delete()
+        
+    except RenderBusyError:
+        await progress_message.edit_text(RENDER_BUSY_TEXT)
+    except Exception as e:
+        logging.error(f"Ошибка в handle_overlay_chart: {e}")
+        await callback_query.message.answer("❌ Произошла ошибка при создании графика.")
+
+async def handle_full_resolution_chart(callback_query: CallbackQuery):
+    """Обработчик кнопки «Полное разрешение»: график в 300 dpi файлом"""
+    try:
+        user_id = callback_query.from_user.id
+        chart_type = callback_query.data.split(":", 1)[1]
+        if chart_type not in CHART_RECORDS_LIMITS:
+            await callback_query.answer("❌ Неизвестный тип графика")
+            return
+        
+        await callback_query.answer("⏳ Готовлю график в полном разрешении...")
+        
+        # Из кэша, если полный график по этим данным уже запрашивался
+        records = await db.get_user_records(user_id, limit=CHART_RECORDS_LIMITS[chart_type])
+        chart_image = await get_or_render_chart(user_id, records, chart_type, quality="full")
+        if not chart_image:
+            await callback_query.message.answer("❌ Не удалось создать график. Попробуйте позже.")
+            return
+        
+        # Документом, чтобы Telegram не пережимал изображение
+        await callback_query.message.answer_document(
+            BufferedInputFile(chart_image, filename=f"{chart_type}_chart_full.png"),
+            caption="🔍 График в полном разрешении (300 dpi)"
+        )
+        
+    except RenderBusyError:
+        await callback_query.message.answer(RENDER_BUSY_TEXT)
+    except Exception as e:
+        logging.error(f"Ошибка в handle_full_resolution_chart: {e}")
+        await callback_query.message.answer("❌ Произошла ошибка при создании графика.")
+
+async def handle_pdf_report(callback_query: CallbackQuery):
+    """Обработчик PDF-отчета по последним циклам (графики и таблицы дней)"""
+    try:
+        user_id = callback_query.from_user.id
+        
+        progress_message = await callback_query.message.answer("⏳ Готовлю PDF-отчет по циклам...")
+        await callback_query.answer()
+        
+        cycle_report = await load_module("cycle_report")
+        report = await cycle_report.build_cycle_report(user_id)
+        if not report:
+            await progress_message.edit_text("📊 У вас пока нет записей для отчета.")
+            return
+        
+        await callback_query.message.answer_document(
+            BufferedInputFile(report, filename=f"cycle_report_{datetime.now().strftime('%Y%m%d')}.pdf"),
+            caption=(
+                "📄 <b>Отчет по циклам</b>\n"
+                f"Последние циклы (до {cycle_report.REPORT_MAX_CYCLES}): график температуры и таблица дней"
+            ),
+            parse_mode="HTML"
+        )
+        await progress_message.delete()
+        
+    except RenderBusyError:
+        await progress_message.edit_text(RENDER_BUSY_TEXT)
+    except Exception as e:
+        logging.error(f"Ошибка в handle_pdf_report: {e}")
+        await callback_query.message.answer("❌ Произошла ошибка при создании отчета.")
+
+async def handle_quick_chart(callback_query: CallbackQuery):
+    """Обработчик быстрого графика (легкий SVG-рендерер без matplotlib)"""
+    try:
+        user_id = callback_query.from_user.id
+        records = await db.get_user_records(user_id, limit=40)
+        
+        if not [r for r in records if r.get('temperature')]:
+            await callback_query.message.edit_text(
+                "📊 У вас пока нет записей температуры для создания графика."
+            )
+            return
+        
+        chart_generator = await load_module("fertility_chart_generator")
+        light_renderer = await load_module("light_chart_renderer")
+        text_chart = chart_generator.generate_text_chart(records)
+        
+        png = None
+        if light_renderer.SVG_RASTER_AVAILABLE:
+            chart_buffer = await chart_generator.generate_fertility_chart(records, "temperature", renderer="svg")
+            if chart_buffer:
+                png = light_renderer.LightChartRenderer.rasterize(chart_buffer.getvalue())
+        
+        if png:
+            await callback_query.message.answer_photo(
+                photo=BufferedInputFile(png, filename="quick_chart.png"),
+                caption=text_chart or "📈 Быстрый график температуры",
+                parse_mode="HTML"
+            )
+        elif text_chart:
+            # Без cairosvg - текстовый график в сообщении: файл SVG Telegram не показывает
+            await callback_query.message.answer(text_chart, parse_mode="HTML")
+        else:
+            await callback_query.message.edit_text("❌ Не удалось создать график.")
+            return
+        await callback_query.answer()
+        
+    except Exception as e:
+        logging.error(f"Ошибка в handle_quick_chart: {e}")
+        await callback_query.message.edit_text("❌ Произошла ошибка при создании графика.")
+
 async def handle_current_phase(callback_query: CallbackQuery):
     """Обработчик определения текущей фазы"""
     try:
@@ -260,7 +469,9 @@ async def handle_current_phase(callback_query: CallbackQuery):
             )
             return
         
-        current_phase = get_current_fertility_phase(records)
+        # Фаза и фертильное окно из инкрементального состояния цикла (без пересчета)
+        cycle_status = await cycle_tracker.get_status(user_id, records)
+        current_phase = cycle_status['phase']
         
         # Получаем дополнительную информацию
         temp_records = [r for r in records if r.get('temperature')]
@@ -270,6 +481,19 @@ async def handle_current_phase(callback_query: CallbackQuery):
         phase_text = f"📅 <b>Анализ текущей фазы</b>\n\n"
         phase_text += f"🎯 <b>Текущая фаза:</b> {current_phase}\n"
         
+        if cycle_status.get('cycle_day'):
+            phase_text += f"🔢 <b>День цикла:</b> {cycle_status['cycle_day']}\n"
+        
+        if cycle_status.get('fertile_window_open') is not None:
+            window_text = "открыто" if cycle_status['fertile_window_open'] else "закрыто"
+            phase_text += f"🟠 <b>Фертильное окно:</b> {window_text}\n"
+        
+        if cycle_status.get('shift_status'):
+            phase_text += f"📈 <b>Температурный сдвиг (3 над 6):</b> {cycle_status['shift_status']}\n"
+        
+        if cycle_status.get('cover_line'):
+            phase_text += f"➖ <b>Покровная линия:</b> {cycle_status['cover_line']:.2f}°C\n"
+        
         if last_date:
             if isinstance(last_date, str):
                 date_obj = datetime.strptime(last_date, '%Y-%m-%d').date()
@@ -282,6 +506,12 @@ async def handle_current_phase(callback_query: CallbackQuery):
         
         phase_text += f"📊 <b>Всего записей:</b> {len(records)}\n"
         
+        # Текстовый график последних дней (без matplotlib)
+        chart_generator = await load_module("fertility_chart_generator")
+        text_chart = chart_generator.generate_text_chart(records)
+        if text_chart:
+            phase_text += f"\n{text_chart}\n"
+        
         # Описание фаз
         phase_descriptions = {
             "Менструация": "🔴 Менструальная фаза - время месячных. Уровень гормонов низкий, температура обычно снижена.",
@@ -337,6 +567,10 @@ def register_chart_handlers(dp):
     dp.callback_query.register(handle_summary_chart, lambda c: c.data == "chart_summary")
     dp.callback_query.register(handle_fertility_prediction, lambda c: c.data == "chart_prediction")
     dp.callback_query.register(handle_current_phase, lambda c: c.data == "chart_current_phase")
+    dp.callback_query.register(handle_quick_chart, lambda c: c.data == "chart_quick")
+    dp.callback_query.register(handle_overlay_chart, lambda c: c.data in ("chart_overlay", "chart_overlay_shift"))
+    dp.callback_query.register(handle_full_resolution_chart, lambda c: c.data.startswith("chart_full:"))
+    dp.callback_query.register(handle_pdf_report, lambda c: c.data == "chart_pdf_report")
     
     # Обработчики текстовых команд
     dp.message.register(handle_chart_request_button, F.text == "📊 Графики и анализ")
@@ -355,8 +589,16 @@ async def send_automatic_chart_updates():
         # графиков пользователям, у которых накопилось достаточно данных
         logging.info("Проверка автоматических обновлений графиков...")
         
-        # Пример: найти пользователей с новыми данными за последние 3 дня
-        # и отправить им обновленные графики
+        # Пакетный пересчет фаз всех пользователей с новыми данными за последние 3 дня
+        cohort_analyzer = await load_module("cohort_analyzer")
+        stats = await cohort_analyzer.refresh_cohort_status(active_since=cohort_analyzer.default_active_since(days=3))
+        logging.info(f"Фазы обновлены для {stats['users']} пользователей "
+                     f"({stats['users_per_second']:.0f} пользователей/с)")
+        
+        # Здесь можно отправить обновленные графики пользователям из таблицы phase_status
+        
+        from render_scheduler import render_scheduler
+        logging.info(f"Очередь отрисовки: {render_scheduler.metrics()}")
         
     except Exception as e:
         logging.error(f"Ошибка автоматического обновления графиков: {e}")
@@ -370,12 +612,18 @@ async def get_quick_fertility_status(user_id: int) -> str:
         if not records:
             return "📊 Нет данных для анализа"
         
-        current_phase = get_current_fertility_phase(records)
+        cycle_status = await cycle_tracker.get_status(user_id, records)
+        current_phase = cycle_status['phase']
         temp_records = len([r for r in records if r.get('temperature')])
         
         status = f"📅 Фаза: {current_phase}\n"
         status += f"📊 Записей температуры: {temp_records}/10"
         
+        chart_generator = await load_module("fertility_chart_generator")
+        text_chart = chart_generator.generate_text_chart(records, days=10)
+        if text_chart:
+            status += f"\n{text_chart}"
+        
         return status
         
     except Exception as e:
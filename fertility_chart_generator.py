@@ -2,49 +2,235 @@
 Модуль для создания графиков фертильности с анализом фаз цикла
 """
 
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import pandas as pd
 import numpy as np
 from datetime import datetime, date, timedelta
 from typing import List, Dict, Optional, Tuple, Any
 import io
 import logging
 from dataclasses import dataclass
-from enum import Enum
 
-# Настройка matplotlib для русского языка
-plt.rcParams['font.family'] = ['DejaVu Sans', 'Liberation Sans', 'Arial Unicode MS']
-plt.rcParams['axes.unicode_minus'] = False
+from fertility_phases import FertilityPhase, PHASES, PHASE_CODES
 
-class FertilityPhase(Enum):
-    """Фазы менструального цикла"""
-    MENSTRUAL = "Менструация"
-    FOLLICULAR = "Фолликулярная"
-    OVULATION = "Овуляция"
-    LUTEAL = "Лютеиновая"
-    UNKNOWN = "Неопределенная"
+# matplotlib загружается при первой отрисовке (см. load_pyplot)
+_pyplot = None
+
+def load_pyplot():
+    """
+    Ленивая загрузка matplotlib.pyplot с настройкой шрифтов для русского языка.
+    Импорт занимает сотни мс и десятки МБ, поэтому выполняется при первом
+    графике (или фоновом прогреве), а не при запуске бота.
+    """
+    global _pyplot
+    if _pyplot is None:
+        import matplotlib.pyplot as plt
+        plt.rcParams['font.family'] = ['DejaVu Sans', 'Liberation Sans', 'Arial Unicode MS']
+        plt.rcParams['axes.unicode_minus'] = False
+        _pyplot = plt
+    return _pyplot
 
 @dataclass
-class CycleDay:
-    """Данные одного дня цикла"""
-    date: date
-    day_number: int
-    temperature: Optional[float] = None
-    mucus_type: Optional[str] = None
-    menstruation_type: Optional[str] = None
-    note: Optional[str] = None
-    phase: FertilityPhase = FertilityPhase.UNKNOWN
-    is_fertile: bool = False
+class CycleSeries:
+    """
+    Календарный ряд цикла: по одному элементу массивов на каждый день
+    от начала цикла (start) до последней записи. Дни без записи
+    имеют NaN в temperatures и False в has_entry.
+    """
+    start: date
+    temperatures: np.ndarray   # float, NaN - нет измерения
+    phase_codes: np.ndarray    # int8, индекс в PHASES
+    fertile: np.ndarray        # bool
+    menstrual: np.ndarray      # bool
+    has_entry: np.ndarray      # bool, есть запись за день
+    ovulation_day: Optional[int] = None
+    
+    def __len__(self) -> int:
+        return len(self.temperatures)
+    
+    @property
+    def dates(self) -> np.ndarray:
+        """Даты дней ряда (datetime64[D])"""
+        return np.datetime64(self.start, 'D') + np.arange(len(self))
+    
+    @property
+    def end(self) -> date:
+        return self.start + timedelta(days=len(self) - 1)
+    
+    @property
+    def has_temperature(self) -> np.ndarray:
+        return ~np.isnan(self.temperatures)
+    
+    def phase_mask(self, phase: FertilityPhase) -> np.ndarray:
+        return self.phase_codes == PHASE_CODES[phase]
+    
+    def phase_at(self, index: int) -> FertilityPhase:
+        return PHASES[self.phase_codes[index]]
+
+# Выравнивание циклов для графика сравнения: тип графика -> способ
+OVERLAY_ALIGNMENTS = {
+    "overlay": "cycle_day",
+    "overlay_shift": "shift_day",
+}
+OVERLAY_PREVIOUS_CYCLES = 6  # сколько прошлых циклов сравнивать с текущим
+
+# Разрешение графиков: превью для сообщения и полное - по кнопке, файлом
+CHART_DPI = {
+    "preview": 80,   # около 960x640 - размер фото в Telegram, рисуется в разы быстрее
+    "full": 300,
+}
+
+@dataclass
+class CycleOverlay:
+    """
+    Циклы, выровненные по дню цикла или по дню температурного сдвига:
+    строки - циклы (последняя - текущий), столбцы - дни. Столбец origin
+    соответствует 1-му дню цикла или первому высокому дню.
+    """
+    temperatures: np.ndarray   # float (циклы x дни), NaN - нет измерения
+    starts: List[date]         # начало каждого цикла
+    align: str                 # "cycle_day" или "shift_day"
+    origin: int
+    
+    def __len__(self) -> int:
+        return len(self.starts)
+    
+    @property
+    def day_numbers(self) -> np.ndarray:
+        """Подписи столбцов: день цикла (с 1) или дни относительно сдвига (с 0)"""
+        offset = 1 if self.align == "cycle_day" else 0
+        return np.arange(self.temperatures.shape[1]) - self.origin + offset
+    
+    @property
+    def history(self) -> np.ndarray:
+        """Закрытые (прошлые) циклы"""
+        return self.temperatures[:-1]
+    
+    def history_band(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Среднее и стандартное отклонение прошлых циклов по дням (NaN, если меньше 2 значений)"""
+        history = self.history
+        counts = (~np.isnan(history)).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            totals = np.nansum(history, axis=0)
+            mean = totals / counts
+            variance = np.nansum((history - mean) ** 2, axis=0) / counts
+        enough = counts >= 2
+        return np.where(enough, mean, np.nan), np.where(enough, np.sqrt(variance), np.nan)
 
 class FertilityAnalyzer:
     """Анализатор фертильности для определения фаз цикла"""
     
+    LOW_WINDOW = 6            # дней в окне низких температур
+    MIN_LOW_MEASUREMENTS = 3  # минимум измерений в окне
+    SHIFT_DELTA = 0.2         # подъем температуры над средним окна
+    HIGH_DELTA = 0.1          # порог для подтверждающих высоких дней
+    MIN_CYCLE_DAYS = 10       # менструация раньше этого дня цикла не начинает новый цикл
+    
     @staticmethod
     def detect_ovulation(temperatures: List[float], dates: List[date]) -> Tuple[Optional[int], List[FertilityPhase]]:
         """
         Определение овуляции по правилу симптотермального метода
         Возвращает индекс дня овуляции и фазы для каждого дня
+        
+        Температуры обрабатываются как массив float с NaN на месте пропусков:
+        среднее окна из 6 низких дней и проверка 2 следующих дней считаются
+        скользящими окнами сразу для всех кандидатов.
+        """
+        temps = FertilityAnalyzer._to_float_array(temperatures)
+        ovulation_day = FertilityAnalyzer.find_ovulation_day(temps)
+        codes = FertilityAnalyzer.phase_codes(ovulation_day, len(temps))
+        return ovulation_day, [PHASES[code] for code in codes]
+    
+    @staticmethod
+    def find_ovulation_day(temps: np.ndarray) -> Optional[int]:
+        """Индекс дня овуляции в массиве температур (NaN - пропуск) или None"""
+        ovulation_day = int(FertilityAnalyzer.find_ovulation_days(temps[np.newaxis, :])[0])
+        return ovulation_day if ovulation_day >= 0 else None
+    
+    @staticmethod
+    def find_ovulation_days(temps: np.ndarray) -> np.ndarray:
+        """
+        Поиск овуляции сразу для нескольких рядов: temps - матрица (ряды x дни),
+        короткие ряды дополнены NaN справа. Возвращает индекс дня овуляции
+        для каждого ряда или -1, если подъем не найден.
+        """
+        rows, n = temps.shape
+        window = FertilityAnalyzer.LOW_WINDOW
+        ovulation_days = np.full(rows, -1, dtype=np.int64)
+        
+        if n > window:
+            # Окна t[i-6:i] для кандидатов i = 6..n-1
+            low = np.lib.stride_tricks.sliding_window_view(temps[:, :-1], window, axis=1)
+            valid = ~np.isnan(low)
+            counts = valid.sum(axis=2)
+            
+            # Суммируем слева направо, как sum() в исходной реализации
+            sums = np.zeros(counts.shape)
+            for k in range(window):
+                sums += np.where(valid[..., k], low[..., k], 0.0)
+            
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avg_low = sums / counts
+            
+            current = temps[:, window:]
+            # Два следующих дня после подъема (NaN за пределами ряда)
+            padded = np.concatenate([temps, np.full((rows, 2), np.nan)], axis=1)
+            next_1 = padded[:, window + 1:n + 1]
+            next_2 = padded[:, window + 2:n + 2]
+            
+            with np.errstate(invalid='ignore'):
+                high_threshold = avg_low + FertilityAnalyzer.HIGH_DELTA
+                candidates = (
+                    ~np.isnan(current)
+                    & (counts >= FertilityAnalyzer.MIN_LOW_MEASUREMENTS)
+                    & (current >= avg_low + FertilityAnalyzer.SHIFT_DELTA)
+                    & ((next_1 >= high_threshold) | (next_2 >= high_threshold))
+                )
+            
+            # Овуляция за день до первого подъема
+            found = candidates.any(axis=1)
+            ovulation_days[found] = np.argmax(candidates[found], axis=1) + window - 1
+        
+        return ovulation_days
+    
+    @staticmethod
+    def phase_codes(ovulation_day: Optional[int], length: int) -> np.ndarray:
+        """Коды фаз для каждого дня на основе найденной овуляции"""
+        ovulation_days = np.array([-1 if ovulation_day is None else ovulation_day])
+        return FertilityAnalyzer.phase_code_matrix(ovulation_days, np.array([length]), length)[0]
+    
+    @staticmethod
+    def phase_code_matrix(ovulation_days: np.ndarray, lengths: np.ndarray, width: int) -> np.ndarray:
+        """
+        Коды фаз для матрицы рядов (ряды x дни); ovulation_days = -1,
+        если овуляция не найдена. Дни за пределами длины ряда не заполняются осмысленно.
+        """
+        days = np.arange(width)[np.newaxis, :]
+        ovulation = ovulation_days[:, np.newaxis]
+        lengths = lengths[:, np.newaxis]
+        
+        follicular = PHASE_CODES[FertilityPhase.FOLLICULAR]
+        luteal = PHASE_CODES[FertilityPhase.LUTEAL]
+        
+        with_ovulation = np.where(days <= ovulation, follicular,
+                                  np.where(days == ovulation + 1, PHASE_CODES[FertilityPhase.OVULATION], luteal))
+        # Если овуляция не найдена, назначаем фазы примерно
+        without_ovulation = np.where(days < lengths // 2, follicular, luteal)
+        
+        codes = np.where(ovulation >= 0, with_ovulation, without_ovulation)
+        codes = np.where(lengths < FertilityAnalyzer.LOW_WINDOW, PHASE_CODES[FertilityPhase.UNKNOWN], codes)
+        return codes.astype(np.int8)
+    
+    @staticmethod
+    def _to_float_array(temperatures) -> np.ndarray:
+        """Преобразование списка температур с None в массив float с NaN"""
+        if isinstance(temperatures, np.ndarray):
+            return temperatures.astype(float, copy=False)
+        return np.array([np.nan if t is None else float(t) for t in temperatures], dtype=float)
+    
+    @staticmethod
+    def _detect_ovulation_loop(temperatures: List[float], dates: List[date]) -> Tuple[Optional[int], List[FertilityPhase]]:
+        """
+        Исходная реализация detect_ovulation на чистом Python
+        (эталон для проверки эквивалентности и бенчмарков)
         """
         if len(temperatures) < 6:
             return None, [FertilityPhase.UNKNOWN] * len(temperatures)
@@ -102,19 +288,80 @@ class FertilityAnalyzer:
         return [bool(record.get('menstruation_type')) for record in records]
     
     @staticmethod
-    def calculate_fertile_window(ovulation_day: Optional[int], cycle_length: int) -> List[bool]:
+    def calculate_fertile_window(ovulation_day: Optional[int], cycle_length: int) -> np.ndarray:
         """Расчет фертильного окна (5 дней до + день овуляции + 1 день после)"""
-        fertile_days = [False] * cycle_length
-        
-        if ovulation_day is not None:
-            # Фертильное окно: 5 дней до овуляции, день овуляции и 1 день после
-            start = max(0, ovulation_day - 5)
-            end = min(cycle_length, ovulation_day + 2)
-            
-            for i in range(start, end):
-                fertile_days[i] = True
-        
-        return fertile_days
+        ovulation_days = np.array([-1 if ovulation_day is None else ovulation_day])
+        return FertilityAnalyzer.fertile_window_matrix(ovulation_days, np.array([cycle_length]), cycle_length)[0]
+    
+    @staticmethod
+    def fertile_window_matrix(ovulation_days: np.ndarray, lengths: np.ndarray, width: int) -> np.ndarray:
+        """Фертильные окна для матрицы рядов (ряды x дни)"""
+        days = np.arange(width)[np.newaxis, :]
+        ovulation = ovulation_days[:, np.newaxis]
+        
+        # Фертильное окно: 5 дней до овуляции, день овуляции и 1 день после
+        return ((ovulation >= 0)
+                & (days >= ovulation - 5)
+                & (days <= ovulation + 1)
+                & (days < lengths[:, np.newaxis]))
+
+    @staticmethod
+    def find_cycle_starts(menstrual: np.ndarray, min_days: int = MIN_CYCLE_DAYS) -> np.ndarray:
+        """
+        Индексы первых дней циклов в календарном ряду: начало менструации,
+        не ближе min_days дней к предыдущему началу
+        """
+        previous = np.concatenate([[False], menstrual[:-1]])
+        onsets = np.flatnonzero(menstrual & ~previous)
+        
+        starts = []
+        for onset in onsets:
+            if not starts or onset - starts[-1] + 1 >= min_days:
+                starts.append(int(onset))
+        return np.array(starts, dtype=np.int64)
+    
+    @staticmethod
+    def align_cycles(temperatures: np.ndarray, starts: np.ndarray,
+                     align: str = "cycle_day") -> Tuple[np.ndarray, int, np.ndarray]:
+        """
+        Выравнивание циклов календарного ряда одним векторизованным проходом.
+        Цикл i занимает [starts[i], starts[i + 1]), последний - до конца ряда.
+        Возвращает матрицу (циклы x дни), столбец начала отсчета и маску
+        оставленных циклов (при выравнивании по сдвигу прошлые циклы без
+        сдвига отбрасываются, а текущий без сдвига ставится по медиане).
+        """
+        total = len(temperatures)
+        lengths = np.diff(np.append(starts, total))
+        cycles = len(starts)
+        rows = np.repeat(np.arange(cycles), lengths)
+        columns = np.arange(starts[0], total) - np.repeat(starts, lengths)
+        
+        matrix = np.full((cycles, int(lengths.max())), np.nan)
+        matrix[rows, columns] = temperatures[starts[0]:]
+        
+        if align == "cycle_day":
+            return matrix, 0, np.ones(cycles, dtype=bool)
+        
+        # Первый высокий день - день после найденной овуляции
+        shifts = FertilityAnalyzer.find_ovulation_days(matrix) + 1
+        found = shifts > 0
+        keep = found.copy()
+        keep[-1] = True
+        if not found.any():
+            return matrix[:0], 0, np.zeros(cycles, dtype=bool)
+        if not found[-1]:
+            shifts[-1] = int(np.median(shifts[found]))
+        
+        shifts = shifts[keep]
+        origin = int(shifts.max())
+        kept_lengths = lengths[keep]
+        kept_days = np.repeat(keep, lengths)
+        kept_rows = np.repeat(np.arange(len(shifts)), kept_lengths)
+        kept_columns = columns[kept_days] - shifts[kept_rows] + origin
+        
+        aligned = np.full((len(shifts), int((kept_lengths - shifts).max()) + origin), np.nan)
+        aligned[kept_rows, kept_columns] = temperatures[starts[0]:][kept_days]
+        return aligned, origin, keep
 
 class FertilityChartGenerator:
     """Генератор графиков фертильности"""
@@ -122,67 +369,69 @@ class FertilityChartGenerator:
     def __init__(self):
         self.analyzer = FertilityAnalyzer()
         
-    def process_cycle_data(self, records: List[Dict]) -> List[CycleDay]:
-        """Обработка данных цикла"""
+    def process_cycle_data(self, records: List[Dict]) -> Optional[CycleSeries]:
+        """
+        Обработка данных цикла в календарный ряд: номер дня определяется датой,
+        а не позицией записи, поэтому пропуски в записях не сдвигают дни цикла
+        """
         if not records:
-            return []
+            return None
         
-        # Сортируем записи по дате
-        sorted_records = sorted(records, key=lambda x: x['record_date'])
+        count = len(records)
+        ordinals = np.fromiter((
+            (datetime.strptime(r['record_date'], '%Y-%m-%d').date() if isinstance(r['record_date'], str)
+             else r['record_date']).toordinal()
+            for r in records
+        ), dtype=np.int64, count=count)
         
-        cycle_days = []
-        temperatures = []
-        dates = []
+        first_ordinal = int(ordinals.min())
+        offsets = ordinals - first_ordinal
+        length = int(offsets.max()) + 1
         
-        for i, record in enumerate(sorted_records):
-            record_date = record['record_date']
-            if isinstance(record_date, str):
-                record_date = datetime.strptime(record_date, '%Y-%m-%d').date()
-            
-            temp = record.get('temperature')
-            if temp:
-                temp = float(temp)
-            
-            cycle_day = CycleDay(
-                date=record_date,
-                day_number=i + 1,
-                temperature=temp,
-                mucus_type=record.get('mucus_type'),
-                menstruation_type=record.get('menstruation_type'),
-                note=record.get('note')
-            )
-            
-            cycle_days.append(cycle_day)
-            temperatures.append(temp)
-            dates.append(record_date)
+        temperatures = np.full(length, np.nan)
+        temperatures[offsets] = np.fromiter(
+            (float(r['temperature']) if r.get('temperature') else np.nan for r in records),
+            dtype=float, count=count)
         
-        # Анализ фаз
-        ovulation_day, phases = self.analyzer.detect_ovulation(temperatures, dates)
-        menstrual_days = self.analyzer.identify_menstrual_days(sorted_records)
-        fertile_days = self.analyzer.calculate_fertile_window(ovulation_day, len(cycle_days))
-        
-        # Обновляем фазы и фертильность
-        for i, day in enumerate(cycle_days):
-            if menstrual_days[i]:
-                day.phase = FertilityPhase.MENSTRUAL
-            else:
-                day.phase = phases[i] if i < len(phases) else FertilityPhase.UNKNOWN
-            
-            day.is_fertile = fertile_days[i] if i < len(fertile_days) else False
+        menstrual = np.zeros(length, dtype=bool)
+        menstrual[offsets] = np.fromiter(
+            (bool(r.get('menstruation_type')) for r in records), dtype=bool, count=count)
+        
+        has_entry = np.zeros(length, dtype=bool)
+        has_entry[offsets] = True
         
-        return cycle_days
+        # Анализ фаз
+        ovulation_day = self.analyzer.find_ovulation_day(temperatures)
+        phase_codes = self.analyzer.phase_codes(ovulation_day, length)
+        phase_codes[menstrual] = PHASE_CODES[FertilityPhase.MENSTRUAL]
+        fertile = self.analyzer.calculate_fertile_window(ovulation_day, length)
+        
+        return CycleSeries(
+            start=date.fromordinal(first_ordinal),
+            temperatures=temperatures,
+            phase_codes=phase_codes,
+            fertile=fertile,
+            menstrual=menstrual,
+            has_entry=has_entry,
+            ovulation_day=ovulation_day
+        )
     
-    def create_temperature_chart(self, cycle_data: List[CycleDay], title: str = "График базальной температуры") -> io.BytesIO:
+    def create_temperature_chart(self, cycle_data: CycleSeries, title: str = "График базальной температуры",
+                                 dpi: int = CHART_DPI["full"]) -> io.BytesIO:
         """Создание графика температуры с фазами"""
         
+        plt = load_pyplot()
+        import matplotlib.dates as mdates
+        
         fig, ax = plt.subplots(figsize=(12, 8))
         
         # Извлекаем данные
-        dates = [day.date for day in cycle_data]
-        temperatures = [day.temperature for day in cycle_data if day.temperature is not None]
-        temp_dates = [day.date for day in cycle_data if day.temperature is not None]
+        dates = cycle_data.dates
+        has_temp = cycle_data.has_temperature
+        temperatures = cycle_data.temperatures[has_temp]
+        temp_dates = dates[has_temp]
         
-        if not temperatures:
+        if not len(temperatures):
             # Создаем пустой график с сообщением
             ax.text(0.5, 0.5, 'Нет данных о температуре', 
                    horizontalalignment='center', verticalalignment='center',
@@ -205,10 +454,9 @@ class FertilityChartGenerator:
             ax.set_title(title, fontsize=16, fontweight='bold')
             
             # Устанавливаем разумные пределы для температуры
-            if temperatures:
-                min_temp = min(temperatures) - 0.1
-                max_temp = max(temperatures) + 0.1
-                ax.set_ylim(min_temp, max_temp)
+            min_temp = temperatures.min() - 0.1
+            max_temp = temperatures.max() + 0.1
+            ax.set_ylim(min_temp, max_temp)
             
             # Форматируем ось дат
             ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
@@ -232,14 +480,14 @@ class FertilityChartGenerator:
         
         # Сохраняем в BytesIO
         img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='PNG', dpi=300, bbox_inches='tight')
+        plt.savefig(img_buffer, format='PNG', dpi=dpi, bbox_inches='tight')
         img_buffer.seek(0)
         plt.close(fig)
         
         return img_buffer
     
-    def _add_phase_backgrounds(self, ax, cycle_data: List[CycleDay], dates: List[date]):
-        """Добавление цветных фонов для фаз цикла"""
+    def _add_phase_backgrounds(self, ax, cycle_data: CycleSeries, dates: np.ndarray):
+        """Добавление цветных фонов для фаз цикла (одна полоса на каждый отрезок фазы)"""
         phase_colors = {
             FertilityPhase.MENSTRUAL: '#FF6B6B',      # Красный
             FertilityPhase.FOLLICULAR: '#4ECDC4',      # Бирюзовый
@@ -248,77 +496,76 @@ class FertilityChartGenerator:
             FertilityPhase.UNKNOWN: '#CCCCCC'          # Серый
         }
         
-        if not dates:
+        if not len(dates):
             return
         
-        current_phase = None
-        phase_start = dates[0]
+        # Границы отрезков с одинаковой фазой
+        codes = cycle_data.phase_codes
+        run_starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+        run_ends = np.append(run_starts[1:], len(codes) - 1)
         
-        for i, day in enumerate(cycle_data):
-            if day.phase != current_phase:
-                # Завершаем предыдущую фазу
-                if current_phase is not None:
-                    ax.axvspan(phase_start, day.date, 
-                             alpha=0.2, color=phase_colors.get(current_phase, '#CCCCCC'))
-                
-                # Начинаем новую фазу
-                current_phase = day.phase
-                phase_start = day.date
-        
-        # Завершаем последнюю фазу
-        if current_phase is not None:
-            ax.axvspan(phase_start, dates[-1], 
-                     alpha=0.2, color=phase_colors.get(current_phase, '#CCCCCC'))
-    
-    def _add_special_markers(self, ax, cycle_data: List[CycleDay]):
-        """Добавление специальных маркеров"""
-        for day in cycle_data:
-            if day.temperature is None:
-                continue
-            
+        for run_start, run_end in zip(run_starts, run_ends):
+            phase = PHASES[codes[run_start]]
+            ax.axvspan(dates[run_start], dates[run_end],
+                       alpha=0.2, color=phase_colors.get(phase, '#CCCCCC'))
+    
+    def _add_special_markers(self, ax, cycle_data: CycleSeries):
+        """Добавление специальных маркеров (одна коллекция на каждую категорию)"""
+        if not cycle_data:
+            return
+        
+        dates = cycle_data.dates
+        temperatures = cycle_data.temperatures
+        
+        has_temp = cycle_data.has_temperature
+        ovulation = has_temp & cycle_data.phase_mask(FertilityPhase.OVULATION)
+        
+        categories = [
             # Маркер овуляции
-            if day.phase == FertilityPhase.OVULATION:
-                ax.scatter(day.date, day.temperature, s=100, c='red', 
-                          marker='*', zorder=5, label='Овуляция' if not hasattr(ax, '_ovulation_marked') else "")
-                ax._ovulation_marked = True
-            
+            (ovulation, dict(s=100, c='red', marker='*', zorder=5, label='Овуляция')),
             # Маркер фертильных дней
-            if day.is_fertile and day.phase != FertilityPhase.OVULATION:
-                ax.scatter(day.date, day.temperature, s=60, c='orange', 
-                          marker='o', alpha=0.7, zorder=4, 
-                          label='Фертильные дни' if not hasattr(ax, '_fertile_marked') else "")
-                ax._fertile_marked = True
-            
+            (has_temp & cycle_data.fertile & ~ovulation,
+             dict(s=60, c='orange', marker='o', alpha=0.7, zorder=4, label='Фертильные дни')),
             # Маркер менструации
-            if day.phase == FertilityPhase.MENSTRUAL:
-                ax.scatter(day.date, day.temperature, s=80, c='darkred', 
-                          marker='s', zorder=4, 
-                          label='Менструация' if not hasattr(ax, '_menstrual_marked') else "")
-                ax._menstrual_marked = True
+            (has_temp & cycle_data.phase_mask(FertilityPhase.MENSTRUAL),
+             dict(s=80, c='darkred', marker='s', zorder=4, label='Менструация')),
+        ]
+        
+        # Коллекции создаются в порядке первого появления категории,
+        # чтобы порядок в легенде совпадал с поштучной отрисовкой
+        categories = [(mask, style) for mask, style in categories if mask.any()]
+        categories.sort(key=lambda item: int(np.argmax(item[0])))
+        
+        for mask, style in categories:
+            ax.scatter(dates[mask], temperatures[mask], **style)
     
-    def _get_current_phase(self, cycle_data: List[CycleDay]) -> FertilityPhase:
+    def _get_current_phase(self, cycle_data: Optional[CycleSeries]) -> FertilityPhase:
         """Определение текущей фазы (последний день с данными)"""
         if not cycle_data:
             return FertilityPhase.UNKNOWN
         
         # Ищем последний день с данными
-        for day in reversed(cycle_data):
-            if day.temperature is not None or day.menstruation_type:
-                return day.phase
+        days_with_data = np.flatnonzero(cycle_data.has_temperature | cycle_data.menstrual)
+        if len(days_with_data):
+            return cycle_data.phase_at(days_with_data[-1])
         
-        return cycle_data[-1].phase if cycle_data else FertilityPhase.UNKNOWN
+        return cycle_data.phase_at(len(cycle_data) - 1)
     
-    def create_cycle_summary_chart(self, cycle_data: List[CycleDay]) -> io.BytesIO:
+    def create_cycle_summary_chart(self, cycle_data: CycleSeries, dpi: int = CHART_DPI["full"]) -> io.BytesIO:
         """Создание сводного графика цикла"""
         
+        plt = load_pyplot()
+        import matplotlib.dates as mdates
+        
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10), height_ratios=[3, 1])
         
         # Верхний график - температура
-        dates = [day.date for day in cycle_data]
-        temperatures = [day.temperature for day in cycle_data if day.temperature is not None]
-        temp_dates = [day.date for day in cycle_data if day.temperature is not None]
+        dates = cycle_data.dates
+        has_temp = cycle_data.has_temperature
+        temperatures = cycle_data.temperatures[has_temp]
+        temp_dates = dates[has_temp]
         
-        if temperatures:
+        if len(temperatures):
             ax1.plot(temp_dates, temperatures, 'o-', linewidth=2, markersize=6, 
                     color='#2E86AB', label='БТТ')
             
@@ -339,17 +586,7 @@ class FertilityChartGenerator:
             FertilityPhase.UNKNOWN: '#CCCCCC'
         }
         
-        for day in cycle_data:
-            color = phase_colors.get(day.phase, '#CCCCCC')
-            height = 1.0
-            
-            if day.is_fertile:
-                height = 1.5
-            
-            if day.phase == FertilityPhase.MENSTRUAL:
-                height = 0.8
-            
-            ax2.bar(day.date, height, color=color, alpha=0.7, width=0.8)
+        self._add_phase_bars(ax2, cycle_data, phase_colors)
         
         ax2.set_ylabel('Фазы цикла', fontsize=12)
         ax2.set_ylim(0, 2)
@@ -376,13 +613,111 @@ class FertilityChartGenerator:
         
         # Сохраняем в BytesIO
         img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='PNG', dpi=300, bbox_inches='tight')
+        plt.savefig(img_buffer, format='PNG', dpi=dpi, bbox_inches='tight')
         img_buffer.seek(0)
         plt.close(fig)
         
         return img_buffer
     
-    def _get_cycle_info(self, cycle_data: List[CycleDay]) -> Dict[str, Any]:
+    def _add_phase_bars(self, ax, cycle_data: CycleSeries, phase_colors: Dict[FertilityPhase, str]):
+        """
+        Полоса фаз: по одной коллекции прямоугольников на каждый цвет фазы.
+        Столбцы рисуются только для дней с записями.
+        """
+        if not cycle_data:
+            return
+        
+        import matplotlib.dates as mdates
+        from matplotlib.collections import PolyCollection
+        
+        x = mdates.date2num(cycle_data.dates)
+        
+        heights = np.where(cycle_data.fertile, 1.5, 1.0)
+        heights[cycle_data.menstrual] = 0.8
+        
+        # Ширина столбца 0.8 дня, как у ax.bar(..., width=0.8)
+        left = x - 0.4
+        right = x + 0.4
+        bottom = np.zeros_like(x)
+        
+        ax.xaxis_date()
+        for phase, color in phase_colors.items():
+            mask = cycle_data.phase_mask(phase) & cycle_data.has_entry
+            if not mask.any():
+                continue
+            verts = np.stack([
+                np.column_stack([left[mask], bottom[mask]]),
+                np.column_stack([left[mask], heights[mask]]),
+                np.column_stack([right[mask], heights[mask]]),
+                np.column_stack([right[mask], bottom[mask]]),
+            ], axis=1)
+            ax.add_collection(PolyCollection(verts, facecolors=color, edgecolors='none', alpha=0.7))
+        
+        ax.autoscale_view()
+    
+    def build_cycle_overlay(self, cycle_data: CycleSeries, align: str = "cycle_day",
+                            previous_cycles: int = OVERLAY_PREVIOUS_CYCLES) -> Optional[CycleOverlay]:
+        """Текущий и до previous_cycles прошлых циклов, выровненные для сравнения"""
+        starts = self.analyzer.find_cycle_starts(cycle_data.menstrual)
+        if not len(starts):
+            return None
+        starts = starts[-(previous_cycles + 1):]
+        
+        temperatures, origin, keep = self.analyzer.align_cycles(cycle_data.temperatures, starts, align)
+        if not len(temperatures):
+            return None
+        
+        return CycleOverlay(
+            temperatures=temperatures,
+            starts=[cycle_data.start + timedelta(days=int(start)) for start in starts[keep]],
+            align=align,
+            origin=origin
+        )
+    
+    def create_overlay_chart(self, overlay: CycleOverlay, dpi: int = CHART_DPI["full"]) -> io.BytesIO:
+        """Сравнение текущего цикла с прошлыми: наложение кривых и среднее ± σ"""
+        plt = load_pyplot()
+        
+        fig, ax = plt.subplots(figsize=(12, 8))
+        x = overlay.day_numbers
+        
+        if len(overlay) > 1:
+            mean, std = overlay.history_band()
+            ax.fill_between(x, mean - std, mean + std, color='gray', alpha=0.2, label='Среднее ± σ')
+            ax.plot(x, mean, '--', color='gray', linewidth=1.5, label='Среднее прошлых циклов')
+            
+            colors = plt.cm.viridis(np.linspace(0.2, 0.8, len(overlay) - 1))
+            for row, start, color in zip(overlay.history, overlay.starts[:-1], colors):
+                valid = ~np.isnan(row)
+                ax.plot(x[valid], row[valid], '-', color=color, linewidth=1, alpha=0.6,
+                        label=f"Цикл с {start.strftime('%d.%m.%Y')}")
+        
+        current = overlay.temperatures[-1]
+        valid = ~np.isnan(current)
+        ax.plot(x[valid], current[valid], 'o-', color='#2E86AB', linewidth=2.5, markersize=6,
+                label=f"Текущий цикл (с {overlay.starts[-1].strftime('%d.%m.%Y')})")
+        
+        if overlay.align == "shift_day":
+            ax.axvline(0, color='red', linestyle=':', linewidth=1.5)
+            ax.set_xlabel('Дни относительно первого высокого дня', fontsize=12)
+        else:
+            ax.set_xlabel('День цикла', fontsize=12)
+        
+        ax.set_ylabel('Температура (°C)', fontsize=12)
+        ax.set_title(f'Сравнение циклов ({len(overlay)})', fontsize=16, fontweight='bold')
+        ax.grid(True, alpha=0.3)
+        ax.legend(loc='upper left', fontsize=9)
+        
+        plt.tight_layout()
+        
+        img_buffer = io.BytesIO()
+        plt.savefig(img_buffer, format='PNG', dpi=dpi, bbox_inches='tight')
+        img_buffer.seek(0)
+        plt.close(fig)
+        
+        return img_buffer
+    
+    def _get_cycle_info(self, cycle_data: Optional[CycleSeries]) -> Dict[str, Any]:
         """Получение информации о цикле"""
         if not cycle_data:
             return {
@@ -393,7 +728,7 @@ class FertilityChartGenerator:
         
         length = len(cycle_data)
         current_phase = self._get_current_phase(cycle_data).value
-        fertile_days = sum(1 for day in cycle_data if day.is_fertile)
+        fertile_days = int(cycle_data.fertile.sum())
         
         return {
             'length': length,
@@ -402,13 +737,16 @@ class FertilityChartGenerator:
         }
 
 # Функции для интеграции с ботом
-async def generate_fertility_chart(records: List[Dict], chart_type: str = "temperature") -> Optional[io.BytesIO]:
+async def generate_fertility_chart(records: List[Dict], chart_type: str = "temperature",
+                                   renderer: str = "matplotlib", quality: str = "full") -> Optional[io.BytesIO]:
     """
     Генерация графика фертильности
     
     Args:
         records: Список записей из базы данных
-        chart_type: Тип графика ("temperature" или "summary")
+        chart_type: Тип графика ("temperature", "summary", "overlay" или "overlay_shift")
+        renderer: "matplotlib" - полный PNG, "svg" - легкий SVG без matplotlib
+        quality: разрешение PNG из CHART_DPI ("preview" или "full")
     
     Returns:
         BytesIO объект с изображением графика или None при ошибке
@@ -421,15 +759,36 @@ async def generate_fertility_chart(records: List[Dict], chart_type: str = "tempe
             logging.warning("Нет данных для создания графика")
             return None
         
-        if chart_type == "summary":
-            return generator.create_cycle_summary_chart(cycle_data)
-        else:
-            return generator.create_temperature_chart(cycle_data)
+        if renderer == "svg":
+            from light_chart_renderer import LightChartRenderer
+            return io.BytesIO(LightChartRenderer().svg_chart(cycle_data))
+        
+        if chart_type in OVERLAY_ALIGNMENTS:
+            cycle_data = generator.build_cycle_overlay(cycle_data, OVERLAY_ALIGNMENTS[chart_type])
+            if cycle_data is None:
+                logging.warning("Нет циклов для графика сравнения")
+                return None
+        
+        # Отрисовка в пуле процессов, чтобы не блокировать цикл событий
+        from render_pool import render_in_pool
+        return io.BytesIO(await render_in_pool(cycle_data, chart_type, CHART_DPI[quality]))
             
     except Exception as e:
         logging.error(f"Ошибка создания графика: {e}")
         return None
 
+def generate_text_chart(records: List[Dict], days: Optional[int] = None) -> Optional[str]:
+    """Текстовый график (строка температур и полоса фаз) для встраивания в сообщение"""
+    try:
+        from light_chart_renderer import LightChartRenderer, SPARKLINE_DAYS
+        cycle_data = FertilityChartGenerator().process_cycle_data(records)
+        if not cycle_data:
+            return None
+        return LightChartRenderer().text_chart(cycle_data, days or SPARKLINE_DAYS) or None
+    except Exception as e:
+        logging.error(f"Ошибка создания текстового графика: {e}")
+        return None
+
 def get_current_fertility_phase(records: List[Dict]) -> str:
     """Получение текущей фазы фертильности"""
     try:
@@ -455,22 +814,14 @@ def get_fertility_predictions(records: List[Dict]) -> Dict[str, Any]:
         if not cycle_data:
             return {"error": "Нет данных"}
         
-        # Находим овуляцию и фертильные дни
-        ovulation_day = None
-        fertile_days = []
-        
-        for i, day in enumerate(cycle_data):
-            if day.phase == FertilityPhase.OVULATION:
-                ovulation_day = i + 1
-            if day.is_fertile:
-                fertile_days.append(day.date.strftime('%d.%m.%Y'))
-        
-        # Прогноз следующей овуляции (примерно)
-        if cycle_data:
-            last_date = cycle_data[-1].date
-            next_ovulation = last_date + timedelta(days=14)  # Примерная оценка
-        else:
-            next_ovulation = None
+        # Находим овуляцию (день цикла) и фертильные дни
+        ovulation_days = np.flatnonzero(cycle_data.phase_mask(FertilityPhase.OVULATION))
+        ovulation_day = int(ovulation_days[-1]) + 1 if len(ovulation_days) else None
+        fertile_days = [d.strftime('%d.%m.%Y') for d in cycle_data.dates[cycle_data.fertile].tolist()]
+        
+        # Прогноз следующей овуляции (примерно); по истории циклов
+        # прогноз уточняет cycle_predictor
+        next_ovulation = cycle_data.end + timedelta(days=14)  # Примерная оценка
         
         return {
             "current_phase": generator._get_current_phase(cycle_data).value,
@@ -4,12 +4,34 @@
 """
 
 from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+import asyncio
 import io
 import os
 import logging
-from excel_data_handler import ExcelDataHandler, import_excel_to_bot, create_excel_template
+import tempfile
+from typing import Optional
+# excel_data_handler (pandas, openpyxl) загружается при первом запросе через load_module
+from lazy_modules import load_module
+from import_jobs import import_jobs
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+UPLOAD_PREFIX = "fertility_import_"  # приватные временные файлы загрузок (права 0600, случайное имя)
+TEMPLATE_CAPTION = ("📄 Шаблон Excel для отслеживания фертильности\n\n"
+                    "Заполните данные и отправьте файл обратно для импорта.")
+# Расширение загруженного файла -> формат импорта
+UPLOAD_FORMATS = {".xlsx": "xlsx", ".csv": "csv", ".parquet": "parquet"}
+# Старый формат Excel (BIFF): openpyxl его не читает, файл нужно пересохранить в .xlsx
+LEGACY_EXCEL_EXTENSION = ".xls"
+# Форматы экспорта истории: callback_data -> (формат, расширение, подпись)
+EXPORT_FORMATS = {
+    "export_csv": ("csv", "csv", "CSV"),
+    "export_parquet": ("parquet", "parquet", "Parquet"),
+}
+# file_id шаблона в Telegram после первой отправки (байты шаблона кэшируются в excel_data_handler)
+_template_file_id: Optional[str] = None
 
 # Добавляем новые обработчики для работы с Excel файлами
 
@@ -20,14 +42,17 @@ async def handle_excel_import_button(message: Message):
         builder.button(text="📥 Загрузить Excel файл", callback_data="excel_upload")
         builder.button(text="📄 Скачать шаблон", callback_data="excel_template")
         builder.button(text="📊 Просмотреть статистику", callback_data="excel_stats")
+        builder.button(text="📤 Экспорт в CSV", callback_data="export_csv")
+        builder.button(text="📤 Экспорт в Parquet", callback_data="export_parquet")
         builder.adjust(1)
         
         help_text = (
             "📊 <b>Работа с Excel файлами</b>\n\n"
             "Вы можете:\n"
-            "• Загрузить свой Excel файл с данными о фертильности\n"
+            "• Загрузить свой Excel файл с данными о фертильности (или CSV, Parquet с теми же колонками)\n"
             "• Скачать шаблон для заполнения\n"
-            "• Посмотреть статистику по загруженным данным\n\n"
+            "• Посмотреть статистику по загруженным данным\n"
+            "• Выгрузить всю историю в CSV или Parquet\n\n"
             "Поддерживаемые поля:\n"
             "🔹 День цикла\n"
             "🔹 Дата\n"
@@ -43,28 +68,28 @@ async def handle_excel_import_button(message: Message):
 
 async def handle_excel_template_download(callback_query: CallbackQuery):
     """Обработчик скачивания шаблона Excel"""
+    global _template_file_id
     try:
-        user_id = callback_query.from_user.id
-        template_path = f"template_fertility_{user_id}.xlsx"
+        # Шаблон не меняется: после первой отправки Telegram отдает его по file_id без повторной загрузки
+        if _template_file_id is not None:
+            try:
+                await callback_query.message.answer_document(_template_file_id, caption=TEMPLATE_CAPTION)
+                await callback_query.answer("✅ Шаблон отправлен!")
+                return
+            except TelegramBadRequest as e:
+                logging.warning(f"Шаблон по file_id не отправлен, загружаем заново: {e}")
+                _template_file_id = None
+
+        excel_data_handler = await load_module("excel_data_handler")
+        template = await asyncio.to_thread(excel_data_handler.excel_template_bytes)
+        sent = await callback_query.message.answer_document(
+            types.BufferedInputFile(template, filename="template_fertility_tracker.xlsx"),
+            caption=TEMPLATE_CAPTION
+        )
+        if sent.document is not None:
+            _template_file_id = sent.document.file_id
         
-        # Создаем шаблон
-        if create_excel_template(template_path):
-            # Отправляем файл пользователю
-            with open(template_path, 'rb') as file:
-                await callback_query.message.answer_document(
-                    types.BufferedInputFile(
-                        file.read(),
-                        filename="template_fertility_tracker.xlsx"
-                    ),
-                    caption="📄 Шаблон Excel для отслеживания фертильности\n\nЗаполните данные и отправьте файл обратно для импорта."
-                )
-            
-            # Удаляем временный файл
-            os.remove(template_path)
-            
-            await callback_query.answer("✅ Шаблон отправлен!")
-        else:
-            await callback_query.answer("❌ Ошибка создания шаблона", show_alert=True)
+        await callback_query.answer("✅ Шаблон отправлен!")
             
     except Exception as e:
         logging.error(f"Ошибка в handle_excel_template_download: {e}")
@@ -76,6 +101,7 @@ async def handle_excel_upload_request(callback_query: CallbackQuery):
         await callback_query.message.edit_text(
             "📥 <b>Загрузка Excel файла</b>\n\n"
             "Отправьте Excel файл (.xlsx) с вашими данными о фертильности.\n"
+            "Подойдут и CSV или Parquet с теми же столбцами (дата - числом месяца или полной датой).\n"
             "Файл должен содержать столбцы: День цикла, Дата, БТТ, и другие поддерживаемые поля.",
             parse_mode="HTML"
         )
@@ -83,74 +109,128 @@ async def handle_excel_upload_request(callback_query: CallbackQuery):
     except Exception as e:
         logging.error(f"Ошибка в handle_excel_upload_request: {e}")
 
+def import_cancel_keyboard():
+    """Кнопка отмены фонового импорта"""
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✖️ Отменить импорт", callback_data="excel_import_cancel")
+    return builder.as_markup()
+
+def format_import_result(result: dict) -> str:
+    """Текст итогов успешного импорта"""
+    if result.get("repeated"):
+        response_text = "✅ <b>Этот файл уже импортирован</b>, данные в боте не изменились.\n\n"
+    else:
+        response_text = "✅ <b>Импорт успешно завершен!</b>\n\n"
+    response_text += f"📊 Импортировано записей: {result['records_imported']}\n"
+    if "inserted" in result:
+        response_text += (
+            f"🆕 Новых дней: {result['inserted']}, ✏️ изменено: {result['updated']}, "
+            f"➖ без изменений: {result['unchanged']}\n"
+        )
+    if result.get("skipped"):
+        response_text += f"🔁 Повторов дат (учтена строка более поздней карты): {result['skipped']}\n"
+    
+    if "statistics" in result:
+        stats = result["statistics"]
+        response_text += f"🌡 Записей с температурой: {stats.get('temperature_records', 0)}\n"
+        response_text += f"⚠️ Записей с нарушениями: {stats.get('records_with_disruptions', 0)}\n"
+        response_text += f"📝 Записей с заметками: {stats.get('records_with_notes', 0)}\n"
+        
+        if stats.get('temperature_stats'):
+            temp_stats = stats['temperature_stats']
+            response_text += f"\n🌡 <b>Статистика температуры:</b>\n"
+            response_text += f"Минимум: {temp_stats.get('min', 0):.2f}°C\n"
+            response_text += f"Максимум: {temp_stats.get('max', 0):.2f}°C\n"
+            response_text += f"Среднее: {temp_stats.get('avg', 0):.2f}°C\n"
+    return response_text
+
 async def handle_document_upload(message: Message):
-    """Обработчик загрузки документов (Excel файлов)"""
+    """
+    Обработчик загрузки документов (Excel файлов): файл скачивается, импорт
+    запускается в фоне (import_jobs), обработчик сразу возвращается
+    """
     try:
         document = message.document
         
-        # Проверяем, что это Excel файл
-        if not document.file_name.endswith(('.xlsx', '.xls')):
-            await message.answer("❌ Пожалуйста, отправьте файл Excel (.xlsx или .xls)")
+        # Проверяем, что это Excel, CSV или Parquet файл
+        extension = os.path.splitext(document.file_name or "")[1].lower()
+        if extension == LEGACY_EXCEL_EXTENSION:
+            await message.answer("❌ Файлы .xls (Excel 97-2003) не поддерживаются. "
+                                 "Откройте файл в Excel и сохраните его как .xlsx")
+            return
+        file_format = UPLOAD_FORMATS.get(extension)
+        if file_format is None:
+            await message.answer("❌ Пожалуйста, отправьте файл Excel (.xlsx), CSV или Parquet")
             return
         
         # Проверяем размер файла (максимум 10MB)
-        if document.file_size > 10 * 1024 * 1024:
+        if document.file_size > MAX_UPLOAD_SIZE:
             await message.answer("❌ Файл слишком большой. Максимальный размер 10MB")
             return
         
         user_id = message.from_user.id
+        if import_jobs.get(user_id) is not None:
+            await message.answer("⏳ Предыдущий импорт еще выполняется. Дождитесь его завершения или отмените его.")
+            return
         
-        # Скачиваем файл
-        file_info = await message.bot.get_file(document.file_id)
-        file_path = f"temp_excel_{user_id}.xlsx"
-        
-        await message.bot.download_file(file_info.file_path, file_path)
+        # Скачиваем файл в приватный временный файл: процессы разбора читают его по пути,
+        # содержимое не держится в памяти бота и не передается каждому процессу
+        # (расширение нужно openpyxl: книгу по пути он открывает только с ним)
+        upload_fd, upload_path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, suffix=f".{file_format}")
+        try:
+            with os.fdopen(upload_fd, "wb") as upload:
+                await message.bot.download(document, destination=upload)
+            
+            # Показываем прогресс
+            progress_message = await message.answer("⏳ Обрабатываем файл...", reply_markup=import_cancel_keyboard())
+        except Exception:
+            os.remove(upload_path)
+            raise
         
-        # Показываем прогресс
-        progress_message = await message.answer("⏳ Обрабатываем файл...")
+        async def on_progress(job):
+            await progress_message.edit_text(
+                f"⏳ Обрабатываем файл...\nОбработано записей: {job.records_parsed}, сохранено: {job.records_saved}",
+                reply_markup=import_cancel_keyboard()
+            )
         
-        try:
-            # Импортируем данные
-            result = await import_excel_to_bot(file_path, user_id)
+        async def on_finish(job, result):
+            if job.inserted or job.updated:
+                # Записи добавлены задним числом: состояние цикла восстановится при следующем запросе
+                from cycle_evaluator import cycle_tracker
+                predictor = await load_module("cycle_predictor")
+                await cycle_tracker.invalidate(user_id)
+                await predictor.cycle_predictor.invalidate(user_id)
             
-            if result["success"]:
-                response_text = (
-                    "✅ <b>Импорт успешно завершен!</b>\n\n"
-                    f"📊 Импортировано записей: {result['records_imported']}\n"
-                )
-                
-                if "statistics" in result:
-                    stats = result["statistics"]
-                    response_text += f"🌡 Записей с температурой: {stats.get('temperature_records', 0)}\n"
-                    response_text += f"⚠️ Записей с нарушениями: {stats.get('records_with_disruptions', 0)}\n"
-                    response_text += f"📝 Записей с заметками: {stats.get('records_with_notes', 0)}\n"
-                    
-                    if stats.get('temperature_stats'):
-                        temp_stats = stats['temperature_stats']
-                        response_text += f"\n🌡 <b>Статистика температуры:</b>\n"
-                        response_text += f"Минимум: {temp_stats.get('min', 0):.2f}°C\n"
-                        response_text += f"Максимум: {temp_stats.get('max', 0):.2f}°C\n"
-                        response_text += f"Среднее: {temp_stats.get('avg', 0):.2f}°C\n"
-                
-                await progress_message.edit_text(response_text, parse_mode="HTML")
+            if result.get("cancelled"):
+                await progress_message.edit_text(f"✖️ Импорт отменен. Сохранено записей: {result['records_saved']}")
+            elif result["success"]:
+                await progress_message.edit_text(format_import_result(result), parse_mode="HTML")
                 
-                # Показываем превью данных
-                if "preview" in result and result["preview"]:
+                # Показываем превью данных (при повторной загрузке того же файла - не нужно)
+                if result.get("preview") and not result.get("repeated"):
                     await message.answer(f"📋 <b>Превью импортированных данных:</b>\n\n{result['preview']}", parse_mode="HTML")
-                    
             else:
                 error_msg = result.get("error", "Неизвестная ошибка")
                 await progress_message.edit_text(f"❌ Ошибка импорта: {error_msg}")
-                
-        finally:
-            # Удаляем временный файл
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        
+        # Дальше временным файлом владеет задача импорта: она удаляет его по завершении
+        import_jobs.start(user_id, upload_path, on_progress, on_finish, file_format)
                 
     except Exception as e:
         logging.error(f"Ошибка в handle_document_upload: {e}")
         await message.answer("❌ Произошла ошибка при обработке файла")
 
+async def handle_excel_import_cancel(callback_query: CallbackQuery):
+    """Обработчик отмены фонового импорта"""
+    try:
+        if await import_jobs.cancel(callback_query.from_user.id):
+            await callback_query.answer("Импорт отменен")
+        else:
+            await callback_query.answer("Импорт уже завершен")
+    except Exception as e:
+        logging.error(f"Ошибка в handle_excel_import_cancel: {e}")
+        await callback_query.answer("❌ Произошла ошибка", show_alert=True)
+
 async def handle_excel_stats(callback_query: CallbackQuery):
     """Обработчик просмотра статистики Excel данных"""
     try:
@@ -200,44 +280,69 @@ async def handle_excel_stats(callback_query: CallbackQuery):
         logging.error(f"Ошибка в handle_excel_stats: {e}")
         await callback_query.answer("❌ Ошибка получения статистики", show_alert=True)
 
-async def export_user_data_to_excel(user_id: int, limit: int = 100) -> str:
-    """Экспорт данных пользователя в Excel файл"""
+async def export_user_data_to_excel(user_id: int) -> Optional[bytes]:
+    """
+    Экспорт всей истории пользователя в Excel (лист на каждый цикл и сводный
+    лист); возвращает содержимое файла .xlsx или None, если записей нет
+    """
     try:
-        from db_handler import db
-        import pandas as pd
-        
-        # Получаем записи пользователя
-        records = await db.get_user_records(user_id, limit=limit)
+        excel_data_handler = await load_module("excel_data_handler")
         
-        if not records:
+        # Строки читаются курсором и сразу пишутся в книгу, файл собирается в памяти
+        output = io.BytesIO()
+        if not await excel_data_handler.export_history_to_excel(user_id, output):
             return None
         
-        # Преобразуем в DataFrame
-        df_data = []
-        for record in records:
-            df_data.append({
-                'Дата': record['record_date'],
-                'БТТ': record.get('temperature'),
-                'Тип слизи': record.get('mucus_type'),
-                'Менструация': record.get('menstruation_type'),
-                'Положение шейки': record.get('cervical_position'),
-                'Заметка': record.get('note'),
-                'Создано': record['created_at'],
-                'Обновлено': record['updated_at']
-            })
+        return output.getvalue()
         
-        df = pd.DataFrame(df_data)
+    except Exception as e:
+        logging.error(f"Ошибка экспорта в Excel: {e}")
+        return None
+
+async def export_user_data_to_table(user_id: int, file_format: str) -> Optional[bytes]:
+    """
+    Экспорт всей истории пользователя в CSV или Parquet (одна таблица,
+    цикл - в колонке «Цикл»); возвращает содержимое файла или None, если
+    записей нет
+    """
+    try:
+        table_data_handler = await load_module("table_data_handler")
         
-        # Сохраняем в Excel
-        output_path = f"export_fertility_{user_id}.xlsx"
-        df.to_excel(output_path, index=False)
+        output = io.BytesIO()
+        if not await table_data_handler.export_history_to_table(user_id, output, file_format):
+            return None
         
-        return output_path
+        return output.getvalue()
         
     except Exception as e:
-        logging.error(f"Ошибка экспорта в Excel: {e}")
+        logging.error(f"Ошибка экспорта в {file_format}: {e}")
         return None
 
+async def handle_export_to_table(callback_query: CallbackQuery):
+    """Обработчик экспорта данных пользователя в CSV или Parquet"""
+    try:
+        user_id = callback_query.from_user.id
+        file_format, extension, title = EXPORT_FORMATS[callback_query.data]
+        await callback_query.answer(f"⏳ Экспортируем данные в {title}...")
+        
+        export_data = await export_user_data_to_table(user_id, file_format)
+        
+        if export_data:
+            await callback_query.message.answer_document(
+                types.BufferedInputFile(
+                    export_data,
+                    filename=f"fertility_data_{user_id}.{extension}"
+                ),
+                caption=f"📊 Ваши данные о фертильности в формате {title}"
+            )
+        else:
+            await callback_query.message.answer(f"❌ Не удалось экспортировать данные в {title}. "
+                                                f"Возможно, у вас нет записей.")
+            
+    except Exception as e:
+        logging.error(f"Ошибка в handle_export_to_table: {e}")
+        await callback_query.message.answer("❌ Произошла ошибка при экспорте данных")
+
 async def handle_export_to_excel(message: Message):
     """Обработчик экспорта данных пользователя в Excel"""
     try:
@@ -245,21 +350,17 @@ async def handle_export_to_excel(message: Message):
         
         progress_message = await message.answer("⏳ Экспортируем ваши данные в Excel...")
         
-        export_path = await export_user_data_to_excel(user_id)
+        export_data = await export_user_data_to_excel(user_id)
         
-        if export_path and os.path.exists(export_path):
+        if export_data:
             # Отправляем файл пользователю
-            with open(export_path, 'rb') as file:
-                await message.answer_document(
-                    types.BufferedInputFile(
-                        file.read(),
-                        filename=f"fertility_data_{user_id}.xlsx"
-                    ),
-                    caption="📊 Ваши данные о фертильности в формате Excel"
-                )
-            
-            # Удаляем временный файл
-            os.remove(export_path)
+            await message.answer_document(
+                types.BufferedInputFile(
+                    export_data,
+                    filename=f"fertility_data_{user_id}.xlsx"
+                ),
+                caption="📊 Ваши данные о фертильности в формате Excel"
+            )
             
             await progress_message.edit_text("✅ Данные успешно экспортированы!")
         else:
@@ -277,6 +378,8 @@ def register_excel_handlers(dp):
     dp.callback_query.register(handle_excel_template_download, lambda c: c.data == "excel_template")
     dp.callback_query.register(handle_excel_upload_request, lambda c: c.data == "excel_upload")
     dp.callback_query.register(handle_excel_stats, lambda c: c.data == "excel_stats")
+    dp.callback_query.register(handle_excel_import_cancel, lambda c: c.data == "excel_import_cancel")
+    dp.callback_query.register(handle_export_to_table, lambda c: c.data in EXPORT_FORMATS)
     
     # Обработчики документов
     dp.message.register(handle_document_upload, lambda message: message.document is not None)
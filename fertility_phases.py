@@ -0,0 +1,22 @@
+"""
+Фазы менструального цикла
+
+Отдельный легкий модуль без matplotlib/numpy: его импортируют обработчики
+и оценка цикла при запуске бота, не загружая стек построения графиков.
+"""
+
+from enum import Enum
+
+
+class FertilityPhase(Enum):
+    """Фазы менструального цикла"""
+    MENSTRUAL = "Менструация"
+    FOLLICULAR = "Фолликулярная"
+    OVULATION = "Овуляция"
+    LUTEAL = "Лютеиновая"
+    UNKNOWN = "Неопределенная"
+
+
+# Коды фаз для массивов CycleSeries.phase_codes
+PHASES = list(FertilityPhase)
+PHASE_CODES = {phase: code for code, phase in enumerate(PHASES)}
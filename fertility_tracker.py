@@ -1,4 +1,5 @@
 # fertility_tracker_bot.py
+# Обработчики основного бота; бот запускается через main.py (сборка - fertility_bot.py)
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, Command
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
@@ -29,6 +30,13 @@ except ImportError as e:
     logging.warning(f"Модуль графиков не доступен: {e}")
     CHARTS_AVAILABLE = False
 
+# Импорт инкрементальной оценки цикла (Sensiplan)
+try:
+    from cycle_evaluator import cycle_tracker
+except ImportError as e:
+    logging.warning(f"Модуль оценки цикла не доступен: {e}")
+    cycle_tracker = None
+
 # Функция для форматирования даты в формат DD.MM.YY
 def format_date(date_str):
     """Форматирование даты из YYYY-MM-DD в DD.MM.YY"""
@@ -48,6 +56,18 @@ def get_today_display_format():
     """Получение сегодняшней даты в формате DD.MM.YY для отображения"""
     return datetime.now().strftime("%d.%m.%y")
 
+# Функция для обновления состояния цикла после записи за день
+async def update_cycle_state(user_id: int, record_date: str):
+    """Инкрементальное обновление фазы и фертильного окна по сохраненной записи"""
+    if cycle_tracker is not None:
+        await cycle_tracker.observe_record(user_id, record_date)
+
+def schedule_chart_prerender(user_id: int):
+    """Упреждающая отрисовка графика после записи температуры (в фоне)"""
+    if CHARTS_AVAILABLE:
+        from chart_cache import schedule_speculative_render
+        schedule_speculative_render(user_id)
+
 # Создание основной клавиатуры
 def get_main_keyboard():
     builder = ReplyKeyboardBuilder()
@@ -179,6 +199,9 @@ async def handle_temperature_input(message: Message):
                         temperature=temperature
                     )
                 
+                await update_cycle_state(user_id, today_db)
+                schedule_chart_prerender(user_id)
+                
                 await message.answer(f"✅ Температура {temperature}°C записана на {today_display}", reply_markup=get_main_keyboard())
             else:
                 await message.answer("❌ Пожалуйста, введите действительную температуру от 35.0°C до 40.0°C")
@@ -271,6 +294,8 @@ async def handle_discharge_selection(callback_query: CallbackQuery):
                     mucus_type=discharge_descriptions[discharge_type]
                 )
             
+            await update_cycle_state(user_id, today_db)
+            
             await callback_query.message.edit_text(f"✅ Выделения '{discharge_descriptions[discharge_type]}' записаны на {today_display}")
         
         await callback_query.answer()
@@ -325,6 +350,8 @@ async def handle_menstruation_selection(callback_query: CallbackQuery):
                 menstruation_type=menstruation_descriptions[menstruation_type]
             )
         
+        await update_cycle_state(user_id, today_db)
+        
         await callback_query.message.edit_text(f"✅ Менструация '{menstruation_descriptions[menstruation_type]}' записана на {today_display}")
         await callback_query.answer()
     except TelegramForbiddenError:
@@ -548,6 +575,7 @@ async def handle_disruption_selection(callback_query: CallbackQuery):
         
         # Сохраняем в базу данных
         await db.create_record(**update_params)
+        await update_cycle_state(user_id, today_db)
         
         # Формируем текст с текущими нарушениями
         disruptions_text = ", ".join(current_disruptions) if current_disruptions else "нет"
@@ -782,6 +810,10 @@ async def on_startup():
     try:
         await db.initialize()
         logging.info("База данных успешно инициализирована")
+        
+        # Графики и Excel загружаются в фоне, пока бот уже принимает обновления
+        from lazy_modules import schedule_prewarm
+        schedule_prewarm()
     except Exception as e:
         logging.error(f"Не удалось инициализировать базу данных: {e}")
         raise
@@ -789,33 +821,13 @@ async def on_startup():
 async def on_shutdown():
     """Закрытие подключения к базе данных при завершении работы"""
     try:
+        from render_pool import shutdown_render_pool
+        shutdown_render_pool()
+        
+        from import_jobs import import_jobs
+        await import_jobs.cancel_all()
+        
         await db.close()
         logging.info("Подключение к базе данных закрыто")
     except Exception as e:
         logging.error(f"Ошибка при закрытии подключения к базе данных: {e}")
-
-async def main():
-    # Регистрация обработчиков графиков
-    if CHARTS_AVAILABLE:
-        register_chart_handlers(dp)
-        logging.info("Обработчики графиков зарегистрированы")
-    
-    # Регистрация обработчиков запуска и завершения работы
-    dp.startup.register(on_startup)
-    dp.shutdown.register(on_shutdown)
-    
-    logging.info("Запуск бота для отслеживания фертильности с поддержкой графиков...")
-    try:
-        await dp.start_polling(bot)
-    except TelegramForbiddenError as e:
-        logging.error(f"Бот заблокирован пользователем: {e}")
-    except Exception:
-        logging.exception("Критическая ошибка при опросе")
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logging.info("Бот остановлен пользователем")
-    except Exception:
-        logging.exception("Непредвиденная ошибка")
\ No newline at end of file
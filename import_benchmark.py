@@ -0,0 +1,364 @@
+"""
+Бенчмарк импорта Excel
+
+Запуск: python import_benchmark.py [all|import|extract|formats] [--workbook путь] [--repeats N] [--days N]
+
+import - прежний многопроходный импорт, воспроизведенный здесь же
+(извлечение через iterrows, затем get_statistics и трижды
+export_to_bot_format, каждый с повторным извлечением записей), против
+однопроходного import_excel_to_bot. Запись в базу заменяется счетчиком строк, чтобы
+измерялся только разбор; каждый замер идет в отдельном процессе ради
+честного пика RSS.
+
+extract - построчное извлечение через iterrows против векторного
+records_frame на таблице листа, размноженной до разных размеров; строки
+для базы сравниваются на совпадение.
+
+formats - запись (экспорт истории) и разбор (импорт того же файла) года
+данных в xlsx, CSV и Parquet: время, записей в секунду и размер файла;
+строки для базы из всех форматов сравниваются на совпадение.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List
+
+import pandas as pd
+
+DEFAULT_WORKBOOK = "2_год_2024_Бланк_карт.xlsx"
+REPEATS = 5
+USER_ID = 1
+EXTRACT_ROWS = [1_000, 10_000, 100_000]
+FORMAT_DAYS = 365
+
+
+def _count_rows_instead_of_db():
+    """Запись в базу в процессе бенчмарка: только подсчет строк"""
+    from db_handler import db
+
+    async def bulk_upsert_records(user_id, rows, outcomes=None):
+        return {"inserted": len(rows), "updated": 0, "unchanged": 0, "skipped": 0}
+
+    db.bulk_upsert_records = bulk_upsert_records
+
+
+def _statistics_old(records: List[Any]) -> Dict[str, Any]:
+    """Прежняя get_statistics: отдельные проходы по списку записей"""
+    temperatures = [r.temperature or r.temperature_alt for r in records if r.temperature or r.temperature_alt]
+    return {
+        "total_records": len(records),
+        "temperature_records": len([r for r in records if r.temperature or r.temperature_alt]),
+        "records_with_disruptions": len([r for r in records if r.disruptions]),
+        "records_with_notes": len([r for r in records if r.note]),
+        "date_range": {
+            "start": min([r.date for r in records if r.date], default=None),
+            "end": max([r.date for r in records if r.date], default=None)
+        },
+        "temperature_stats": {
+            "min": min(temperatures),
+            "max": max(temperatures),
+            "avg": sum(temperatures) / len(temperatures),
+            "count": len(temperatures)
+        } if temperatures else {}
+    }
+
+
+def _export_old(records: List[Any], user_id: int) -> str:
+    """Прежний export_to_bot_format: строка, собираемая через +="""
+    if not records:
+        return "Нет данных для экспорта"
+
+    result = f"📊 Экспорт данных фертильности (пользователь {user_id})\n\n"
+    for record in records:
+        if record.date:
+            result += f"📅 {record.date.strftime('%d.%m.%y')}\n"
+        if record.temperature:
+            result += f"🌡 БТТ: {record.temperature}°C\n"
+        elif record.temperature_alt:
+            result += f"🌡 Температура: {record.temperature_alt}°C\n"
+        if record.disruptions:
+            result += f"⚠️ Нарушения: {record.disruptions}\n"
+        if record.measurement_time:
+            result += f"⏰ Время: {record.measurement_time}\n"
+        if record.note or record.new_thermometer:
+            result += f"📝 Заметка: {record.note or record.new_thermometer}\n"
+        result += "\n"
+    return result
+
+
+def _multi_pass(path: str) -> int:
+    """
+    Прежний импорт: извлечение iterrows, сохранение, затем get_statistics
+    и трижды export_to_bot_format - каждый заново извлекал записи из листа
+    """
+    from excel_data_handler import ExcelDataHandler
+    from db_handler import db
+
+    handler = ExcelDataHandler(path)
+    handler.load_excel_data()
+    records = _records_with_iterrows(handler.data)
+    asyncio.run(db.bulk_upsert_records(USER_ID, _db_rows(records)))
+    _statistics_old(_records_with_iterrows(handler.data))
+    export = _export_old(_records_with_iterrows(handler.data), USER_ID)
+    if len(_export_old(_records_with_iterrows(handler.data), USER_ID)) > 500:
+        export = _export_old(_records_with_iterrows(handler.data), USER_ID)[:500] + "..."
+    return len(records)
+
+
+def _single_pass(path: str) -> int:
+    """Текущий импорт: один проход по листу (первому, как и прежний импорт)"""
+    from excel_data_handler import ExcelDataHandler, ImportSummary
+
+    handler = ExcelDataHandler(path)
+    summary = ImportSummary(user_id=USER_ID)
+    asyncio.run(handler.save_frames_bulk(USER_ID, summary.observe(handler.iter_record_frames())))
+    summary.statistics()
+    summary.preview()
+    return summary.total_records
+
+
+IMPORTERS = {
+    "несколько проходов": _multi_pass,
+    "один проход": _single_pass,
+}
+
+
+def _measure(name: str, path: str) -> Dict[str, float]:
+    """Замер одного импорта в чистом процессе"""
+    _count_rows_instead_of_db()
+    started = time.perf_counter()
+    records = IMPORTERS[name](path)
+    elapsed = time.perf_counter() - started
+    return {
+        "records": records,
+        "ms": elapsed * 1000,
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def benchmark_import(path: str, repeats: int):
+    print(f"Импорт {path}, повторов: {repeats}")
+    print(f"{'вариант':>20} {'записей':>8} {'мс (медиана)':>13} {'пик RSS, МБ':>12}")
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in IMPORTERS:
+        samples = []
+        for _ in range(repeats):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                samples.append(executor.submit(_measure, name, path).result())
+        times = sorted(sample["ms"] for sample in samples)
+        results[name] = times[len(times) // 2]
+        print(f"{name:>20} {samples[0]['records']:>8} {results[name]:>13.1f} "
+              f"{max(sample['rss_mb'] for sample in samples):>12.1f}")
+
+    speedup = results["несколько проходов"] / results["один проход"]
+    print(f"Однопроходный импорт быстрее в {speedup:.1f} раза")
+
+
+def _records_with_iterrows(data: pd.DataFrame) -> List[Any]:
+    """
+    Прежнее извлечение записей через iterrows - эталон для сравнения; даты
+    отсчитываются от текущего месяца с переходом на следующий месяц, когда
+    номер дня уменьшается
+    """
+    from excel_data_handler import FertilityRecord
+
+    records = []
+    today = date.today()
+    month_index = today.year * 12 + today.month - 1
+    last_day = None
+    for _, row in data[data['БТТ'].notna() | data['температура.1'].notna()].iterrows():
+        record = FertilityRecord()
+        if pd.notna(row.get('День цикла')):
+            record.cycle_day = int(row['День цикла'])
+        if pd.notna(row.get('Дата')):
+            day = int(row['Дата'])
+            if last_day is not None and day < last_day:
+                month_index += 1
+            last_day = day
+            try:
+                record.date = date(month_index // 12, month_index % 12 + 1, day)
+            except (ValueError, TypeError):
+                pass
+        if pd.notna(row.get('БТТ')):
+            record.temperature = float(row['БТТ'])
+        if pd.notna(row.get('температура.1')):
+            record.temperature_alt = float(row['температура.1'])
+        for attribute, name in (('disruptions', 'Нарушения'), ('disruption_code', 'НТ'), ('note', 'Примечание'),
+                                ('new_thermometer', 'Новый термометр'), ('measurement_time', 'Время'),
+                                ('timing_note', 'позже/раньше'), ('fertile_period', 'плодный период')):
+            if pd.notna(row.get(name)):
+                setattr(record, attribute, str(row[name]))
+        records.append(record)
+    return records
+
+
+def _db_rows(records: List[Any]) -> List[tuple]:
+    """Прежняя сборка строк для базы: заметка склеивается по каждой записи"""
+    rows = []
+    for record in records:
+        note_parts = []
+        if record.note:
+            note_parts.append(f"Примечание: {record.note}")
+        if record.new_thermometer:
+            note_parts.append(f"Термометр: {record.new_thermometer}")
+        if record.disruption_code:
+            note_parts.append(f"Код: {record.disruption_code}")
+        if record.measurement_time:
+            note_parts.append(f"Время: {record.measurement_time}")
+        if record.timing_note:
+            note_parts.append(f"Время заметка: {record.timing_note}")
+        if record.fertile_period:
+            note_parts.append(f"Плодный период: {record.fertile_period}")
+        if record.cycle_day:
+            note_parts.append(f"День цикла: {record.cycle_day}")
+        if record.date:
+            rows.append((record.date, record.temperature or record.temperature_alt,
+                         "; ".join(note_parts) if note_parts else None))
+    return rows
+
+
+def _extract_with_iterrows(data: pd.DataFrame) -> List[tuple]:
+    return _db_rows(_records_with_iterrows(data))
+
+
+def _extract_vectorized(data: pd.DataFrame) -> List[tuple]:
+    from excel_data_handler import records_frame, frame_db_rows
+
+    return frame_db_rows(records_frame(data))
+
+
+def benchmark_extract(path: str, repeats: int):
+    from excel_data_handler import SOURCE_COLUMNS
+
+    sheet = pd.read_excel(path, sheet_name=0)
+    sheet = sheet[[name for name in SOURCE_COLUMNS if name in sheet.columns]]
+    sheet = sheet[sheet['БТТ'].notna() | sheet['температура.1'].notna()]
+    print(f"Извлечение записей: таблица листа {path} ({len(sheet)} строк), размноженная")
+    print(f"{'строк':>8} {'iterrows, мс':>13} {'векторно, мс':>13} {'ускорение':>10}")
+
+    for rows in EXTRACT_ROWS:
+        data = pd.concat([sheet] * (rows // len(sheet) + 1), ignore_index=True).iloc[:rows]
+        results = {}
+        for name, extract in (("iterrows", _extract_with_iterrows), ("vectorized", _extract_vectorized)):
+            times = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                results[name] = extract(data)
+                times.append((time.perf_counter() - started) * 1000)
+            results[name + "_ms"] = sorted(times)[len(times) // 2]
+        if results["iterrows"] != results["vectorized"]:
+            raise AssertionError(f"Результаты извлечения расходятся на {rows} строках")
+        print(f"{rows:>8} {results['iterrows_ms']:>13.1f} {results['vectorized_ms']:>13.1f} "
+              f"{results['iterrows_ms'] / results['vectorized_ms']:>9.1f}x")
+
+
+def _history_records(days: int) -> List[Dict[str, Any]]:
+    """Записи пользователя за days дней в виде строк db.iter_user_records (28-дневные циклы)"""
+    records = []
+    start = date(2025, 1, 1)
+    for index in range(days):
+        cycle_day = index % 28
+        records.append({
+            'record_date': start + timedelta(days=index),
+            'temperature': round(36.3 + (0.4 if cycle_day > 14 else 0) + (index % 5) * 0.05, 2) if index % 7 else None,
+            'mucus_type': 'яичный белок' if cycle_day in (12, 13) else None,
+            'menstruation_type': 'обильная' if cycle_day < 4 else None,
+            'cervical_position': None,
+            'note': f"Заметка {index}; время: 06:30" if index % 3 == 0 else None,
+            'abdominal_pain': cycle_day == 1,
+            'breast_tenderness': cycle_day > 24,
+            'intercourse': cycle_day == 13,
+            'disruptions': '["стресс"]' if index % 11 == 0 else '[]',
+            'created_at': datetime(2025, 1, 1, 7, 0),
+            'updated_at': datetime(2025, 1, 1, 7, 0),
+        })
+    return records
+
+
+def _write_history(file_format: str, records: List[Dict[str, Any]]) -> bytes:
+    """Экспорт истории в формат (как export_history_to_excel / export_history_to_table)"""
+    import io
+    from excel_data_handler import HistoryWorkbookWriter
+    from table_data_handler import HistoryTableWriter
+
+    output = io.BytesIO()
+    if file_format == "xlsx":
+        writer = HistoryWorkbookWriter()
+        for record in records:
+            writer.add(record)
+        writer.save(output)
+    else:
+        writer = HistoryTableWriter(output, file_format)
+        for record in records:
+            writer.add(record)
+        writer.close()
+    return output.getvalue()
+
+
+def _parse_history(file_format: str, data: bytes) -> List[tuple]:
+    """Импорт файла до строк для базы (как процесс разбора import_jobs)"""
+    import io
+    from excel_data_handler import frame_db_rows
+    from table_data_handler import open_import_file
+
+    rows = []
+    for frame in open_import_file(io.BytesIO(data), file_format).iter_workbook_frames():
+        rows.extend(frame_db_rows(frame))
+    return rows
+
+
+def benchmark_formats(days: int, repeats: int):
+    from table_data_handler import PARQUET_AVAILABLE
+
+    records = _history_records(days)
+    formats = ["xlsx", "csv"] + (["parquet"] if PARQUET_AVAILABLE else [])
+    print(f"Форматы: история за {days} дней ({len(records)} записей), повторов: {repeats}")
+    if not PARQUET_AVAILABLE:
+        print("pyarrow не установлен, Parquet пропущен")
+    print(f"{'формат':>8} {'запись, мс':>11} {'записей/с':>10} {'разбор, мс':>11} {'записей/с':>10} {'размер, КБ':>11}")
+
+    results = {}
+    for file_format in formats:
+        write_times, parse_times = [], []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            data = _write_history(file_format, records)
+            write_times.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            results[file_format] = _parse_history(file_format, data)
+            parse_times.append((time.perf_counter() - started) * 1000)
+        write_ms = sorted(write_times)[len(write_times) // 2]
+        parse_ms = sorted(parse_times)[len(parse_times) // 2]
+        print(f"{file_format:>8} {write_ms:>11.1f} {len(records) / write_ms * 1000:>10.0f} "
+              f"{parse_ms:>11.1f} {len(records) / parse_ms * 1000:>10.0f} {len(data) / 1024:>11.1f}")
+
+    for file_format in formats[1:]:
+        if results[file_format] != results["xlsx"]:
+            raise AssertionError(f"Строки для базы из {file_format} и xlsx расходятся")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк импорта Excel")
+    parser.add_argument("suite", nargs="?", default="all", choices=["all", "import", "extract", "formats"])
+    parser.add_argument("--workbook", default=DEFAULT_WORKBOOK)
+    parser.add_argument("--repeats", type=int, default=REPEATS,
+                        help=f"повторов каждого варианта (по умолчанию {REPEATS})")
+    parser.add_argument("--days", type=int, default=FORMAT_DAYS,
+                        help=f"дней истории для сравнения форматов (по умолчанию {FORMAT_DAYS})")
+    args = parser.parse_args()
+
+    if args.suite in ("all", "import"):
+        benchmark_import(args.workbook, args.repeats)
+    if args.suite in ("all", "extract"):
+        print()
+        benchmark_extract(args.workbook, args.repeats)
+    if args.suite in ("all", "formats"):
+        print()
+        benchmark_formats(args.days, args.repeats)
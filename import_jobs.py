@@ -0,0 +1,340 @@
+"""
+Фоновый импорт Excel (а также CSV и Parquet)
+
+Разбор файла (openpyxl, pandas) занимает процессор на секунды, поэтому
+выполняется в отдельных процессах, а обработчик сообщения сразу
+возвращается. В книге ищутся все листы-карты, каждый лист разбирается
+своим процессом (не больше IMPORT_SHEET_WORKERS одновременно) с датами,
+восстановленными по месяцу и году карты. Процессы отдают пачки строк для
+базы через общую ограниченную очередь (не больше QUEUE_CHUNKS пачек в
+пути), бот сводит строки всех листов в общий буфер и записывает его
+запросами db.bulk_upsert_records по IMPORT_CHUNK_SIZE строк, периодически
+сообщая, сколько записей обработано.
+
+Файл, уже импортированный пользователем (тот же отпечаток содержимого),
+при неизменных с того импорта записях не разбирается: сразу возвращается
+сохраненный итог. При записи в базу меняются только новые и изменившиеся
+дни; итог импорта показывает, сколько дней добавлено, изменено и осталось
+без изменений.
+
+Загруженный файл лежит в приватном временном файле: процессы разбора
+открывают его по пути (содержимое не копируется в каждый процесс), а
+задача импорта удаляет его по завершении.
+
+Импорт можно отменить: процесс разбора завершается, уже записанные пачки
+остаются в базе. Одновременно выполняется не больше IMPORT_WORKERS
+импортов, у каждого пользователя - не больше одного.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "2"))
+IMPORT_SHEET_WORKERS = int(os.getenv("IMPORT_SHEET_WORKERS", str(min(4, os.cpu_count() or 1))))
+QUEUE_CHUNKS = 4          # пачек между процессом разбора и записью в базу
+PROGRESS_INTERVAL = 2.0   # с между сообщениями о прогрессе
+POLL_INTERVAL = 0.5       # с ожидания очередной пачки до проверки, жив ли процесс
+JOIN_TIMEOUT = 5.0
+FINGERPRINT_BLOCK = 1024 * 1024  # байт файла за одно чтение при подсчете отпечатка
+
+
+class ImportAlreadyRunningError(Exception):
+    """У пользователя уже выполняется импорт"""
+
+
+@dataclass
+class ImportJob:
+    user_id: int
+    records_parsed: int = 0
+    records_saved: int = 0
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    skipped: int = 0
+    cancelled: bool = False
+    started_at: float = field(default_factory=time.perf_counter)
+    task: Optional[asyncio.Task] = None
+    processes: Dict[int, multiprocessing.Process] = field(default_factory=dict)
+
+
+def file_fingerprint(file_path: str) -> str:
+    """Отпечаток содержимого загруженного файла (файл читается блоками)"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(FINGERPRINT_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def discard_upload(file_path: str):
+    """Удаление временного файла загрузки"""
+    try:
+        os.remove(file_path)
+    except OSError as e:
+        logging.warning(f"Не удалось удалить временный файл импорта {file_path}: {e}")
+
+
+def discover_import_sheets(file_path: str, file_format: str = "xlsx") -> List[tuple]:
+    """Листы-карты загруженной книги с месяцем и годом каждой карты (CSV и Parquet - один лист)"""
+    from table_data_handler import open_import_file
+
+    return open_import_file(file_path, file_format).discover_card_sheets()
+
+
+def parse_import_sheet(file_path: str, file_format: str, user_id: int, index: int, sheet_name: str, dates,
+                       chunk_size: int, chunks: multiprocessing.Queue):
+    """
+    Процесс разбора одного листа: читает лист пачками и кладет в очередь
+    ("rows", номер листа, строки для базы, число записей), затем
+    ("done", номер листа, ImportSummary) или ("error", номер листа, текст ошибки)
+    """
+    try:
+        from excel_data_handler import ImportSummary, frame_db_rows
+        from table_data_handler import open_import_file
+
+        handler = open_import_file(file_path, file_format)
+        summary = ImportSummary(user_id=user_id)
+        for frame in summary.observe(handler.iter_record_frames(chunk_size, sheet_name, dates)):
+            chunks.put(("rows", index, frame_db_rows(frame), len(frame)))
+        chunks.put(("done", index, summary))
+    except Exception as e:
+        logging.error(f"Ошибка разбора листа '{sheet_name}' файла пользователя {user_id}: {e}")
+        chunks.put(("error", index, str(e)))
+
+
+class ImportJobs:
+    """Фоновые задачи импорта по пользователям"""
+
+    def __init__(self, workers: int = IMPORT_WORKERS):
+        self.workers = max(1, workers)
+        self._jobs: Dict[int, ImportJob] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def get(self, user_id: int) -> Optional[ImportJob]:
+        return self._jobs.get(user_id)
+
+    def start(self, user_id: int, file_path: str,
+              on_progress: Callable[[ImportJob], Awaitable[None]],
+              on_finish: Callable[[ImportJob, Dict[str, Any]], Awaitable[None]],
+              file_format: str = "xlsx") -> ImportJob:
+        """
+        Запуск импорта в фоне. on_progress вызывается не чаще раза в
+        PROGRESS_INTERVAL, on_finish - один раз с результатом в формате
+        import_excel_to_bot (плюс "cancelled" при отмене, "repeated" при
+        повторной загрузке уже импортированного файла). Временный файл
+        file_path переходит к задаче: она удаляет его по завершении (или
+        сразу, если импорт не запущен).
+        """
+        if user_id in self._jobs:
+            discard_upload(file_path)
+            raise ImportAlreadyRunningError(user_id)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+
+        job = ImportJob(user_id=user_id)
+        self._jobs[user_id] = job
+        job.task = asyncio.create_task(self._run(job, file_path, file_format, on_progress, on_finish))
+        return job
+
+    async def cancel(self, user_id: int) -> bool:
+        """Отмена импорта пользователя; False, если импорт не выполняется"""
+        job = self._jobs.get(user_id)
+        if job is None or job.task is None or job.task.done():
+            return False
+        job.cancelled = True
+        job.task.cancel()
+        try:
+            await job.task
+        except asyncio.CancelledError:
+            pass
+        return True
+
+    async def cancel_all(self):
+        """Отмена всех импортов (при завершении работы бота)"""
+        for user_id in list(self._jobs):
+            await self.cancel(user_id)
+
+    async def _run(self, job: ImportJob, file_path: str, file_format: str, on_progress, on_finish):
+        from db_handler import db
+
+        result: Dict[str, Any] = {"success": False, "error": "Импорт прерван"}
+        context = multiprocessing.get_context("spawn")
+        chunks = context.Queue(maxsize=QUEUE_CHUNKS)
+        try:
+            fingerprint = await asyncio.to_thread(file_fingerprint, file_path)
+            result = await self._repeated_import(job, fingerprint)
+            if result is None:
+                async with self._slots:
+                    result = await self._parse_and_save(job, file_path, file_format, context, chunks, on_progress)
+                if result["success"]:
+                    # Версия записей после импорта: повторная загрузка файла отвечается сразу, пока она не изменится
+                    records_state = await db.get_records_state(job.user_id)
+                    if records_state is not None:
+                        await db.save_import_fingerprint(job.user_id, fingerprint, records_state, result)
+        except asyncio.CancelledError:
+            result = {"success": False, "cancelled": True, "error": "Импорт отменен"}
+        except Exception as e:
+            logging.error(f"Ошибка фонового импорта пользователя {job.user_id}: {e}")
+            result = {"success": False, "error": str(e)}
+        finally:
+            await self._stop_processes(job, chunks)
+            discard_upload(file_path)
+            self._jobs.pop(job.user_id, None)
+
+        result.setdefault("records_saved", job.records_saved)
+        logging.info(f"Импорт пользователя {job.user_id} завершен за {time.perf_counter() - job.started_at:.1f} с: "
+                     f"разобрано {job.records_parsed}, сохранено {job.records_saved}"
+                     f"{', отменен' if job.cancelled else ''}")
+        try:
+            await on_finish(job, result)
+        except Exception as e:
+            logging.error(f"Ошибка уведомления о завершении импорта пользователя {job.user_id}: {e}")
+
+    @staticmethod
+    async def _repeated_import(job: ImportJob, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Итог прежнего импорта того же файла, если записи пользователя с тех
+        пор не менялись (иначе файл разбирается заново)
+        """
+        from db_handler import db
+
+        previous = await db.get_import_fingerprint(job.user_id, fingerprint)
+        if previous is None or previous["records_state"] != await db.get_records_state(job.user_id):
+            return None
+        result = previous["result"]
+        logging.info(f"Пользователь {job.user_id} повторно загрузил уже импортированный файл")
+        return dict(result, repeated=True, inserted=0, updated=0, unchanged=result.get("records_saved", 0))
+
+    async def _parse_and_save(self, job: ImportJob, file_path: str, file_format: str, context, chunks,
+                              on_progress) -> Dict[str, Any]:
+        """Поиск листов-карт, их разбор и запись в базу"""
+        try:
+            sheets = await asyncio.to_thread(discover_import_sheets, file_path, file_format)
+        except Exception as e:
+            logging.error(f"Ошибка загрузки файла {file_format} пользователя {job.user_id}: {e}")
+            return {"success": False, "error": f"Не удалось прочитать файл {file_format.upper()}"}
+        if not sheets:
+            return {"success": False, "error": "В файле не найдено листов с картами (нет колонки 'БТТ')"}
+        return await self._consume(job, file_path, file_format, sheets, context, chunks, on_progress)
+
+    async def _consume(self, job: ImportJob, file_path: str, file_format: str, sheets: List[tuple], context, chunks,
+                       on_progress) -> Dict[str, Any]:
+        """
+        Разбор листов процессами и запись строк всех листов в базу общим
+        буфером по мере поступления
+        """
+        from db_handler import db
+        from excel_data_handler import IMPORT_CHUNK_SIZE, SKIPPED_COUNT, WRITE_COUNTS, ImportSummary
+
+        pending = list(enumerate(sheets))
+        summaries: Dict[int, ImportSummary] = {}
+        buffer: List[tuple] = []
+        # Дата -> номер листа, чья строка за этот день уже принята: при пересечении карт побеждает
+        # более поздний лист книги, как при последовательном импорте, независимо от порядка разбора
+        date_sheets: Dict[Any, int] = {}
+        # Итог каждого записанного дня: день учитывается один раз, сколько бы строк за него ни пришло
+        outcomes: Dict[Any, str] = {}
+
+        def start_next():
+            index, (sheet_name, dates) = pending.pop(0)
+            process = context.Process(
+                target=parse_import_sheet,
+                args=(file_path, file_format, job.user_id, index, sheet_name, dates, IMPORT_CHUNK_SIZE, chunks),
+                daemon=True
+            )
+            process.start()
+            job.processes[index] = process
+
+        async def flush():
+            rows = buffer[:]
+            buffer.clear()
+            counts = await db.bulk_upsert_records(job.user_id, rows, outcomes)
+            if counts:
+                job.inserted += counts["inserted"]
+                job.updated += counts["updated"]
+                job.unchanged += counts["unchanged"]
+                job.skipped += counts[SKIPPED_COUNT]
+                job.records_saved += sum(counts[key] for key in WRITE_COUNTS)
+
+        for _ in range(min(max(1, IMPORT_SHEET_WORKERS), len(pending))):
+            start_next()
+
+        last_progress = time.perf_counter()
+        while job.processes:
+            try:
+                message = await asyncio.to_thread(chunks.get, True, POLL_INTERVAL)
+            except queue.Empty:
+                if not any(process.is_alive() for process in job.processes.values()):
+                    return {"success": False, "error": "Процесс разбора файла аварийно завершен"}
+                continue
+
+            kind, index = message[0], message[1]
+            if kind == "error":
+                return {"success": False, "error": f"Лист '{sheets[index][0]}': {message[2]}"}
+            if kind == "done":
+                summaries[index] = message[2]
+                await asyncio.to_thread(job.processes.pop(index).join, JOIN_TIMEOUT)
+                if pending:
+                    start_next()
+                continue
+
+            _, _, rows, records = message
+            job.records_parsed += records
+            for row in rows:
+                if date_sheets.get(row[0], -1) > index:
+                    # День перекрыт более поздней картой: строка не записывается и с базой не сверяется
+                    job.skipped += 1
+                    continue
+                date_sheets[row[0]] = index
+                buffer.append(row)
+            if len(buffer) >= IMPORT_CHUNK_SIZE:
+                await flush()
+            if time.perf_counter() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.perf_counter()
+                try:
+                    await on_progress(job)
+                except Exception as e:
+                    logging.warning(f"Не удалось обновить прогресс импорта пользователя {job.user_id}: {e}")
+        if buffer:
+            await flush()
+
+        # Итоги листов сводятся в порядке листов в книге, чтобы превью шло по картам
+        summary = ImportSummary(user_id=job.user_id)
+        for index in sorted(summaries):
+            summary.merge(summaries[index])
+        if not summary.total_records:
+            return {"success": False, "error": "Не найдено записей для импорта"}
+        return {
+            # Каждый день с датой - либо сохранен один раз, либо повтор даты
+            "success": job.records_saved == summary.dated_records - job.skipped,
+            "records_imported": summary.total_records,
+            "records_saved": job.records_saved,
+            "inserted": job.inserted,
+            "updated": job.updated,
+            "unchanged": job.unchanged,
+            "skipped": job.skipped,
+            "statistics": summary.statistics(),
+            "preview": summary.preview()
+        }
+
+    @staticmethod
+    async def _stop_processes(job: ImportJob, chunks):
+        """Завершение процессов разбора (при отмене или ошибке - принудительно)"""
+        for process in job.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in job.processes.values():
+            await asyncio.to_thread(process.join, JOIN_TIMEOUT)
+        job.processes.clear()
+        chunks.close()
+        chunks.cancel_join_thread()
+
+
+import_jobs = ImportJobs()
@@ -0,0 +1,78 @@
+"""
+Ленивая загрузка тяжелых модулей бота
+
+Графики, прогнозы и Excel тянут matplotlib, pandas и numpy: это сотни мс и
+десятки МБ при каждом запуске. Модули загружаются при первом запросе графика
+или Excel (в отдельном потоке, чтобы не блокировать цикл событий) либо
+фоновым прогревом после запуска опроса.
+"""
+
+import asyncio
+import importlib
+import logging
+import os
+import time
+from types import ModuleType
+from typing import Dict
+
+# Модули, загрузка которых откладывается до первого использования
+HEAVY_MODULES = (
+    "fertility_chart_generator",  # numpy, matplotlib (при первой отрисовке)
+    "cycle_predictor",            # numpy
+    "cohort_analyzer",            # numpy
+    "light_chart_renderer",       # numpy
+    "cycle_report",               # numpy (PDF-отчет)
+    "excel_data_handler",         # pandas, openpyxl
+    "table_data_handler",         # pandas, pyarrow (CSV и Parquet)
+)
+
+# Фоновый прогрев после запуска опроса (PREWARM_MODULES=0 - отключить)
+PREWARM_ENABLED = os.getenv("PREWARM_MODULES", "1") != "0"
+
+_loaded: Dict[str, ModuleType] = {}
+
+
+async def load_module(name: str) -> ModuleType:
+    """Модуль по имени; при первом обращении импортируется в отдельном потоке"""
+    module = _loaded.get(name)
+    if module is None:
+        module = await asyncio.to_thread(importlib.import_module, name)
+        _loaded[name] = module
+    return module
+
+
+async def prewarm_heavy_modules():
+    """Фоновая загрузка тяжелых модулей, чтобы первый запрос не ждал импорта"""
+    started = time.perf_counter()
+    for name in HEAVY_MODULES:
+        try:
+            await load_module(name)
+        except Exception as e:
+            logging.warning(f"Не удалось загрузить модуль {name}: {e}")
+
+    try:
+        excel_data_handler = await load_module("excel_data_handler")
+        await asyncio.to_thread(excel_data_handler.excel_template_bytes)
+    except Exception as e:
+        logging.warning(f"Не удалось подготовить шаблон Excel: {e}")
+
+    try:
+        chart_generator = await load_module("fertility_chart_generator")
+        await asyncio.to_thread(chart_generator.load_pyplot)
+    except Exception as e:
+        logging.warning(f"Не удалось загрузить matplotlib: {e}")
+
+    logging.info(f"Прогрев модулей завершен за {time.perf_counter() - started:.2f} с")
+
+    # Процессы отрисовки (пробный график в каждом при PREWARM_RENDER=1)
+    try:
+        render_pool = await load_module("render_pool")
+        await render_pool.start_render_pool()
+    except Exception as e:
+        logging.warning(f"Не удалось запустить пул отрисовки: {e}")
+
+
+def schedule_prewarm():
+    """Запуск прогрева в фоне (вызывается из обработчика запуска)"""
+    if PREWARM_ENABLED:
+        asyncio.get_running_loop().create_task(prewarm_heavy_modules())
@@ -0,0 +1,165 @@
+"""
+Легкий рендерер графиков без matplotlib
+
+Для быстрых ответов: SVG по шаблону (при наличии cairosvg может быть
+растрирован в PNG) и компактная текстовая строка из блоков Unicode с
+полосой фаз для встраивания в сообщение. Строится за миллисекунды из
+того же CycleSeries, что и полный график; matplotlib остается для
+полных графиков.
+"""
+
+import logging
+from typing import Optional, List
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from fertility_phases import FertilityPhase, PHASES
+
+try:
+    import cairosvg
+    SVG_RASTER_AVAILABLE = True
+except ImportError:
+    cairosvg = None
+    SVG_RASTER_AVAILABLE = False
+
+SPARK_BLOCKS = "▁▂▃▄▅▆▇█"
+SPARK_GAP = "·"         # день без измерения
+SPARKLINE_DAYS = 28     # сколько последних дней помещается в строку сообщения
+
+PHASE_CELLS = {
+    FertilityPhase.MENSTRUAL: "🟥",
+    FertilityPhase.FOLLICULAR: "🟦",
+    FertilityPhase.OVULATION: "⭐",
+    FertilityPhase.LUTEAL: "🟩",
+    FertilityPhase.UNKNOWN: "⬜",
+}
+
+# Те же цвета фаз, что и у полного графика
+PHASE_COLORS = {
+    FertilityPhase.MENSTRUAL: '#FF6B6B',
+    FertilityPhase.FOLLICULAR: '#4ECDC4',
+    FertilityPhase.OVULATION: '#45B7D1',
+    FertilityPhase.LUTEAL: '#96CEB4',
+    FertilityPhase.UNKNOWN: '#CCCCCC'
+}
+
+SVG_WIDTH = 800
+SVG_HEIGHT = 420
+SVG_MARGIN = (50, 20, 50, 60)  # сверху, справа, снизу, слева
+
+
+class LightChartRenderer:
+    """Рендерер SVG и текстовых графиков по CycleSeries"""
+
+    def sparkline(self, cycle_data, days: int = SPARKLINE_DAYS) -> str:
+        """Строка температур из блоков ▁..█ за последние days дней"""
+        temperatures = cycle_data.temperatures[-days:]
+        valid = ~np.isnan(temperatures)
+        if not valid.any():
+            return ""
+
+        low = np.nanmin(temperatures)
+        span = np.nanmax(temperatures) - low
+        levels = np.zeros(len(temperatures), dtype=np.int64)
+        if span > 0:
+            levels[valid] = np.rint((temperatures[valid] - low) / span * (len(SPARK_BLOCKS) - 1))
+
+        blocks = np.array(list(SPARK_BLOCKS))
+        return "".join(np.where(valid, blocks[levels], SPARK_GAP))
+
+    def phase_strip(self, cycle_data, days: int = SPARKLINE_DAYS) -> str:
+        """Полоса фаз за последние days дней (один символ на день)"""
+        cells = np.array([PHASE_CELLS[phase] for phase in PHASES])
+        return "".join(cells[cycle_data.phase_codes[-days:]])
+
+    def text_chart(self, cycle_data, days: int = SPARKLINE_DAYS) -> str:
+        """Компактный текстовый график: диапазон температур, строка и полоса фаз"""
+        sparkline = self.sparkline(cycle_data, days)
+        if not sparkline:
+            return ""
+
+        temperatures = cycle_data.temperatures[-days:]
+        dates = cycle_data.dates[-days:].tolist()
+        return (
+            f"🌡 {np.nanmin(temperatures):.2f}–{np.nanmax(temperatures):.2f}°C, "
+            f"{dates[0].strftime('%d.%m')}–{dates[-1].strftime('%d.%m')}\n"
+            f"<code>{sparkline}</code>\n"
+            f"{self.phase_strip(cycle_data, days)}"
+        )
+
+    def svg_chart(self, cycle_data, title: str = "График базальной температуры") -> bytes:
+        """График температуры с фазами в виде SVG"""
+        top, right, bottom, left = SVG_MARGIN
+        plot_width = SVG_WIDTH - left - right
+        plot_height = SVG_HEIGHT - top - bottom
+        length = len(cycle_data)
+
+        parts: List[str] = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" height="{SVG_HEIGHT}" '
+            f'viewBox="0 0 {SVG_WIDTH} {SVG_HEIGHT}" font-family="DejaVu Sans, Arial, sans-serif">',
+            f'<rect width="{SVG_WIDTH}" height="{SVG_HEIGHT}" fill="white"/>',
+            f'<text x="{SVG_WIDTH / 2:.0f}" y="30" text-anchor="middle" font-size="18" '
+            f'font-weight="bold">{escape(title)}</text>',
+        ]
+
+        temperatures = cycle_data.temperatures
+        valid = ~np.isnan(temperatures)
+        if not valid.any():
+            parts.append(f'<text x="{SVG_WIDTH / 2:.0f}" y="{SVG_HEIGHT / 2:.0f}" text-anchor="middle" '
+                         f'font-size="16">Нет данных о температуре</text>')
+            parts.append('</svg>')
+            return "".join(parts).encode("utf-8")
+
+        low = np.nanmin(temperatures) - 0.1
+        high = np.nanmax(temperatures) + 0.1
+        day_width = plot_width / max(length - 1, 1)
+        xs = left + np.arange(length) * day_width
+        ys = top + (high - temperatures) / (high - low) * plot_height
+
+        # Фоны фаз: по прямоугольнику на отрезок одинаковой фазы
+        codes = cycle_data.phase_codes
+        run_starts = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1])
+        run_ends = np.append(run_starts[1:], length - 1)
+        for run_start, run_end in zip(run_starts, run_ends):
+            color = PHASE_COLORS[PHASES[codes[run_start]]]
+            parts.append(f'<rect x="{xs[run_start]:.1f}" y="{top}" width="{max(xs[run_end] - xs[run_start], 1):.1f}" '
+                         f'height="{plot_height}" fill="{color}" fill-opacity="0.2"/>')
+
+        # Сетка и подписи температуры (шаг 0.1 °C)
+        for tick in np.arange(np.ceil(low * 10) / 10, high, 0.1):
+            y = top + (high - tick) / (high - low) * plot_height
+            parts.append(f'<line x1="{left}" y1="{y:.1f}" x2="{SVG_WIDTH - right}" y2="{y:.1f}" '
+                         f'stroke="#000" stroke-opacity="0.1"/>')
+            parts.append(f'<text x="{left - 6}" y="{y + 4:.1f}" text-anchor="end" font-size="11">{tick:.1f}</text>')
+
+        # Подписи дат (около 10 на оси)
+        dates = cycle_data.dates.tolist()
+        step = max(1, length // 10)
+        for i in range(0, length, step):
+            parts.append(f'<text x="{xs[i]:.1f}" y="{SVG_HEIGHT - bottom + 18}" text-anchor="middle" '
+                         f'font-size="11">{dates[i].strftime("%d.%m")}</text>')
+
+        # Линия и точки температуры
+        points = " ".join(f"{x:.1f},{y:.1f}" for x, y in zip(xs[valid], ys[valid]))
+        parts.append(f'<polyline points="{points}" fill="none" stroke="#2E86AB" stroke-width="2"/>')
+
+        ovulation = valid & (codes == PHASES.index(FertilityPhase.OVULATION))
+        fertile = valid & cycle_data.fertile & ~ovulation
+        for mask, color, radius in ((valid, "#2E86AB", 3.5), (fertile, "orange", 5), (ovulation, "red", 7)):
+            parts.extend(f'<circle cx="{x:.1f}" cy="{y:.1f}" r="{radius}" fill="{color}"/>'
+                         for x, y in zip(xs[mask], ys[mask]))
+
+        parts.append('</svg>')
+        return "".join(parts).encode("utf-8")
+
+    @staticmethod
+    def rasterize(svg: bytes, scale: float = 1.0) -> Optional[bytes]:
+        """PNG из SVG (если установлен cairosvg), иначе None"""
+        if not SVG_RASTER_AVAILABLE:
+            return None
+        try:
+            return cairosvg.svg2png(bytestring=svg, scale=scale)
+        except Exception as e:
+            logging.error(f"Ошибка растрирования SVG: {e}")
+            return None
@@ -0,0 +1,157 @@
+"""
+Пул процессов для отрисовки графиков
+
+Отрисовка и сохранение PNG в 300 dpi занимают сотни мс процессорного
+времени, поэтому выполняются в отдельных процессах и не блокируют цикл
+событий бота. В процесс передается уже обработанный CycleSeries, обратно
+возвращаются байты изображения.
+
+Первая отрисовка в процессе дополнительно платит за поиск шрифтов
+(DejaVu Sans / Liberation Sans / Arial Unicode MS), инициализацию Agg и
+первое использование numpy. При включенном прогреве (PREWARM_RENDER=1)
+каждый процесс пула рисует пробный график при запуске, и первый
+пользователь получает график так же быстро, как последующие.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, timedelta
+from typing import Optional
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(2, os.cpu_count() or 1))))  # 0 - в текущем процессе
+PREWARM_RENDER = os.getenv("PREWARM_RENDER", "0") == "1"
+START_ATTEMPTS = 20  # раундов ожидания ответа от всех процессов при запуске
+
+_executor: Optional[ProcessPoolExecutor] = None
+# pyplot не потокобезопасен: отрисовки в потоках текущего процесса идут по одной
+_thread_render_lock = threading.Lock()
+
+
+def _throwaway_records():
+    """Короткий синтетический цикл для пробной отрисовки"""
+    start = date(2024, 1, 1)
+    return [
+        {
+            "record_date": start + timedelta(days=i),
+            "temperature": 36.3 + (0.4 if i > 14 else 0.0) + (i % 3) * 0.05,
+            "menstruation_type": "Средние" if i < 4 else None,
+        }
+        for i in range(28)
+    ]
+
+
+def _init_worker(prewarm: bool):
+    """Инициализация процесса пула: Agg, шрифты и (опционально) пробный график"""
+    import matplotlib
+    matplotlib.use("Agg")
+    from fertility_chart_generator import FertilityChartGenerator, load_pyplot
+    load_pyplot()
+
+    if prewarm:
+        started = time.perf_counter()
+        cycle_data = FertilityChartGenerator().process_cycle_data(_throwaway_records())
+        render_chart(cycle_data, "summary")
+        render_chart(cycle_data, "temperature")
+        logging.info(f"Процесс отрисовки {os.getpid()} прогрет за {time.perf_counter() - started:.2f} с")
+
+
+def _ping() -> int:
+    # Короткая пауза, чтобы задачи распределились по разным процессам
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def render_chart(cycle_data, chart_type: str, dpi: int = 300) -> bytes:
+    """Отрисовка графика (выполняется в процессе пула); cycle_data - CycleSeries или CycleOverlay"""
+    from fertility_chart_generator import FertilityChartGenerator, OVERLAY_ALIGNMENTS
+    generator = FertilityChartGenerator()
+    if chart_type in OVERLAY_ALIGNMENTS:
+        return generator.create_overlay_chart(cycle_data, dpi=dpi).getvalue()
+    if chart_type == "summary":
+        return generator.create_cycle_summary_chart(cycle_data, dpi=dpi).getvalue()
+    return generator.create_temperature_chart(cycle_data, dpi=dpi).getvalue()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Пул процессов отрисовки (создается при первом обращении)"""
+    global _executor
+    if _executor is None:
+        # spawn: процессы не наследуют потоки и соединения бота; главный модуль
+        # (main.py) они импортируют заново, поэтому в нем нет aiogram и бота
+        _executor = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(PREWARM_RENDER,)
+        )
+    return _executor
+
+
+def _run_locked(func, *args):
+    with _thread_render_lock:
+        return func(*args)
+
+
+async def run_in_pool(func, *args):
+    """
+    Выполнение функции модуля (например, сборки отчета) в пуле. При сбое
+    пул пересоздается и задача повторяется один раз; если сбой повторился -
+    выполняется в потоке текущего процесса (по одной отрисовке)
+    """
+    global _executor
+    if RENDER_WORKERS <= 0:
+        return await asyncio.to_thread(_run_locked, func, *args)
+
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        executor = get_executor()
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool as e:
+            logging.error(f"Пул отрисовки аварийно завершен, пересоздаем: {e}")
+            # Пул мог уже пересоздать другой задачей, сбой которой пришел раньше
+            if _executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                _executor = None
+    return await asyncio.to_thread(_run_locked, func, *args)
+
+
+async def render_in_pool(cycle_data, chart_type: str, dpi: int = 300) -> bytes:
+    """Отрисовка графика в пуле процессов"""
+    return await run_in_pool(render_chart, cycle_data, chart_type, dpi)
+
+
+async def start_render_pool():
+    """
+    Запуск всех процессов пула (с пробной отрисовкой при PREWARM_RENDER=1).
+    Вызывается в фоне после запуска опроса.
+    """
+    if RENDER_WORKERS <= 0:
+        return
+
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    # Процессы spawn-пула запускаются все сразу при первой задаче и отвечают
+    # после инициализации (и прогрева); ждем ответа от каждого процесса
+    pids = set()
+    for _ in range(START_ATTEMPTS):
+        pids.update(await asyncio.gather(*[loop.run_in_executor(executor, _ping) for _ in range(RENDER_WORKERS)]))
+        if len(pids) >= RENDER_WORKERS:
+            break
+    logging.info(f"Пул отрисовки запущен за {time.perf_counter() - started:.2f} с: "
+                 f"{len(pids)} процессов, прогрев {'включен' if PREWARM_RENDER else 'выключен'}")
+
+
+def shutdown_render_pool():
+    """Остановка пула (при завершении работы бота)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,204 @@
+"""
+Планировщик отрисовки графиков
+
+Все отрисовки PNG проходят через ограниченную очередь с классами
+приоритета: запросы пользователей раньше упреждающих, упреждающие раньше
+пакетных. Одинаковые ожидающие задачи (тот же пользователь, тип графика
+и данные) объединяются. При переполнении запрос пользователя вытесняет
+задачу с более низким приоритетом, а если вытеснять нечего - получает
+RenderBusyError («занято, попробуйте позже»), вместо того чтобы
+нагружать процессор и память без ограничений.
+
+Глубина очереди и время ожидания по классам доступны через metrics().
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+INTERACTIVE = 0
+SPECULATIVE = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", SPECULATIVE: "speculative", BATCH: "batch"}
+
+MAX_QUEUE = int(os.getenv("RENDER_QUEUE_SIZE", "32"))
+WAIT_SAMPLES = 500       # последних ожиданий для перцентилей по каждому классу
+METRICS_LOG_EVERY = 100  # выполненных задач между записями метрик в журнал
+
+
+class RenderBusyError(Exception):
+    """Очередь отрисовки переполнена: запрос нужно повторить позже"""
+
+
+@dataclass
+class RenderJob:
+    key: Hashable
+    priority: int
+    factory: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    started: bool = False
+    evicted: bool = False
+
+
+class RenderScheduler:
+    """Ограниченная очередь отрисовки с приоритетами и объединением задач"""
+
+    def __init__(self, workers: Optional[int] = None, max_queue: int = MAX_QUEUE):
+        self._workers_count = workers
+        self.max_queue = max_queue
+        self._heap: List = []
+        self._sequence = itertools.count()
+        self._pending: Dict[Hashable, RenderJob] = {}
+        self._running: Dict[Hashable, RenderJob] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._waits: Dict[int, Deque[float]] = {p: deque(maxlen=WAIT_SAMPLES) for p in PRIORITY_NAMES}
+        self.stats = {"submitted": 0, "completed": 0, "deduplicated": 0, "rejected": 0, "evicted": 0}
+
+    @property
+    def workers(self) -> int:
+        if self._workers_count is None:
+            from render_pool import RENDER_WORKERS
+            self._workers_count = max(RENDER_WORKERS, 1)
+        return self._workers_count
+
+    def depth(self) -> int:
+        """Число задач, ожидающих отрисовки"""
+        return len(self._pending)
+
+    def busy(self) -> bool:
+        """Есть ожидающие задачи или все обработчики заняты"""
+        return bool(self._pending) or len(self._running) >= self.workers
+
+    def _ensure_workers(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._workers = [task for task in self._workers if not task.done()]
+        while len(self._workers) < self.workers:
+            self._workers.append(asyncio.get_running_loop().create_task(self._worker()))
+
+    def _push(self, job: RenderJob):
+        heapq.heappush(self._heap, (job.priority, next(self._sequence), job))
+        self._wakeup.set()
+
+    def _evict_for(self, priority: int) -> bool:
+        """Вытеснение самой новой задачи с самым низким приоритетом (ниже priority)"""
+        candidates = [job for job in self._pending.values() if job.priority > priority]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda job: (job.priority, job.enqueued_at))
+        victim.evicted = True
+        del self._pending[victim.key]
+        victim.future.set_exception(RenderBusyError("задача вытеснена более срочной"))
+        self.stats["evicted"] += 1
+        return True
+
+    async def submit(self, key: Hashable, factory: Callable[[], Awaitable[Any]],
+                     priority: int = INTERACTIVE) -> Any:
+        """
+        Постановка отрисовки в очередь и ожидание результата. key определяет
+        одинаковые задачи; factory - корутина отрисовки. RenderBusyError,
+        если очередь переполнена (упреждающие задачи - если она просто занята).
+        """
+        self._ensure_workers()
+
+        job = self._pending.get(key) or self._running.get(key)
+        if job is not None:
+            self.stats["deduplicated"] += 1
+            if not job.started and priority < job.priority:
+                # Повышение приоритета: старая запись в куче будет пропущена
+                job.priority = priority
+                self._push(job)
+            return await asyncio.shield(job.future)
+
+        if priority == SPECULATIVE and self.busy():
+            self.stats["rejected"] += 1
+            raise RenderBusyError("очередь отрисовки занята")
+
+        if len(self._pending) >= self.max_queue and not self._evict_for(priority):
+            self.stats["rejected"] += 1
+            logging.warning(f"Очередь отрисовки переполнена ({len(self._pending)} задач), "
+                            f"запрос {PRIORITY_NAMES[priority]} отклонен")
+            raise RenderBusyError("очередь отрисовки переполнена")
+
+        job = RenderJob(key=key, priority=priority, factory=factory,
+                        future=asyncio.get_running_loop().create_future())
+        self._pending[key] = job
+        self.stats["submitted"] += 1
+        self._push(job)
+        return await asyncio.shield(job.future)
+
+    async def _next_job(self) -> RenderJob:
+        while True:
+            while self._heap:
+                priority, _, job = heapq.heappop(self._heap)
+                # Пропуск вытесненных, уже начатых и устаревших (после повышения приоритета) записей
+                if job.evicted or job.started or priority != job.priority:
+                    continue
+                return job
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            job.started = True
+            del self._pending[job.key]
+            self._running[job.key] = job
+            self._waits[job.priority].append(time.perf_counter() - job.enqueued_at)
+
+            try:
+                job.future.set_result(await job.factory())
+            except asyncio.CancelledError:
+                # Отрисовка отменена (пул остановлен с cancel_futures или бот завершается):
+                # ожидающие этот ключ получают RenderBusyError, а не ждут вечно
+                job.future.set_exception(RenderBusyError("отрисовка отменена"))
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                job.future.set_exception(e)
+            except BaseException:
+                # KeyboardInterrupt/SystemExit: ожидающие не остаются без ответа, обработчик завершается
+                job.future.set_exception(RenderBusyError("отрисовка прервана"))
+                raise
+            finally:
+                del self._running[job.key]
+                self.stats["completed"] += 1
+                if self.stats["completed"] % METRICS_LOG_EVERY == 0:
+                    logging.info(f"Метрики отрисовки: {self.metrics()}")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Глубина очереди, время ожидания по классам (мс) и счетчики"""
+        depth_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+        for job in self._pending.values():
+            depth_by_priority[PRIORITY_NAMES[job.priority]] += 1
+
+        wait_ms = {}
+        for priority, samples in self._waits.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            wait_ms[PRIORITY_NAMES[priority]] = {
+                "p50": round(ordered[len(ordered) // 2] * 1000, 1),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                "max": round(ordered[-1] * 1000, 1),
+            }
+
+        return {
+            "queue_depth": len(self._pending),
+            "depth_by_priority": depth_by_priority,
+            "running": len(self._running),
+            "wait_ms": wait_ms,
+            **self.stats,
+        }
+
+
+# Глобальный экземпляр
+render_scheduler = RenderScheduler()
@@ -0,0 +1,99 @@
+"""
+Бенчмарк холодного запуска бота (python -X importtime)
+
+Импортирует сборку бота (fertility_bot) в отдельном процессе, разбирает
+отчет importtime и завершается с ошибкой, если при запуске загружаются
+тяжелые модули (matplotlib, pandas, numpy) или импорт превышает бюджет
+времени. Отдельно проверяется главный модуль main: его заново импортирует
+каждый процесс пулов (spawn), поэтому aiogram и база в нем не загружаются.
+
+Запуск: python startup_benchmark.py [--budget-ms 3000]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from typing import List, Dict, Tuple
+
+ENTRY_MODULE = "fertility_bot"
+FORBIDDEN_MODULES = ("matplotlib", "pandas", "numpy", "openpyxl")
+WORKER_MAIN_MODULE = "main"  # импортируется процессами пулов как __mp_main__
+WORKER_FORBIDDEN_MODULES = ("aiogram", "asyncpg", "db_handler", "fertility_bot")
+REPEATS = 3
+DEFAULT_BUDGET_MS = 3000.0
+DUMMY_TOKEN = "123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"  # только для создания Bot()
+
+
+def run_importtime(module: str) -> List[Tuple[str, int, int]]:
+    """Импорт модуля в чистом процессе; возвращает (имя, собственное, накопленное время в мкс)"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, API_TOKEN=DUMMY_TOKEN, PYTHONPATH=repo_dir, PYTHONDONTWRITEBYTECODE="1")
+
+    # Рабочий каталог временный: при импорте создается каталог logs
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=work_dir, env=env, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"Импорт {module} завершился с ошибкой:\n{result.stderr[-2000:]}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def summarize(entries: List[Tuple[str, int, int]], module: str,
+              forbidden: Tuple[str, ...] = FORBIDDEN_MODULES) -> Dict:
+    """Общее время импорта, загруженные тяжелые модули и самые дорогие импорты"""
+    total_us = next(cumulative for name, _, cumulative in entries if name == module)
+    heavy = sorted({name.split(".")[0] for name, _, _ in entries} & set(forbidden))
+    top_level = [(name, cumulative) for name, _, cumulative in entries if "." not in name]
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return {"total_ms": total_us / 1000, "heavy": heavy, "top": top_level[:10]}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help=f"бюджет времени импорта {ENTRY_MODULE} (медиана)")
+    args = parser.parse_args()
+
+    # Первый запуск прогревает файловый кэш, результаты берутся по последующим
+    run_importtime(ENTRY_MODULE)
+    runs = [summarize(run_importtime(ENTRY_MODULE), ENTRY_MODULE) for _ in range(REPEATS)]
+    median_ms = sorted(run["total_ms"] for run in runs)[REPEATS // 2]
+
+    print(f"import {ENTRY_MODULE}: медиана {median_ms:.0f} мс из {REPEATS} запусков (бюджет {args.budget_ms:.0f} мс)")
+    print("Самые дорогие модули верхнего уровня:")
+    for name, cumulative in runs[-1]["top"]:
+        print(f"  {name:<40} {cumulative / 1000:>8.1f} мс")
+
+    failed = False
+    heavy = runs[-1]["heavy"]
+    if heavy:
+        print(f"ОШИБКА: при запуске загружаются тяжелые модули: {', '.join(heavy)}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print(f"ОШИБКА: импорт дольше бюджета ({median_ms:.0f} > {args.budget_ms:.0f} мс)")
+        failed = True
+
+    worker = summarize(run_importtime(WORKER_MAIN_MODULE), WORKER_MAIN_MODULE, WORKER_FORBIDDEN_MODULES)
+    print(f"import {WORKER_MAIN_MODULE} (процессы пулов): {worker['total_ms']:.0f} мс")
+    if worker["heavy"]:
+        print(f"ОШИБКА: процессы пулов при импорте главного модуля загружают: {', '.join(worker['heavy'])}")
+        failed = True
+
+    if not failed:
+        print("Холодный запуск в норме: matplotlib, pandas и numpy не загружаются")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
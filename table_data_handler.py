@@ -0,0 +1,249 @@
+"""
+Импорт и экспорт CSV и Parquet
+
+Табличные форматы проходят через тот же конвейер строк, что и Excel:
+колонки сопоставляются по тем же заголовкам (IMPORT_COLUMNS), пачки
+преобразуются records_frame и пишутся в базу db.bulk_upsert_records, а
+экспорт строит строки истории тем же HistoryRows, что и лист цикла в xlsx
+(плюс колонка с номером цикла). Файлы читаются и пишутся пачками, целиком
+в памяти не держатся.
+
+Parquet требует pyarrow; без него доступен только CSV.
+"""
+
+import csv
+import importlib.util
+import io
+import logging
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Union
+
+import pandas as pd
+
+from db_handler import db
+from excel_data_handler import (
+    HISTORY_COLUMNS, IMPORT_CHUNK_SIZE, IMPORT_COLUMNS, ExcelDataHandler, HistoryRows, SheetDates, records_frame
+)
+
+# pyarrow импортируется только для Parquet: процессы разбора xlsx и CSV его не загружают
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+TABLE_FORMATS = ("csv", "parquet")
+# Колонки экспорта истории в таблицу: номер цикла и колонки листа цикла xlsx
+TABLE_HISTORY_COLUMNS = ["Цикл"] + [name for name, _ in HISTORY_COLUMNS]
+EXPORT_BATCH_ROWS = 10_000  # строк в группе строк Parquet
+CSV_SNIFF_BYTES = 64 * 1024
+
+
+def _parquet_schema():
+    """Типы колонок экспорта в Parquet (даты - датами, температура - числом)"""
+    import pyarrow
+
+    types = {
+        "Цикл": pyarrow.int32(), "Дата": pyarrow.date32(), "День цикла": pyarrow.int32(),
+        "БТТ": pyarrow.float64(), "Создано": pyarrow.timestamp("us"), "Обновлено": pyarrow.timestamp("us"),
+    }
+    return pyarrow.schema([(name, types.get(name, pyarrow.string())) for name in TABLE_HISTORY_COLUMNS])
+
+
+class TableDataHandler:
+    """
+    Чтение CSV или Parquet с колонками листа-карты (или экспорта истории)
+    пачками записей, с тем же интерфейсом, что у ExcelDataHandler: файл
+    считается одним листом-картой
+    """
+
+    def __init__(self, file_path: Union[str, BinaryIO], file_format: str):
+        if file_format not in TABLE_FORMATS:
+            raise ValueError(f"Неизвестный формат таблицы: {file_format}")
+        if file_format == "parquet" and not PARQUET_AVAILABLE:
+            raise RuntimeError("Для файлов Parquet нужен пакет pyarrow")
+        self.file_path = file_path
+        self.file_format = file_format
+        self.source_name = file_path if isinstance(file_path, str) else f"загруженный файл {file_format.upper()}"
+        self._options: Optional[Dict[str, Any]] = None
+        self._columns: Optional[List[str]] = None
+
+    def _source(self) -> Union[str, BinaryIO]:
+        """Источник для чтения; файловый объект перематывается в начало перед каждым проходом"""
+        if not isinstance(self.file_path, str):
+            self.file_path.seek(0)
+        return self.file_path
+
+    def _csv_options(self) -> Dict[str, Any]:
+        """Разделитель и десятичный знак CSV (выгрузки Excel с русской локалью - «;» и «,»)"""
+        if self._options is not None:
+            return self._options
+        source = self._source()
+        if isinstance(source, str):
+            with open(source, "rb") as file:
+                sample = file.read(CSV_SNIFF_BYTES)
+        else:
+            sample = source.read(CSV_SNIFF_BYTES)
+        try:
+            delimiter = csv.Sniffer().sniff(sample.decode("utf-8-sig", errors="ignore"), delimiters=",;\t").delimiter
+        except csv.Error:
+            delimiter = ","
+        self._options = {"sep": delimiter, "decimal": "," if delimiter == ";" else ".", "encoding": "utf-8-sig"}
+        return self._options
+
+    def columns(self) -> List[str]:
+        """Заголовки таблицы (повторяющиеся - с суффиксами .1, .2, как в pandas)"""
+        if self._columns is None:
+            if self.file_format == "csv":
+                options = self._csv_options()
+                self._columns = list(pd.read_csv(self._source(), nrows=0, **options).columns)
+            else:
+                import pyarrow.parquet as parquet
+
+                self._columns = list(parquet.ParquetFile(self._source()).schema_arrow.names)
+        return self._columns
+
+    def iter_raw_chunks(self, chunk_size: int = IMPORT_CHUNK_SIZE,
+                        columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+        """Таблица пачками по chunk_size строк (только нужные колонки)"""
+        present = [name for name in (columns or IMPORT_COLUMNS) if name in self.columns()]
+        if self.file_format == "csv":
+            options = self._csv_options()
+            with pd.read_csv(self._source(), chunksize=chunk_size, usecols=present, **options) as reader:
+                yield from reader
+        else:
+            import pyarrow.parquet as parquet
+
+            table = parquet.ParquetFile(self._source())
+            for batch in table.iter_batches(batch_size=chunk_size, columns=present):
+                yield batch.to_pandas()
+
+    def _table_dates(self) -> SheetDates:
+        """
+        Месяц и год для номеров дней в колонке «Дата»: полей карты в таблице
+        нет, поэтому таблица с номерами дней считается заканчивающейся в
+        текущем месяце (полные даты берутся как есть)
+        """
+        dates = SheetDates()
+        if "Дата" not in self.columns():
+            return dates
+        wraps = 0
+        previous = None
+        has_day_numbers = False
+        for chunk in self.iter_raw_chunks(columns=["Дата"]):
+            days = pd.to_numeric(chunk["Дата"], errors="coerce").dropna()
+            if days.empty:
+                continue
+            has_day_numbers = True
+            if previous is not None and days.iloc[0] < previous:
+                wraps += 1
+            wraps += int((days.diff() < 0).sum())
+            previous = days.iloc[-1]
+        if has_day_numbers:
+            dates.anchor_to_today(wraps)
+            logging.warning(f"В таблице {self.source_name} даты заданы номерами дней, "
+                            f"месяц отсчитан от текущего")
+        return dates
+
+    def discover_card_sheets(self) -> List[tuple]:
+        """Таблица как единственный лист-карта: [(название, SheetDates)] или [], если нет колонки «БТТ»"""
+        if "БТТ" not in self.columns():
+            logging.error(f"В таблице нет колонки 'БТТ': {self.source_name}")
+            return []
+        return [(self.file_format.upper(), self._table_dates())]
+
+    def iter_record_frames(self, chunk_size: int = IMPORT_CHUNK_SIZE, sheet_name: Optional[str] = None,
+                           dates: Optional[SheetDates] = None) -> Iterator[pd.DataFrame]:
+        """Потоковое извлечение записей пачками (records_frame, как для листа Excel)"""
+        if dates is None:
+            dates = self._table_dates()
+        count = 0
+        for chunk in self.iter_raw_chunks(chunk_size):
+            frame = records_frame(chunk, dates)
+            if not frame.empty:
+                count += len(frame)
+                yield frame
+        logging.info(f"Извлечено {count} записей о фертильности из {self.source_name}")
+
+    def iter_workbook_frames(self, chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """Пачки записей всей таблицы"""
+        for sheet_name, dates in self.discover_card_sheets():
+            yield from self.iter_record_frames(chunk_size, sheet_name, dates)
+
+
+def open_import_file(file_path: Union[str, BinaryIO], file_format: str = "xlsx"):
+    """Обработчик импорта по формату файла: xlsx, csv или parquet"""
+    if file_format == "xlsx":
+        return ExcelDataHandler(file_path)
+    return TableDataHandler(file_path, file_format)
+
+
+class HistoryTableWriter(HistoryRows):
+    """
+    Запись всей истории пользователя в CSV или Parquet по одной строке:
+    одна таблица, цикл - в колонке «Цикл». CSV пишется сразу построчно,
+    Parquet - группами строк по EXPORT_BATCH_ROWS.
+    """
+
+    def __init__(self, output: BinaryIO, file_format: str):
+        if file_format not in TABLE_FORMATS:
+            raise ValueError(f"Неизвестный формат таблицы: {file_format}")
+        if file_format == "parquet" and not PARQUET_AVAILABLE:
+            raise RuntimeError("Для файлов Parquet нужен пакет pyarrow")
+        super().__init__()
+        self.file_format = file_format
+        self.output = output
+        self.batch: List[list] = []
+        if file_format == "csv":
+            # BOM - чтобы Excel открыл кириллицу в UTF-8
+            self.text = io.TextIOWrapper(output, encoding="utf-8-sig", newline="")
+            self.csv = csv.writer(self.text)
+            self.csv.writerow(TABLE_HISTORY_COLUMNS)
+        else:
+            import pyarrow.parquet as parquet
+
+            self.schema = _parquet_schema()
+            self.parquet = parquet.ParquetWriter(output, self.schema)
+
+    def add(self, record: Dict[str, Any]):
+        """Запись строки истории (из db.iter_user_records)"""
+        row = self.row(record)
+        row.insert(0, self.cycles[-1].number)
+        if self.file_format == "csv":
+            self.csv.writerow(row)
+            return
+        self.batch.append(row)
+        if len(self.batch) >= EXPORT_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self.batch:
+            return
+        import pyarrow
+
+        columns = list(zip(*self.batch))
+        self.parquet.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+        self.batch = []
+
+    def close(self):
+        """Дописать файл; поток вывода остается открытым"""
+        if self.file_format == "csv":
+            self.text.flush()
+            self.text.detach()
+        else:
+            self._flush()
+            self.parquet.close()
+
+
+async def export_history_to_table(user_id: int, output: BinaryIO, file_format: str) -> int:
+    """
+    Экспорт всей истории пользователя в CSV или Parquet: строки читаются
+    курсором пачками и сразу пишутся в файл. Возвращает число выгруженных
+    записей (0 - записей нет).
+    """
+    writer = HistoryTableWriter(output, file_format)
+    async for batch in db.iter_user_records(user_id):
+        for record in batch:
+            writer.add(record)
+    writer.close()
+    logging.info(f"Экспорт истории пользователя {user_id} в {file_format.upper()}: "
+                 f"{writer.rows} записей, {len(writer.cycles)} циклов")
+    return writer.rows